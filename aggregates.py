@@ -0,0 +1,191 @@
+"""
+This program rebuilds the aggregates of the landings (see
+LANDING_AGGREGATES of schema.py) from TREATED_DATA and from its
+archives (see retention.py), or prints the report of an airport:
+python3 aggregates.py rebuild
+python3 aggregates.py report <airport> [<days>]
+The aggregates are kept up to date by triggers, in the transaction that
+writes TREATED_DATA, so a report never reads TREATED_DATA. They only
+have to be rebuilt when landings were written without the triggers (a
+backfill, or a database restored from a backup).
+The aggregates are only made for the SQLite storage (see storage.py).
+"""
+
+import glob
+import os
+import sys
+import time
+from functions import *
+from schema import (LANDING_DATABASE, LANDING_AGGREGATES, LANDING_MIGRATIONS, aggregate_columns,
+                    aggregate_conflict, add_landings_to_aggregate, landing_sums, migrate)
+from retention import ARCHIVE_SCHEMA, archive_path, create_archive_table, load_policies
+
+FILENAME = os.path.basename(__file__)
+# tables of the landings by period (see landings_by_period)
+PERIOD_AGGREGATES = {"hour": "LANDING_BY_HOUR", "day": "LANDING_BY_DAY"}
+# days of the report, by default
+REPORT_DAYS = 7
+
+print_c = lambda text : print_context(FILENAME, text)
+
+
+def sum_archives(conn: sqlite3.Connection, archive_dir: str, key: list) -> None:
+    """
+Writes the rows of the aggregates of the landings of all archives in
+the temporary tables ARCHIVED_<aggregate> (an archive can only be
+attached outside of a transaction)
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the landing database
+archive_dir : str
+    Directory of the archive databases
+key : list
+    Columns that identify a landing in the archives
+    """
+    for name in LANDING_AGGREGATES:
+        execute(conn, FILENAME, f"DROP TABLE IF EXISTS temp.\"ARCHIVED_{name}\";")
+        execute(conn, FILENAME, f"CREATE TEMP TABLE \"ARCHIVED_{name}\" AS SELECT * FROM main.\"{name}\" WHERE 0;")
+
+    for path in sorted(glob.glob(archive_path(archive_dir, LANDING_DATABASE, "*"))):
+        if execute(conn, FILENAME, f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA};", (path,)) is False:
+            continue
+        archive_columns = execute(conn, FILENAME, f"PRAGMA {ARCHIVE_SCHEMA}.table_info(\"TREATED_DATA\");").fetchall()
+        if len(archive_columns) > 0:
+            with transaction(conn, FILENAME):
+                # the archives of the older versions don't have all the
+                # columns
+                create_archive_table(conn, "TREATED_DATA", key)
+                for name in LANDING_AGGREGATES:
+                    execute(conn, FILENAME, f"""
+                            INSERT INTO temp."ARCHIVED_{name}"
+                            {landing_sums(name, f'{ARCHIVE_SCHEMA}."TREATED_DATA"')};
+                        """)
+        execute(conn, FILENAME, f"DETACH DATABASE {ARCHIVE_SCHEMA};")
+
+
+def rebuild_aggregates(conn: sqlite3.Connection, archive_dir: str, key: list) -> bool:
+    """
+Writes again all the aggregates of the landings, from TREATED_DATA and
+its archives, in one transaction
+
+Returns
+-------
+bool
+    True if the aggregates are rebuilt
+    """
+    sum_archives(conn, archive_dir, key)
+
+    is_rebuilt = False
+    with transaction(conn, FILENAME):
+        for name in LANDING_AGGREGATES:
+            keys, counters = aggregate_columns(name)
+            execute(conn, FILENAME, f"DELETE FROM \"{name}\";")
+            add_landings_to_aggregate(conn, FILENAME, name)
+            execute(conn, FILENAME, f"""
+                    INSERT INTO main."{name}" ({", ".join(keys + counters)})
+                    SELECT {", ".join(keys + [f"sum({counter})" for counter in counters])}
+                    FROM temp."ARCHIVED_{name}"
+                    WHERE 1
+                    GROUP BY {", ".join(keys)}
+                    {aggregate_conflict(name)};
+                """)
+        is_rebuilt = True
+
+    for name in LANDING_AGGREGATES:
+        execute(conn, FILENAME, f"DROP TABLE IF EXISTS temp.\"ARCHIVED_{name}\";")
+
+    return is_rebuilt
+
+
+def landings_by_period(conn: sqlite3.Connection, file: str, airport: str, period: str, begin: int,
+                       end: int) -> list:
+    """
+Returns the landings of an airport by hour or by day
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the landing database
+file : str
+    File which makes the query
+airport : str
+    Name of the airport
+period : str
+    "hour" or "day"
+begin : int
+    Beginning of the first period (unix timestamp)
+end : int
+    End of the last period (unix timestamp, excluded)
+
+Returns
+-------
+list
+    (beginning of the period, landings, confirmed landings, sent
+landings, mean probability) of each period with landings
+    """
+    name = PERIOD_AGGREGATES[period]
+    keys, counters = aggregate_columns(name)
+    landings, confirmed, sent, probability = counters
+    rows = execute(conn, file, f"""
+            SELECT {keys[1]}, {landings}, {confirmed}, {sent}, {probability} / {landings}
+            FROM "{name}"
+            WHERE {keys[0]} = ? AND {keys[1]} >= ? AND {keys[1]} < ?
+            ORDER BY {keys[1]};
+        """, (airport, begin, end))
+
+    return rows.fetchall() if rows else []
+
+
+def confirmation_rates(conn: sqlite3.Connection, file: str, airport: str) -> list:
+    """
+Returns, for each source of the landings of an airport, the part of its
+landings that were confirmed (by a PPR or an AFTN message)
+
+Returns
+-------
+list
+    (source, landings, confirmed landings, confirmation rate) of each
+source
+    """
+    rows = execute(conn, file, """
+            SELECT lsSource, lsLandings, lsConfirmed, CAST(lsConfirmed AS REAL) / lsLandings
+            FROM "LANDING_BY_SOURCE"
+            WHERE lsAirport = ?
+            ORDER BY lsLandings DESC;
+        """, (airport,))
+
+    return rows.fetchall() if rows else []
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("rebuild", "report") or (sys.argv[1] == "report" and len(sys.argv) < 3):
+        print_c("usage: python3 aggregates.py rebuild | report <airport> [<days>]")
+        exit()
+    if STORAGE.name != "sqlite":
+        print_c(f"ERROR: the aggregates are only made for SQLite, not for {STORAGE.name}")
+        exit()
+
+    conn = create_connection(LANDING_DATABASE)
+    migrate(conn, FILENAME, LANDING_MIGRATIONS)
+
+    if sys.argv[1] == "rebuild":
+        policies = load_policies()
+        if rebuild_aggregates(conn, policies["archive_path"], policies["tables"]["TREATED_DATA"]["key"]):
+            print_c("aggregates rebuilt")
+        else:
+            print_c("ERROR: the aggregates couldn't be rebuilt")
+    else:
+        airport = sys.argv[2]
+        days = int(sys.argv[3]) if len(sys.argv) > 3 else REPORT_DAYS
+        today = int(time.time()) // 86400 * 86400
+        for day, landing_c, confirmed_c, sent_c, probability in \
+                landings_by_period(conn, FILENAME, airport, "day", today - (days - 1) * 86400, today + 86400):
+            print_c(f"{time.strftime('%Y-%m-%d', time.gmtime(day))}: {landing_c} landings, "
+                    f"{confirmed_c} confirmed, {sent_c} sent, mean probability {probability:.2f}")
+        for source, landing_c, confirmed_c, rate in confirmation_rates(conn, FILENAME, airport):
+            print_c(f"{source or 'unknown source'}: {landing_c} landings, {confirmed_c} confirmed ({rate:.0%})")
+
+    print_query_summary(FILENAME)
+    conn.close()
@@ -19,7 +19,8 @@ br = lambda x, y: min(30, max(7, x/25 + y*0.6))
 brd = lambda x, y: min(200, max(45, x/4 - y/2))
 
 
-def create_zone(coords_plane: tuple, altitude: float, velocity: float, heading: float) -> tuple:
+def create_zone(coords_plane: tuple, altitude: float, velocity: float, heading: float, 
+                descent_rate: float=None, speed_trend: float=None) -> tuple:
     """
 Creates the zone where an airplane could have landed
 
@@ -35,6 +36,12 @@ velocity : float
 heading : float
     heading of the airplane, from 0° to 360°, where 0° is full North, 
     and 90° is full East (clockwise)
+descent_rate : float, optional
+    descent rate of the airplane, in meters/seconds (positive when the
+    airplane goes down), see position_history.py
+speed_trend : float, optional
+    ground speed trend of the airplane, in meters/seconds² (negative 
+    when the airplane slows down), see position_history.py
 
 Returns
 -------
@@ -52,6 +59,13 @@ tuple
     big_radius = br(altitude, velocity)
     big_radius_angle = brd(altitude, velocity)
 
+    # if we know that the airplane goes down, or slows down, it can't go
+    # further than where it reaches the ground, or where it stops
+    if descent_rate is not None and descent_rate > 0:
+        big_radius = max(small_radius, min(big_radius, velocity * (altitude / descent_rate) / 1000))
+    if speed_trend is not None and speed_trend < 0:
+        big_radius = max(small_radius, min(big_radius, (velocity ** 2) / (-2 * speed_trend) / 1000))
+
     # calculate the begin angle and the end angle
     # with the heading at the middle of the big radius angle
     angle1 = heading - (big_radius_angle / 2)
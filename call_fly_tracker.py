@@ -5,8 +5,9 @@ Why this program? Because when multiple programs connect to a single
 database, it can create conflicts. So this program calls the program
 one by one, so the conflict won't happen.
 
-If you want to add a program that needs to be called (a new 
-get_airplanes for instance) you have to write it the CALL_PATH file.
+If you want to add a program that needs to be called, you have to write
+it the CALL_PATH file. The get_airplane programs are polled by 
+ingestion_daemon.py (see ingestion.json).
 """
 
 import time 
@@ -6,8 +6,10 @@ times on different API
 
 import time
 from functions import *
+from schema import AIRPLANE_MIGRATIONS, migrate
 import os
 import json
+from position_history import HistoryStore
 
 # final variable of how many minutes it takes to consider, that an
 # airplane is really disappeared from the radars (in minutes)
@@ -27,208 +29,242 @@ SAVE_FILE = "save_airplane.json"
 print_c = lambda text : print_context(FILENAME, text)
 
 
-print_c("begin of the routine")
+def history_trend(history: HistoryStore, regis: str) -> dict:
+    """
+Returns the descent rate and the ground speed trend of an airplane,
+from its position history
 
-conn = create_connection(DATABASE_PATH)
-query = lambda query_ : query_to_bdd(conn, FILENAME, query_)
+Parameters
+----------
+history : HistoryStore
+    Position history of the airplanes (see position_history.py)
+regis : str
+    Registration of the airplane
 
-wait_unlock_db(query, DATABASE_PATH, FILENAME)
+Returns
+-------
+dict
+    The descent rate (in m/s) and the speed trend (in m/s²), None if
+they aren't known
+    """
+    airplane_history = history.get(regis)
+    if airplane_history is None:
+        return {"descent_rate": None, "speed_trend": None}
 
+    return {"descent_rate": airplane_history.descent_rate(),
+            "speed_trend": airplane_history.speed_trend()}
 
-table_exists = query(f"SELECT count(name) FROM sqlite_master WHERE type = 'table' AND name = 'INVISIBLE_AIRPLANE';").fetchall()
 
-if table_exists[0][0] == 0:
-    # we have the basic parameters of a airplane (registration 
-    # name, coordinate, altitude, speed and heading) qnd three more
-    # aspects : when it was last seen, if it is invisible, and since
-    # when it's invisible
-    query("""
-            CREATE TABLE "INVISIBLE_AIRPLANE" ( 
-                "apRegis" TEXT NOT NULL, 
-                "apLatitude" REAL, 
-                "apLongitude" REAL, 
-                "apAltitude" REAL, 
-                "apTime" INTEGER,
-                "apVelocity" REAL,
-                "apHeading" REAL,
-                "apInvisibleTime" INTEGER,
-                CONSTRAINT unique_direction UNIQUE (apRegis),
-                PRIMARY KEY ("apRegis") );
-        """)
+def register_landings(conn: sqlite3.Connection, landings: list, is_slow: bool, history: HistoryStore) -> list:
+    """
+Registers the airplanes that could have landed in the INVISIBLE_AIRPLANE
+table, if the same flight isn't already registered
 
-# if this program is executed before an get_airplane
-table_exists = query("SELECT count(name) FROM sqlite_master WHERE type = 'table' AND name = 'AIRPLANE';").fetchall()
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the airplane database
+landings : list
+    Last seen row (of the AIRPLANE table) of each airplane that could 
+have landed
+is_slow : bool
+    True if the airplanes are too slow (= on the ground), False if they
+are really invisible
+history : HistoryStore
+    Position history of the airplanes (see position_history.py)
 
-if table_exists[0][0] == 0:
-    print_c("waiting for the AIRPLANE table to be created")
-    exit()
-    
+Returns
+-------
+list
+    The registered airplanes, in the format of the SAVE_FILE
+    """
+    query = lambda query_, parameters=() : execute(conn, FILENAME, query_, parameters)
+    save_data_list = []
+    registered_list = []
+    is_registered = False
+
+    # all airplanes are registered in one transaction
+    with transaction(conn, FILENAME):
+        for last_seen in landings:
+            # the rows of an AIRPLANE table created before the ICAO 
+            # address don't have it
+            icao = last_seen[10] if len(last_seen) > 10 else None
+            is_in_db = query("""
+                                SELECT count(apRegis) 
+                                FROM \"INVISIBLE_AIRPLANE\" 
+                                WHERE apRegis = ?
+                                AND apTime BETWEEN ? AND ?;
+                            """, (last_seen[0], last_seen[4] - DELAY_FLIGHT * 60, last_seen[4] + DELAY_FLIGHT * 60))
+
+            if is_in_db.fetchone()[0] == 0:
+                last_contact = last_seen[3]
+                if is_slow:
+                    last_contact = last_seen[3] if last_seen[3] > 0 else int(time.time())
+                # a row of an older flight of the airplane (that wasn't
+                # archived yet, see retention.py) is replaced, so it can't
+                # roll back the other airplanes
+                query("""
+                        INSERT INTO "INVISIBLE_AIRPLANE"
+                        (apRegis, apLatitude, apLongitude, apAltitude, apTime,
+                        apVelocity, apHeading, apInvisibleTime, apIcao)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ON CONFLICT(apRegis) DO UPDATE SET
+                        apLatitude = excluded.apLatitude,
+                        apLongitude = excluded.apLongitude,
+                        apAltitude = excluded.apAltitude,
+                        apTime = excluded.apTime,
+                        apVelocity = excluded.apVelocity,
+                        apHeading = excluded.apHeading,
+                        apInvisibleTime = excluded.apInvisibleTime,
+                        apIcao = excluded.apIcao;
+                    """, (*last_seen[:3], last_contact, *last_seen[4:7], last_seen[8], icao))
+                registered_list.append((last_seen, icao))
+        is_registered = True
+
+    # the airplanes are only saved if the transaction is committed
+    for last_seen, icao in (registered_list if is_registered else []):
+        save_data_list.append({"regis": last_seen[0], 
+                                "coords": {
+                                    "latitude": last_seen[1], 
+                                    "longitude": last_seen[2]
+                                }, 
+                                "altitude": last_seen[3], 
+                                "time": last_seen[4], 
+                                "velocity": last_seen[5], 
+                                "heading": last_seen[6], 
+                                "source": last_seen[9],
+                                "icao": icao,
+                                **history_trend(history, last_seen[0])
+                            })
+
+    return save_data_list
+
+
+def save_landings(save_data_list: list) -> None:
+    """
+Adds the registered airplanes to the SAVE_FILE
+
+Parameters
+----------
+save_data_list : list
+    The registered airplanes (see register_landings)
+    """
+    try:
+        with open(SAVE_FILE) as file:
+            content = json.loads(file.read())
+        last_id = max([int(x) for x in content.keys()])
+        last_id += 1
+    except (FileNotFoundError, json.decoder.JSONDecodeError, ValueError):
+        content = {}
+        last_id = 0
+        
+    new_content = {str(last_id + i): item for i, item in enumerate(save_data_list)}
+
+    new_content = content | new_content
+
+    with open(SAVE_FILE, "w+") as file:
+        file.write(json.dumps(new_content, indent=2))
 
 
-source_list = query("SELECT DISTINCT apSource FROM \"AIRPLANE\" WHERE 1;").fetchall()
-source_list = [item[0] for item in source_list]
+if __name__ == "__main__":
+    print_c("begin of the routine")
 
-# if the airplane hasn't given a signal after DELAY_INVISIBLE minutes,
-# it will registered as invisible
-airplanes = query("SELECT apRegis, apTime, apSource FROM \"AIRPLANE\" WHERE apInvisible = '0';")
-for airplane in airplanes:
-    delta_time = int(time.time()) - airplane[1]
-    if delta_time > int(DELAY_INVISIBLE * 60):
-        wait_unlock_db(query, DATABASE_PATH, FILENAME)
-        query(f"""
+    conn = create_connection(DATABASE_PATH)
+    query = lambda query_, parameters=() : execute(conn, FILENAME, query_, parameters)
+
+    # if this program is executed before an get_airplane, the tables are
+    # created (empty)
+    migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+
+    save_data_list = []
+    # the last fixes of the airplanes, written by the ingestion
+    history = HistoryStore.load()
+    is_checked = False
+
+    # all the checks are made in one transaction, so they are written at
+    # once, and never partially
+    with transaction(conn, FILENAME, immediate=True):
+        now = int(time.time())
+
+        # if the airplane hasn't given a signal after DELAY_INVISIBLE minutes,
+        # it will registered as invisible
+        query("""
                 UPDATE "AIRPLANE"
-                SET apInvisible = '1',
-                apInvisibleTime = '{int(time.time())}'
-                WHERE apRegis = '{airplane[0]}'
-                AND apSource = '{airplane[2]}';
-            """)
-
-save_data_list = []
-
-print_c("adding new airplanes")
-# add the airplane if it is really invisible in the INVISIBLE_AIRPLANE table
-airplanes = query("SELECT DISTINCT apRegis FROM \"AIRPLANE\" WHERE 1;").fetchall()
-for airplane in airplanes:
-    wait_unlock_db(query, DATABASE_PATH, FILENAME)
-    airplane_name = airplane[0]
-    # for a registration name, we see the different invisible status
-    same_airplane = query(f"SELECT DISTINCT apInvisible FROM \"AIRPLANE\" WHERE apRegis = '{airplane_name}';")
-    if same_airplane:
-        same_airplane = [item[0] for item in same_airplane]
-        if 0 in same_airplane:
-            # 0 = still tracking, so there is at least one tracking service that
-            # still detects the airplane.
-            # with those deletion, we keep the only sources that can still track
-            query(f"""
-                    DELETE FROM \"AIRPLANE\"
-                    WHERE apRegis = '{airplane_name}'
-                    AND apInvisible = '1';
-                """)
-        else:
-            # None of the tracking services can track this airplane, so it is
-            # really invisible
-            last_seen = query(f"""
-                                SELECT * FROM "AIRPLANE"
-                                WHERE apTime = (
-                                    SELECT MAX(apTime) FROM "AIRPLANE"
-                                    WHERE apRegis = '{airplane_name}'
-                                );
-                            """)
-            last_seen = last_seen.fetchone()
-            if not isinstance(last_seen, type(None)):
-                is_in_db = query(f"""
-                                    SELECT count(apRegis) 
-                                    FROM \"INVISIBLE_AIRPLANE\" 
-                                    WHERE apRegis = '{last_seen[0]}'
-                                    AND apTime BETWEEN '{last_seen[4] - DELAY_FLIGHT * 60}'
-                                                    AND '{last_seen[4] + DELAY_FLIGHT * 60}';
-                                """)
-                is_in_db = is_in_db.fetchall() if is_in_db else [[0]]
-
-                if is_in_db[0][0] == 0:
-                    query(f"""
-                            INSERT INTO "INVISIBLE_AIRPLANE"
-                            VALUES ('{last_seen[0]}', '{last_seen[1]}', 
-                            '{last_seen[2]}', '{last_seen[3]}', '{last_seen[4]}', 
-                            '{last_seen[5]}', '{last_seen[6]}', '{last_seen[8]}')
-                        """)
-                    save_data_list.append({"regis": last_seen[0], 
-                                            "coords": {
-                                                "latitude": last_seen[1], 
-                                                "longitude": last_seen[2]
-                                            }, 
-                                            "altitude": last_seen[3], 
-                                            "time": last_seen[4], 
-                                            "velocity": last_seen[5], 
-                                            "heading": last_seen[6], 
-                                            "source": last_seen[9]
-                                        })
-
-                query(f"""
+                SET apInvisible = 1,
+                apInvisibleTime = ?
+                WHERE apInvisible = 0
+                AND apTime < ?;
+            """, (now, now - DELAY_INVISIBLE * 60))
+
+        print_c("adding new airplanes")
+        # add the airplane if it is really invisible in the INVISIBLE_AIRPLANE table
+        airplanes = query("SELECT DISTINCT apRegis FROM \"AIRPLANE\";").fetchall()
+        for airplane in airplanes:
+            airplane_name = airplane[0]
+            # for a registration name, we see the different invisible status
+            same_airplane = query("SELECT DISTINCT apInvisible FROM \"AIRPLANE\" WHERE apRegis = ?;", (airplane_name,))
+            same_airplane = [item[0] for item in same_airplane]
+            if 0 in same_airplane:
+                # 0 = still tracking, so there is at least one tracking service that
+                # still detects the airplane.
+                # with those deletion, we keep the only sources that can still track
+                query("""
                         DELETE FROM \"AIRPLANE\"
-                        WHERE apRegis = '{last_seen[0]}';
-                    """)
-
-# add airplanes that are too slow (= on the ground)
-airplanes = query(f"SELECT DISTINCT apRegis FROM \"AIRPLANE\" WHERE apVelocity < '{MIN_VELOCITY}';").fetchall()
-for airplane in airplanes:
-    wait_unlock_db(query, DATABASE_PATH, FILENAME)
-    airplane = airplane[0]
-    same_airplanes_speed = query(f"SELECT apVelocity FROM \"AIRPLANE\" WHERE apRegis = '{airplane}';").fetchall()
-    
-    is_slow = all([speed[0] < MIN_VELOCITY for speed in same_airplanes_speed])
-    
-    if is_slow:
-        last_seen = query(f"""
-                            SELECT * FROM "AIRPLANE"
-                            WHERE apTime = (
-                                SELECT MAX(apTime) FROM "AIRPLANE"
-                                WHERE apRegis = '{airplane}'
-                            );
-                        """)
-        last_seen = last_seen.fetchone()
-        if not isinstance(last_seen, type(None)):
-            is_in_db = query(f"""
-                                SELECT count(apRegis) 
-                                FROM \"INVISIBLE_AIRPLANE\" 
-                                WHERE apRegis = '{last_seen[0]}'
-                                AND apTime BETWEEN '{last_seen[4] - DELAY_FLIGHT * 60}'
-                                                AND '{last_seen[4] + DELAY_FLIGHT * 60}';
-                            """)
-            is_in_db = is_in_db.fetchall() if not isinstance(is_in_db, type(None)) else [[0]]
-
-            if is_in_db[0][0] == 0:
-                last_contact = last_seen[3] if last_seen[3] > 0 else int(time.time())
-                query(f"""
-                        INSERT INTO "INVISIBLE_AIRPLANE"
-                        VALUES ('{last_seen[0]}', '{last_seen[1]}', 
-                        '{last_seen[2]}', '{last_contact}', '{last_seen[4]}', 
-                        '{last_seen[5]}', '{last_seen[6]}', '{last_seen[8]}')
-                    """)
-                save_data_list.append({"regis": last_seen[0], 
-                                        "coords": {
-                                            "latitude": last_seen[1], 
-                                            "longitude": last_seen[2]
-                                        }, 
-                                        "altitude": last_seen[3], 
-                                        "time": last_seen[4], 
-                                        "velocity": last_seen[5], 
-                                        "heading": last_seen[6], 
-                                        "source": last_seen[9]
-                                        })
-
-            query(f"""
-                    DELETE FROM \"AIRPLANE\"
-                    WHERE apRegis = '{last_seen[0]}';
-                """)
-
-# delete invisible airplanes that are too old 
-airplanes = query("SELECT apRegis, apInvisibleTime FROM \"AIRPLANE\" WHERE apInvisible = '1';")
-for airplane in airplanes:
-    airplane_name, airplane_time = airplane
-    if int(time.time()) > (airplane_time + DELAY_DELETE * 60):
-        query(f"""
-                DELETE FROM "AIRPLANE"
-                WHERE apRegis = '{airplane_name}';
-            """)
+                        WHERE apRegis = ?
+                        AND apInvisible = 1;
+                    """, (airplane_name,))
+            else:
+                # None of the tracking services can track this airplane, so it is
+                # really invisible
+                last_seen = query("""
+                                    SELECT * FROM "AIRPLANE"
+                                    WHERE apRegis = ?
+                                    ORDER BY apTime DESC
+                                    LIMIT 1;
+                                """, (airplane_name,))
+                last_seen = last_seen.fetchone()
+                if last_seen is not None:
+                    save_data_list += register_landings(conn, [last_seen], False, history)
 
-conn.close()
+                    query("DELETE FROM \"AIRPLANE\" WHERE apRegis = ?;", (last_seen[0],))
 
-try:
-    with open(SAVE_FILE) as file:
-        content = json.loads(file.read())
-    last_id = max([int(x) for x in content.keys()])
-    last_id += 1
-except (FileNotFoundError, json.decoder.JSONDecodeError):
-    file = open(SAVE_FILE, "w+")
-    content = {}
-    last_id = 0
-    
-new_content = {str(last_id + i): item for i, item in enumerate(save_data_list)}
+        # add airplanes that are too slow (= on the ground)
+        # (without DISTINCT, so the index of the velocity is used)
+        airplanes = query("SELECT apRegis FROM \"AIRPLANE\" WHERE apVelocity < ?;", (MIN_VELOCITY,)).fetchall()
+        for airplane in dict.fromkeys(item[0] for item in airplanes):
+            same_airplanes_speed = query("SELECT apVelocity FROM \"AIRPLANE\" WHERE apRegis = ?;", (airplane,)).fetchall()
+            
+            is_slow = all([speed[0] < MIN_VELOCITY for speed in same_airplanes_speed])
+            
+            if is_slow:
+                last_seen = query("""
+                                    SELECT * FROM "AIRPLANE"
+                                    WHERE apRegis = ?
+                                    ORDER BY apTime DESC
+                                    LIMIT 1;
+                                """, (airplane,))
+                last_seen = last_seen.fetchone()
+                if last_seen is not None:
+                    save_data_list += register_landings(conn, [last_seen], True, history)
+
+                    query("DELETE FROM \"AIRPLANE\" WHERE apRegis = ?;", (last_seen[0],))
+
+        # delete invisible airplanes that are too old 
+        query("""
+                DELETE FROM "AIRPLANE"
+                WHERE apRegis IN (
+                    SELECT apRegis FROM "AIRPLANE"
+                    WHERE apInvisible = 1
+                    AND apInvisibleTime < ?
+                );
+            """, (now - DELAY_DELETE * 60,))
+        is_checked = True
 
-new_content = content | new_content
+    conn.close()
 
-with open(SAVE_FILE, "w+") as file:
-    file.write(json.dumps(new_content, indent=2))
+    # the airplanes are only saved if the transaction is committed
+    if is_checked:
+        save_landings(save_data_list)
 
-print_c("end of the routine")
+    print_query_summary(FILENAME)
+    print_c("end of the routine")
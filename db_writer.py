@@ -0,0 +1,269 @@
+"""
+This program is the only writer of a database: the other programs send
+it their writes (a batch of queries, each one with a list of
+parameters) on a local socket, instead of waiting for the lock of the
+database.
+The batches received in GROUP_TIME seconds (or until GROUP_SIZE rows)
+are written in one transaction, so there is only one commit (one write
+on the disk) for all of them, and the more programs write at the same
+time, the bigger the groups are. Each batch is written in its own
+savepoint, so a batch that fails doesn't cancel the others, and a
+program only gets the answer to its batch once it is committed.
+With: python3 db_writer.py <database>, the writer of the database
+listens on the socket <database>.writer (that only the user of the
+writer can open). Without writer, the function write writes the batch
+directly in the database.
+Only the batches that don't depend on what is read in their transaction
+go through the writer (the snapshots of ingestion_daemon.py, the new
+evidences of etdex_ponderation.py, the sent flags of send_db.py, ...).
+The transactions that read the database then write what they read
+(the treatment of the evidences of etdex_ponderation.py, the checks of
+check_airplanes.py) still write directly, and wait for the lock of the
+database like before.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+from functions import *
+from schema import MIGRATIONS, migrate
+
+FILENAME = os.path.basename(__file__)
+# maximum time to wait for other batches, before the commit of a group
+# (in seconds)
+GROUP_TIME = 0.05
+# a group is committed at once if it has more rows than that
+GROUP_SIZE = 5000
+# time between two prints of the statistics of the writer (in seconds)
+STATS_TIME = 60
+
+print_c = lambda text : print_context(FILENAME, text)
+
+# connection of each thread of this program to the writer of each
+# database, by (database, thread)
+CLIENTS = {}
+
+
+def writer_address(database: str) -> str:
+    """
+Returns the path of the socket of the writer of a database
+    """
+    return f"{database}.writer"
+
+
+def send_batch(database: str, statements: list) -> tuple: #|None
+    """
+Sends a batch to the writer of a database, and waits until it is
+committed
+
+Parameters
+----------
+database : str
+    Path to the database
+statements : list
+    Queries of the batch, each one with its list of parameters
+
+Returns
+-------
+tuple or None
+    True and None if the batch is committed, or False and the error, or
+None if the writer doesn't run
+    """
+    key = (database, threading.get_ident())
+    client = CLIENTS.get(key)
+    if client is None:
+        try:
+            client = CLIENTS[key] = Client(writer_address(database), "AF_UNIX")
+        except OSError:
+            return None
+
+    try:
+        client.send(statements)
+        return client.recv()
+    except (OSError, EOFError) as e:
+        # the batch could have been committed, so it isn't written a
+        # second time
+        CLIENTS.pop(key).close()
+        return (False, f"the connection to the writer was lost ({e})")
+
+
+def write(database: str, conn: sqlite3.Connection, file: str, statements: list) -> bool:
+    """
+Writes a batch with the writer of the database (see send_batch), or
+directly with conn, in one transaction, if the writer doesn't run
+
+Parameters
+----------
+database : str
+    Path to the database
+conn : sqlite3.Connection
+    Connection to the database, used without writer
+file : str
+    File which makes the queries
+statements : list
+    Queries of the batch, each one with its list of parameters
+
+Returns
+-------
+bool
+    True if the batch is committed
+    """
+    statements = [(query_, list(parameters_list)) for query_, parameters_list in statements]
+    result = send_batch(database, statements)
+    if result is None:
+        is_written = False
+        with transaction(conn, file):
+            for query_, parameters_list in statements:
+                executemany(conn, file, query_, parameters_list)
+            is_written = True
+        return is_written
+
+    if not result[0]:
+        print_context(file, f"Error: '{result[1]}'", True)
+    return result[0]
+
+
+class DatabaseWriter:
+    """
+Receives the batches of all programs, and writes them by groups
+    """
+    def __init__(self, database: str):
+        self.database = database
+        # (statements, client connection) of the received batches
+        self.batches = queue.Queue()
+        self.group_c, self.batch_c, self.row_c = 0, 0, 0
+
+    def receive(self, client) -> None:
+        """
+Receives the batches of a program, until it closes the connection
+        """
+        try:
+            while True:
+                self.batches.put((client.recv(), client))
+        except (OSError, EOFError):
+            client.close()
+
+    def listen(self, listener: Listener) -> None:
+        """
+Accepts the connections of the programs
+        """
+        while True:
+            try:
+                client = listener.accept()
+            except OSError as e:
+                print_context(FILENAME, f"Error: '{e}'", True)
+                continue
+            threading.Thread(target=self.receive, args=(client,), daemon=True).start()
+
+    def next_group(self) -> list:
+        """
+Waits for a batch, and the batches received in the next GROUP_TIME
+seconds (at most GROUP_SIZE rows)
+        """
+        group = [self.batches.get()]
+        row_c = sum(len(parameters_list) for _, parameters_list in group[0][0])
+        end_time = time.monotonic() + GROUP_TIME
+        while row_c < GROUP_SIZE:
+            try:
+                batch = self.batches.get(timeout=max(0, end_time - time.monotonic()))
+            except queue.Empty:
+                break
+            group.append(batch)
+            row_c += sum(len(parameters_list) for _, parameters_list in batch[0])
+
+        self.row_c += row_c
+        return group
+
+    def commit(self, conn: sqlite3.Connection, group: list) -> list:
+        """
+Writes a group of batches in one transaction, each batch in its own
+savepoint
+
+Returns
+-------
+list
+    The result of each batch (see send_batch)
+        """
+        results = []
+        try:
+            begin_immediate(conn, FILENAME)
+            for statements, _ in group:
+                conn.execute("SAVEPOINT batch;")
+                try:
+                    for query_, parameters_list in statements:
+                        timed_statement(FILENAME, query_, conn.executemany, parameters_list)
+                    results.append((True, None))
+                except (*Error, ValueError) as e:
+                    conn.execute("ROLLBACK TO batch;")
+                    results.append((False, str(e)))
+                conn.execute("RELEASE batch;")
+            timed_commit(conn, FILENAME)
+        except Error as e:
+            if conn.in_transaction:
+                conn.rollback()
+            print_context(FILENAME, f"Error: '{e}'", True)
+            results = [(False, str(e))] * len(group)
+
+        return results
+
+    def serve(self) -> None:
+        """
+Writes the received batches forever
+        """
+        conn = create_connection(self.database, False)
+        # a batch is only acknowledged when it is on the disk
+        STORAGE.set_durable(conn)
+        migrate(conn, FILENAME, MIGRATIONS.get(self.database, []))
+
+        address = writer_address(self.database)
+        try:
+            Client(address, "AF_UNIX").close()
+            print_c(f"ERROR: a writer of {self.database} already runs")
+            return
+        except OSError:
+            # the socket of a writer that stopped
+            if os.path.exists(address):
+                os.remove(address)
+
+        # the batches are unpickled, so only the programs of the same user
+        # can connect: the socket is created without any permission for
+        # the others (a chmod after its creation would leave a window)
+        umask = os.umask(0o177)
+        try:
+            listener = Listener(address, "AF_UNIX")
+        finally:
+            os.umask(umask)
+        threading.Thread(target=self.listen, args=(listener,), daemon=True).start()
+        print_c(f"writer of {self.database} listening on {address}")
+
+        stats_time = time.monotonic() + STATS_TIME
+        try:
+            while True:
+                group = self.next_group()
+                for (_, client), result in zip(group, self.commit(conn, group)):
+                    try:
+                        client.send(result)
+                    except OSError:
+                        pass
+                self.group_c += 1
+                self.batch_c += len(group)
+
+                if time.monotonic() > stats_time:
+                    print_c(f"groups: {self.group_c}, batches: {self.batch_c}, rows: {self.row_c}")
+                    print_query_summary(FILENAME)
+                    self.group_c, self.batch_c, self.row_c = 0, 0, 0
+                    stats_time = time.monotonic() + STATS_TIME
+        finally:
+            listener.close()
+            conn.close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print_c("usage: python3 db_writer.py <database>")
+        exit()
+
+    DatabaseWriter(sys.argv[1]).serve()
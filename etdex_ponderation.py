@@ -3,15 +3,16 @@ This program calculate the probabilty of a landing, with different
 sources
 """
 
-import jellyfish
 import json
 import time
 import os
 import requests
 from math import isclose
-from geopy import distance
 from os.path import exists
 from functions import *
+from schema import LANDING_MIGRATIONS, migrate
+from db_writer import write
+from spatial import haversine, regis_similarity
 from datetime import datetime
 
 
@@ -22,6 +23,11 @@ time.tzset()
 LANDING_TIME                = 15                            # in minutes
 LANDING_DITANCE             = 2                             # in km
 CORRELATION_APPROVAL_PROB   = 0.5                           # probability
+# further than that, two evidences can't refer to the same landing
+# (prob_same_landing is under CORRELATION_APPROVAL_PROB, even for the 
+# same airplane at the same place, or at the same time)
+CORRELATION_TIME            = 45                            # in minutes
+CORRELATION_DISTANCE        = 4                             # in km
 LANDING_APPROVAL_PROB       = 0.75                          # probability
 PPR_DELTA_TIME              = 3                             # in hour
 AFTN_DELTA_TIME             = 20                            # in minutes
@@ -93,7 +99,8 @@ Parameters
 evidence1 : tuple
     One of the evidence to be compared to the other, to see if there 
 is a correlation between the two. The form of this tuple is (index, 
-airport, probability, source, source2, time)
+airport, registration, probability, source, source2, time, latitude, 
+longitude, icao)
 evidence2 : tuple
     The other evidence, with the same form as the first evidence
 
@@ -108,9 +115,13 @@ float
     time_probability = 0
     distance_probability = 0
 
-    # first we calculate if the name could be the same
-    diff_letter = jellyfish.hamming_distance(ev1[2], ev2[2])
-    id_probability = 1 - (diff_letter / len(ev1[2])) * 1.5
+    # first we calculate if the name could be the same, the ICAO address
+    # identifies the airplane exactly, so the names are only compared if
+    # one of the evidences doesn't have it
+    if ev1[9] is not None and ev2[9] is not None:
+        id_probability = 1 if ev1[9] == ev2[9] else 0
+    else:
+        id_probability = regis_similarity(ev1[2], ev2[2])
 
     # then if its in the same time span
     delta_time = ev1[6] - ev2[6]
@@ -120,15 +131,14 @@ float
 
     time_probability = prob_calc(LANDING_TIME, delta_time)
 
-    # finally if it's in the same zone
-    if (not isinstance(ev1[7], type(None)) or ev1[7] != 0) \
-            and (not isinstance(ev1[8], type(None)) or ev1[8] != 0) \
-            and (not isinstance(ev2[7], type(None)) or ev2[7] != 0) \
-            and (not isinstance(ev2[8], type(None)) or ev2[8] != 0):
+    # finally if it's in the same zone (haversine is None if one of the
+    # evidences doesn't have a position)
+    evidence_distance = haversine(ev1[7], ev1[8], ev2[7], ev2[8])
+    if evidence_distance is not None:
 
         prob_calc = lambda ld, ds : (ld/ds) - (ds/ld) + (ds/1)/ds
 
-        evidence_distance = distance.distance((ev1[7], ev1[8]), (ev2[7], ev2[8])).km + 0.1
+        evidence_distance = evidence_distance + 0.1
         distance_probability = min(1, prob_calc(LANDING_DITANCE, evidence_distance))
     else:
         distance_probability = max(0, (id_probability + time_probability) / 2)
@@ -165,12 +175,15 @@ float
     return prob
 
 
-def evidence_probability(evidences: list) -> list:
+def evidence_probability(conn: sqlite3.Connection, evidences: list) -> list:
     """
 Gives a list of all possible landings
 
 Parameters
 ----------
+conn : sqlite3.Connection
+    Connection to the database, to find the evidences near an evidence
+(see nearby_evidences)
 evidences : list
     List of all evidences, that points to the same airport
 
@@ -187,7 +200,19 @@ it was, and i's probability)
             evidence_correlation[evidence1] = []
             verified_evidences.append(evidence1)
 
-            for evidence2 in evidences:
+            # only the evidences near this one can refer to the same 
+            # landing (the evidences without position are always
+            # compared)
+            nearby = [evidence2 for evidence2 in evidences if evidence2[7] is None or evidence2[8] is None]
+            if evidence1[7] is None or evidence1[8] is None:
+                nearby = evidences
+            else:
+                nearby_id = {evidence2[0] for evidence2 in nearby_evidences(conn, FILENAME, evidence1[7], evidence1[8],
+                                                                             evidence1[6], CORRELATION_DISTANCE,
+                                                                             CORRELATION_TIME, evidence1[1])}
+                nearby = [evidence2 for evidence2 in evidences if evidence2[0] in nearby_id or evidence2 in nearby]
+
+            for evidence2 in nearby:
                 if evidence1[0] != evidence2[0] and evidence2 not in verified_evidences:
 
                     # here we will see if the two evidence could refer
@@ -225,7 +250,8 @@ it was, and i's probability)
             evidence_prob.append({"airport": evidence1[1], 
                                     "regis": evidence1[2],
                                     "time": max_time,
-                                    "prob": probability})
+                                    "prob": probability,
+                                    "source": evidence1[4]})
 
     return evidence_prob
 
@@ -307,41 +333,20 @@ while True:
         aftn_data = {"been_read": True}
 
     conn = create_connection(DATABASE_PATH)
-    query = lambda query_ : query_to_bdd(conn, FILENAME, query_)
+    query = lambda query_, parameters=() : execute(conn, FILENAME, query_, parameters)
     
-    # check if the table UNTREATED_TABLE exists
-    table_exists = query("SELECT count(name) FROM sqlite_master WHERE type = 'table' AND name = 'UNTREATED_DATA';").fetchall()
-    table_exists = table_exists[0][0]
-
-    # if the count is equal to 0, we create both tables
-    if table_exists == 0:
-        print_c("creating database table")
-        query("""
-                CREATE TABLE "UNTREATED_DATA" ( 
-                    "udId" INTEGER NOT NULL,
-                    "udAirport" TEXT NOT NULL, 
-                    "udRegis" TEXT, 
-                    "udProbability" REAL, 
-                    "udSource" TEXT, 
-                    "udSource2" TEXT,
-                    "udTime" INTEGER, 
-                    "udLatitude" REAL,
-                    "udLongitude" REAL,
-                    PRIMARY KEY("udId" AUTOINCREMENT) 
-                );
-                """)
-        query("""
-                CREATE TABLE "TREATED_DATA" (
-                    "tdId" INTEGER NOT NULL,
-                    "tdAirport" TEXT NOT NULL,
-                    "tdAirplane" TEXT,
-                    "tdTime" INTEGER,
-                    "tdProb" REAL,
-                    "tdSent" INTEGER,
-                    CONSTRAINT unique_combinaison UNIQUE (tdAirport, tdAirplane),
-                    PRIMARY KEY("tdId" AUTOINCREMENT)
-                );
-                """)
+    # creates the tables if they don't exist, or upgrades them
+    migrate(conn, FILENAME, LANDING_MIGRATIONS)
+
+    # a landing is only written once in TREATED_DATA by airport and 
+    # airplane (see unique_combinaison), the other ones are ignored. The
+    # source is the one that decided the landing (for the aggregates, 
+    # see aggregates.py)
+    insert_treated = """
+                        INSERT OR IGNORE INTO "TREATED_DATA"
+                        (tdAirport, tdAirplane, tdTime, tdProb, tdSent, tdSource)
+                        VALUES (?, ?, ?, ?, 0, ?);
+                    """
 
     # add all airplanes coming from airTracker
     print_c("Adding new airplanes...")
@@ -349,6 +354,7 @@ while True:
         with open(POSSIBLE_LANDINGS_ADSB_FILE, "w+") as file:
             file.write(json.dumps({"been_read": True, "data": tracking}))
         
+        untreated_list = []
         for tracked_airplane in tracking:
             # the probability is calculated, that it will always be more than 
             # min_prob, and the more weight_prob is high, the more the final
@@ -367,21 +373,26 @@ while True:
 
             for possible_airport in tracking[tracked_airplane]["airport"]:
                 if tracked_airplane_probability > LANDING_APPROVAL_PROB:
-                    query(f"""
-                                INSERT INTO "UNTREATED_DATA"
-                                (udAirport, udRegis, udProbability, udSource, udTime, udLatitude, udLongitude)
-                                VALUES ('{possible_airport["regis"]}', '{tracked_airplane}',
-                                '{tracked_airplane_probability}', 'airTracker', 
-                                '{tracked_airplane_time}', 
-                                '{tracking[tracked_airplane]["coords"]["latitude"]}',
-                                '{tracking[tracked_airplane]["coords"]["longitude"]}');
-                            """)
+                    untreated_list.append((possible_airport["regis"], tracked_airplane,
+                                           tracked_airplane_probability, "airTracker",
+                                           tracked_airplane_time,
+                                           tracking[tracked_airplane]["coords"]["latitude"],
+                                           tracking[tracked_airplane]["coords"]["longitude"],
+                                           tracking[tracked_airplane].get("icao")))
+
+        # all airplanes are written at once (by the writer of the 
+        # database, if it runs)
+        write(DATABASE_PATH, conn, FILENAME, [("""
+                        INSERT INTO "UNTREATED_DATA"
+                        (udAirport, udRegis, udProbability, udSource, udTime, udLatitude, udLongitude, udIcao)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?);
+                    """, untreated_list)])
 
     # here are all the PPRs going to be checked, and if one has the same 
     # destination airport and same airplane. If one same landing has be 
     # found, the landing will have a 100% of probability
     print_c("Adding and treating the PPR...")
-    number_ppr = query("SELECT COUNT(udId) FROM \"UNTREATED_DATA\" WHERE udSource = \"PPR\";").fetchone()[0]
+    number_ppr = query("SELECT COUNT(udId) FROM \"UNTREATED_DATA\" WHERE udSource = ?;", ("PPR",)).fetchone()[0]
     if not ppr_been_read or number_ppr > 0:
         with open(PPR_FILE, "w+") as file:
             file.write(json.dumps({"been_read": True, "new_ppr": all_ppr}))
@@ -396,155 +407,146 @@ while True:
         else:
             max_id = max(max_id)
 
-        # we add the ppr that are already in the database
-        ppr_in_db = query("""
-                                SELECT * 
-                                FROM "UNTREATED_DATA"
-                                WHERE udSource = "PPR";
-                            """).fetchall()
-        older_ppr = {}
-        for index, item in enumerate(ppr_in_db):
-            older_ppr[str(max_id + index + 1)] = {
-                "airport": item[1],
-                "arrivingFrom": item[1],
-                "departingTo": item[1],
-                "licenseNumber": item[2],
-                "arrival": datetime.utcfromtimestamp(int(item[6])).strftime("%a, %d %b %Y %H:%M:%S UTC"),
-                "departure": datetime.utcfromtimestamp(int(item[6])).strftime("%a, %d %b %Y %H:%M:%S UTC")
-            }
-
-        all_ppr = older_ppr | all_ppr
-
-        for ppr_id in all_ppr:
-            departing_airport = all_ppr[ppr_id]["departingTo"]
-            present_airport = all_ppr[ppr_id]["airport"]
-            airplane = all_ppr[ppr_id]["licenseNumber"]
-
-            departure_time = all_ppr[ppr_id]["departure"]
-            if "," in departure_time:
-                departure_time = datetime.strptime(departure_time, "%a, %d %b %Y %H:%M:%S %Z")
-            elif departure_time != "":
-                departure_time = datetime.strptime(departure_time, "%a %b %d %Y %H:%M:%S %Z%z")
-            departure_time = int(time.mktime(departure_time.timetuple()))
-            
-            arrival_time = all_ppr[ppr_id]["arrival"]
-            if "," in arrival_time:
-                arrival_time = datetime.strptime(arrival_time, "%a, %d %b %Y %H:%M:%S %Z")
-            elif arrival_time != "":
-                arrival_time = datetime.strptime(arrival_time, "%a %b %d %Y %H:%M:%S %Z%z")
-            else:
-                continue
-            arrival_time = int(time.mktime(arrival_time.timetuple()))
-
-            # searching for all landings, that could have been at the present
-            # or the destination airport from the PPR
-            landings = query(f"""
-                                SELECT udId, udTime, udAirport, udSource 
-                                FROM \"UNTREATED_DATA\" 
-                                WHERE (udAirport = '{departing_airport}'
-                                OR udAirport = '{present_airport}')
-                                AND udRegis = '{airplane}'
-                                AND udSource != 'PPR';
-                            """)
-            landings = landings.fetchall()
-
-            added = False
-            for landing_data in landings:
-                same_landing_departing = False
-                same_landing_present = False
+        with transaction(conn, FILENAME):
+            # we add the ppr that are already in the database
+            ppr_in_db = query("""
+                                    SELECT * 
+                                    FROM "UNTREATED_DATA"
+                                    WHERE udSource = ?;
+                                """, ("PPR",)).fetchall()
+            older_ppr = {}
+            for index, item in enumerate(ppr_in_db):
+                older_ppr[str(max_id + index + 1)] = {
+                    "airport": item[1],
+                    "arrivingFrom": item[1],
+                    "departingTo": item[1],
+                    "licenseNumber": item[2],
+                    "arrival": datetime.utcfromtimestamp(int(item[6])).strftime("%a, %d %b %Y %H:%M:%S UTC"),
+                    "departure": datetime.utcfromtimestamp(int(item[6])).strftime("%a, %d %b %Y %H:%M:%S UTC")
+                }
+
+            all_ppr = older_ppr | all_ppr
+
+            for ppr_id in all_ppr:
+                departing_airport = all_ppr[ppr_id]["departingTo"]
+                present_airport = all_ppr[ppr_id]["airport"]
+                airplane = all_ppr[ppr_id]["licenseNumber"]
+
+                departure_time = all_ppr[ppr_id]["departure"]
+                if "," in departure_time:
+                    departure_time = datetime.strptime(departure_time, "%a, %d %b %Y %H:%M:%S %Z")
+                elif departure_time != "":
+                    departure_time = datetime.strptime(departure_time, "%a %b %d %Y %H:%M:%S %Z%z")
+                departure_time = int(time.mktime(departure_time.timetuple()))
                 
+                arrival_time = all_ppr[ppr_id]["arrival"]
+                if "," in arrival_time:
+                    arrival_time = datetime.strptime(arrival_time, "%a, %d %b %Y %H:%M:%S %Z")
+                elif arrival_time != "":
+                    arrival_time = datetime.strptime(arrival_time, "%a %b %d %Y %H:%M:%S %Z%z")
+                else:
+                    continue
+                arrival_time = int(time.mktime(arrival_time.timetuple()))
+
+                # searching for all landings, that could have been at the present
+                # or the destination airport from the PPR
+                landings = query("""
+                                    SELECT udId, udTime, udAirport, udSource 
+                                    FROM \"UNTREATED_DATA\" 
+                                    WHERE (udAirport = ?
+                                    OR udAirport = ?)
+                                    AND udRegis = ?
+                                    AND udSource != ?;
+                                """, (departing_airport, present_airport, airplane, "PPR"))
+                landings = landings.fetchall()
 
-                # first check if the ppr is usable for its destination
-                if landing_data[2] == departing_airport:
-                    time_limit = PPR_DELTA_TIME * 60 * 60
-                    if landing_data[1] > departure_time and \
-                            landing_data[1] < departure_time + time_limit:
-                        query(f"""
-                                INSERT INTO "TREATED_DATA"
-                                (tdAirport, tdAirplane, tdTime, tdProb, tdSent)
-                                VALUES ('{departing_airport}', '{airplane}', 
-                                '{landing_data[1]}', '1', '0');
-                            """)
-                        query(f"""
-                                DELETE FROM "UNTREATED_DATA"
-                                WHERE udAirport = '{departing_airport}'
-                                AND udRegis = '{airplane}';
-                            """)
-                        added = True
-
-                # then check if the ppr is usable for its present airport
-                if landing_data[2] == present_airport:
-                    time_limit = PPR_DELTA_TIME * 60 * 60
-                    min_time = arrival_time - (time_limit / 2)
-                    max_time = arrival_time + (time_limit / 2)
+                added = False
+                for landing_data in landings:
+                    same_landing_departing = False
+                    same_landing_present = False
                     
-                    if landing_data[1] > min_time \
-                            and landing_data[1] < max_time:
-                        query(f"""
-                                INSERT INTO "TREATED_DATA"
-                                (tdAirport, tdAirplane, tdTime, tdProb, tdSent)
-                                VALUES ('{present_airport}', '{airplane}',
-                                '{landing_data[1]}', '1', '0');
-                            """)
-                        query(f"""
-                                DELETE FROM "UNTREATED_DATA"
-                                WHERE udAirport = '{present_airport}'
-                                AND udRegis = '{airplane}';
-                            """)                        
-                        added = True
-
-            if not added and int(ppr_id) <= max_id:
-                response = requests.get("https://avdb.aerops.com/public/airports", 
-                                auth=(user_avdb, password_avdb))
-                data = json.loads(response.text)["data"]
-
-                if present_airport in all_airports_name and arrival_time > 0:
-                    coords = [(x["latitude"], x["longitude"]) for x in data if x["name"] == present_airport]
-                    coords = coords[0] if len(coords) > 0 else (None, None)
-
-                    query(f"""
-                            INSERT INTO "UNTREATED_DATA"
-                            (udAirport, udRegis, udTime, udProbability, udSource, udLatitude, udLongitude)
-                            VALUES ('{present_airport}', '{airplane}', 
-                            '{arrival_time}', '1', 'PPR', '{coords[0]}', '{coords[1]}');
-                        """)
-                if departing_airport in all_airports_name and departure_time > 0:
-                    coords = [(x["latitude"], x["longitude"]) for x in data if x["name"] == departing_airport]
-                    coords = coords[0] if len(coords) > 0 else (None, None)
-
-                    query(f"""
-                            INSERT INTO "UNTREATED_DATA"
-                            (udAirport, udRegis, udTime, udProbability, udSource, udLatitude, udLongitude)
-                            VALUES ('{departing_airport}', '{airplane}', 
-                            '{departure_time}', '1', 'PPR', '{coords[0]}', '{coords[1]}');
-                        """)
+
+                    # first check if the ppr is usable for its destination
+                    if landing_data[2] == departing_airport:
+                        time_limit = PPR_DELTA_TIME * 60 * 60
+                        if landing_data[1] > departure_time and \
+                                landing_data[1] < departure_time + time_limit:
+                            query(insert_treated, (departing_airport, airplane, landing_data[1], 1, "PPR"))
+                            query("""
+                                    DELETE FROM "UNTREATED_DATA"
+                                    WHERE udAirport = ?
+                                    AND udRegis = ?;
+                                """, (departing_airport, airplane))
+                            added = True
+
+                    # then check if the ppr is usable for its present airport
+                    if landing_data[2] == present_airport:
+                        time_limit = PPR_DELTA_TIME * 60 * 60
+                        min_time = arrival_time - (time_limit / 2)
+                        max_time = arrival_time + (time_limit / 2)
+                        
+                        if landing_data[1] > min_time \
+                                and landing_data[1] < max_time:
+                            query(insert_treated, (present_airport, airplane, landing_data[1], 1, "PPR"))
+                            query("""
+                                    DELETE FROM "UNTREATED_DATA"
+                                    WHERE udAirport = ?
+                                    AND udRegis = ?;
+                                """, (present_airport, airplane))
+                            added = True
+
+                if not added and int(ppr_id) <= max_id:
+                    response = requests.get("https://avdb.aerops.com/public/airports", 
+                                    auth=(user_avdb, password_avdb))
+                    data = json.loads(response.text)["data"]
+
+                    if present_airport in all_airports_name and arrival_time > 0:
+                        coords = [(x["latitude"], x["longitude"]) for x in data if x["name"] == present_airport]
+                        coords = coords[0] if len(coords) > 0 else (None, None)
+
+                        query("""
+                                INSERT INTO "UNTREATED_DATA"
+                                (udAirport, udRegis, udTime, udProbability, udSource, udLatitude, udLongitude)
+                                VALUES (?, ?, ?, 1, ?, ?, ?);
+                            """, (present_airport, airplane, arrival_time, "PPR", coords[0], coords[1]))
+                    if departing_airport in all_airports_name and departure_time > 0:
+                        coords = [(x["latitude"], x["longitude"]) for x in data if x["name"] == departing_airport]
+                        coords = coords[0] if len(coords) > 0 else (None, None)
+
+                        query("""
+                                INSERT INTO "UNTREATED_DATA"
+                                (udAirport, udRegis, udTime, udProbability, udSource, udLatitude, udLongitude)
+                                VALUES (?, ?, ?, 1, ?, ?, ?);
+                            """, (departing_airport, airplane, departure_time, "PPR", coords[0], coords[1]))
     
     print_c("Verify PPR on the treated data...")
-    ppr_in_db = query("SELECT udAirport, udRegis, udTime FROM UNTREATED_DATA WHERE udSource = 'PPR';").fetchall()
-    for ppr in ppr_in_db:
-        has_movement = query(f"""
-                                SELECT COUNT(tdId)
-                                FROM "TREATED_DATA"
-                                WHERE tdAirport = '{ppr[0]}'
-                                AND tdAirplane = '{ppr[1]}'
-                                AND tdTime > '{ppr[2] - PPR_DELTA_TIME * 60 * 60}'
-                                AND tdTime < '{ppr[2] + PPR_DELTA_TIME * 60 * 60}';
-                            """).fetchone()
-        if not isinstance(has_movement, type(None)):
-            query(f"""
-                    UPDATE \"TREATED_DATA\"
-                    SET tdProb = '1' 
-                    WHERE tdAirport = '{ppr[0]}'
-                    AND tdAirplane = '{ppr[1]}'
-                    AND tdTime > '{ppr[2] - PPR_DELTA_TIME * 60 * 60}'
-                    AND tdTime < '{ppr[2] + PPR_DELTA_TIME * 60 * 60}';
-                """)
-            query(f"""
-                    DELETE FROM "UNTREATED_DATA"
-                    WHERE udAirport = '{ppr[0]}'
-                    AND udRegis = '{ppr[1]}'
-                    and udTime = '{ppr[2]}';
-                """)
+    with transaction(conn, FILENAME):
+        ppr_in_db = query("SELECT udAirport, udRegis, udTime FROM UNTREATED_DATA WHERE udSource = ?;", ("PPR",)).fetchall()
+        for ppr in ppr_in_db:
+            has_movement = query("""
+                                    SELECT COUNT(tdId)
+                                    FROM "TREATED_DATA"
+                                    WHERE tdAirport = ?
+                                    AND tdAirplane = ?
+                                    AND tdTime > ?
+                                    AND tdTime < ?;
+                                """, (ppr[0], ppr[1], ppr[2] - PPR_DELTA_TIME * 60 * 60,
+                                      ppr[2] + PPR_DELTA_TIME * 60 * 60)).fetchone()
+            if not isinstance(has_movement, type(None)):
+                query("""
+                        UPDATE \"TREATED_DATA\"
+                        SET tdProb = 1 
+                        WHERE tdAirport = ?
+                        AND tdAirplane = ?
+                        AND tdTime > ?
+                        AND tdTime < ?;
+                    """, (ppr[0], ppr[1], ppr[2] - PPR_DELTA_TIME * 60 * 60, ppr[2] + PPR_DELTA_TIME * 60 * 60))
+                query("""
+                        DELETE FROM "UNTREATED_DATA"
+                        WHERE udAirport = ?
+                        AND udRegis = ?
+                        and udTime = ?;
+                    """, (ppr[0], ppr[1], ppr[2]))
 
     # here is the data from UNTREATED_DATA going to be treated, this means
     # that it will find all evidences that could refer to the same landing,
@@ -552,39 +554,38 @@ while True:
     # probability of this landing, by weightening them, depending from 
     # they're sources (second part of evidence_probability)
     print_c("Treat the data...")
-    list_airports_name = query("SELECT udAirport FROM \"UNTREATED_DATA\" WHERE 1").fetchall()
-    list_airports_name = push_id(list_airports_name)
-    done_airport = []
-    for airport_name in list_airports_name:
-        if airport_name not in done_airport:
-            done_airport.append(airport_name)
-            
-            evidences_by_airport = query(f"SELECT * FROM \"UNTREATED_DATA\" WHERE udAirport='{airport_name}';")
-            evidences_by_airport = evidences_by_airport.fetchall()
-
-            for evidence in evidence_probability(evidences_by_airport):
-                landing_exists =  query(f"""
-                                            SELECT count(tdId)
-                                            FROM "TREATED_DATA"
-                                            WHERE tdAirport = '{evidence["airport"]}' 
-                                            AND tdAirplane = '{evidence["regis"]}'
-                                            AND tdTime BETWEEN '{evidence["time"] - DELAY_BETWEEN_LANDINGS * 60 *60}'
-                                                            AND '{evidence["time"] + DELAY_BETWEEN_LANDINGS * 60 *60}';
-                                        """).fetchone()[0]
-                if landing_exists == 0:
-                    query(f"""
-                            INSERT INTO "TREATED_DATA"
-                            (tdAirport, tdAirplane, tdTime, tdProb, tdSent)
-                            VALUES ('{evidence["airport"]}', '{evidence["regis"]}', 
-                            '{evidence["time"]}', '{evidence["prob"]}', '0');
-                        """)
-                query(f"""
-                        DELETE FROM "UNTREATED_DATA"
-                        WHERE udAirport = '{evidence["airport"]}'
-                        AND udRegis = '{evidence["regis"]}'
-                        AND tdTime BETWEEN '{evidence["time"] - DELAY_BETWEEN_LANDINGS * 60 *60}'
-                                    AND '{evidence["time"] + DELAY_BETWEEN_LANDINGS * 60 *60}';
-                    """)
+    with transaction(conn, FILENAME):
+        list_airports_name = query("SELECT udAirport FROM \"UNTREATED_DATA\" WHERE 1").fetchall()
+        list_airports_name = push_id(list_airports_name)
+        done_airport = []
+        for airport_name in list_airports_name:
+            if airport_name not in done_airport:
+                done_airport.append(airport_name)
+                
+                evidences_by_airport = query("SELECT * FROM \"UNTREATED_DATA\" WHERE udAirport = ?;", (airport_name,))
+                evidences_by_airport = evidences_by_airport.fetchall()
+
+                for evidence in evidence_probability(conn, evidences_by_airport):
+                    landing_exists =  query("""
+                                                SELECT count(tdId)
+                                                FROM "TREATED_DATA"
+                                                WHERE tdAirport = ? 
+                                                AND tdAirplane = ?
+                                                AND tdTime BETWEEN ? AND ?;
+                                            """, (evidence["airport"], evidence["regis"],
+                                                  evidence["time"] - DELAY_BETWEEN_LANDINGS * 60 *60,
+                                                  evidence["time"] + DELAY_BETWEEN_LANDINGS * 60 *60)).fetchone()[0]
+                    if landing_exists == 0:
+                        query(insert_treated, (evidence["airport"], evidence["regis"], evidence["time"], evidence["prob"],
+                                               evidence["source"]))
+                    query("""
+                            DELETE FROM "UNTREATED_DATA"
+                            WHERE udAirport = ?
+                            AND udRegis = ?
+                            AND udTime BETWEEN ? AND ?;
+                        """, (evidence["airport"], evidence["regis"],
+                              evidence["time"] - DELAY_BETWEEN_LANDINGS * 60 *60,
+                              evidence["time"] + DELAY_BETWEEN_LANDINGS * 60 *60))
 
 
     print_c("Adding and treating the new AFTN messages...")
@@ -593,96 +594,85 @@ while True:
             aftn_data["been_read"] = True
             file.write(json.dumps(aftn_data))
 
-        for aftn_id in aftn_data["new_aftn"]:
-            aftn = aftn_data["new_aftn"][aftn_id]
-            aftn = get_aftn(aftn)
-
-            for table in TABLES:
-                landing = query(f"""
-                                    SELECT {table["id_name"]}
-                                    FROM "{table["table_name"]}"
-                                    WHERE {table["airplane_name"]} = '{aftn["airplane"]}'
-                                    AND {table["airport_name"]} = '{aftn["airport"]}'
-                                    AND {table["time_name"]} BETWEEN '{aftn["time"] - AFTN_DELTA_TIME * 60}' 
-                                                                AND '{aftn["time"] + AFTN_DELTA_TIME * 60}';
-                                """)
-                landing = landing.fetchone()
-
-                if not isinstance(landing, type(None)):
-                    query(f"""
-                        DELETE FROM "{table["table_name"]}"
-                        WHERE {table["id_name"]} = {landing[0]};
-                    """)
-                    query(f"""
-                        INSERT INTO "TREATED_DATA"
-                        (tdAirport, tdAirplane, tdTime, tdProb, tdSent)
-                        VALUES ('{aftn["airport"]}', '{aftn["airplane"]}',
-                        '{aftn["time"]}', '1', '0');
-                    """)
+        with transaction(conn, FILENAME):
+            for aftn_id in aftn_data["new_aftn"]:
+                aftn = aftn_data["new_aftn"][aftn_id]
+                aftn = get_aftn(aftn)
+
+                for table in TABLES:
+                    landing = query(f"""
+                                        SELECT {table["id_name"]}
+                                        FROM "{table["table_name"]}"
+                                        WHERE {table["airplane_name"]} = ?
+                                        AND {table["airport_name"]} = ?
+                                        AND {table["time_name"]} BETWEEN ? AND ?;
+                                    """, (aftn["airplane"], aftn["airport"],
+                                          aftn["time"] - AFTN_DELTA_TIME * 60, aftn["time"] + AFTN_DELTA_TIME * 60))
+                    landing = landing.fetchone()
+
+                    if not isinstance(landing, type(None)):
+                        query(f"""
+                            DELETE FROM "{table["table_name"]}"
+                            WHERE {table["id_name"]} = ?;
+                        """, (landing[0],))
+                        query(insert_treated, (aftn["airport"], aftn["airplane"], aftn["time"], 1, "AFTN"))
 
-            else:
-                # if there wasn't an occurence, it will be directly added
-                query(f"""
-                        INSERT INTO "TREATED_DATA"
-                        (tdAirport, tdAirplane, tdTime, tdProb, tdSent)
-                        VALUES ('{aftn["airport"]}', '{aftn["airplane"]}',
-                        '{aftn["time"]}', '{ponderation["AFTN"]["default"]/100.0}', '0');
-                    """)
+                else:
+                    # if there wasn't an occurence, it will be directly added
+                    query(insert_treated, (aftn["airport"], aftn["airplane"], aftn["time"],
+                                           ponderation["AFTN"]["default"]/100.0, "AFTN"))
 
     # here, when an airplane appears two times, but not at the same airport
     # we will keep the most probable one. If there isn't a most probable
     # one we will keep them all
-    all_landings = query("SELECT DISTINCT tdAirplane FROM \"TREATED_DATA\" WHERE 1;")
-    for airplane_name in push_id(all_landings.fetchall()):
-        same_airplanes = query(f"""
-                                    SELECT * 
-                                    FROM \"TREATED_DATA\" 
-                                    WHERE tdAirplane = '{airplane_name}';
-                                """).fetchall()
-        if len(same_airplanes) > 1:
-            same_time_landing = [[same_airplanes[0]]]
-            for landing in same_airplanes[1:]:
-                added = False
-                for same_landings in same_time_landing:
+    with transaction(conn, FILENAME):
+        all_landings = query("SELECT DISTINCT tdAirplane FROM \"TREATED_DATA\" WHERE 1;")
+        for airplane_name in push_id(all_landings.fetchall()):
+            same_airplanes = query("""
+                                        SELECT * 
+                                        FROM \"TREATED_DATA\" 
+                                        WHERE tdAirplane = ?;
+                                    """, (airplane_name,)).fetchall()
+            if len(same_airplanes) > 1:
+                same_time_landing = [[same_airplanes[0]]]
+                for landing in same_airplanes[1:]:
+                    added = False
+                    for same_landings in same_time_landing:
+                        mean_time = 0
+                        for tmp_landing in same_landings:
+                            mean_time += tmp_landing[3]
+                        mean_time /= len(same_landings)
+
+                        if abs(landing[3] - mean_time) < DELAY_BETWEEN_LANDINGS * 60 * 60:
+                            added = True
+                            same_landings.append(landing)
+                    if not added:
+                        same_time_landing.append([landing])
+                
+                new_landing = {}
+                for group in same_time_landing:
+                    most_prob_landings = [group[0]]
+                    for landing in group[1:]:
+                        if isclose(landing[4], most_prob_landings[0][4]):
+                            most_prob_landings.append(landing)
+                        elif landing[4] > most_prob_landings[0][4]:
+                            most_prob_landings = [landing]
                     mean_time = 0
-                    for tmp_landing in same_landings:
-                        mean_time += tmp_landing[3]
-                    mean_time /= len(same_landings)
-
-                    if abs(landing[3] - mean_time) < DELAY_BETWEEN_LANDINGS * 60 * 60:
-                        added = True
-                        same_landings.append(landing)
-                if not added:
-                    same_time_landing.append([landing])
-            
-            new_landing = {}
-            for group in same_time_landing:
-                most_prob_landings = [group[0]]
-                for landing in group[1:]:
-                    if isclose(landing[4], most_prob_landings[0][4]):
-                        most_prob_landings.append(landing)
-                    elif landing[4] > most_prob_landings[0][4]:
-                        most_prob_landings = [landing]
-                mean_time = 0
-                for landing in most_prob_landings:
-                    mean_time += landing[3]
-                mean_time /= len(most_prob_landings)
-                new_landing[mean_time] = most_prob_landings
-            
-            for landing_time in new_landing:
-                query(f"""
-                        DELETE FROM TREATED_DATA
-                        WHERE tdAirplane = '{airplane_name}'
-                        AND tdTime BETWEEN '{landing_time - DELAY_BETWEEN_LANDINGS * 60 *60}'
-                                        AND '{landing_time + DELAY_BETWEEN_LANDINGS * 60 *60}';
-                    """)
-            for landing in new_landing.values():
-                landing = landing[0]
-                query(f"""
-                        INSERT INTO "TREATED_DATA"
-                        (tdAirport, tdAirplane, tdTime, tdProb, tdSent)
-                        VALUES ('{landing[1]}', '{landing[2]}', '{landing[3]}', '{landing[4]}', '0');
-                    """)
+                    for landing in most_prob_landings:
+                        mean_time += landing[3]
+                    mean_time /= len(most_prob_landings)
+                    new_landing[mean_time] = most_prob_landings
+                
+                for landing_time in new_landing:
+                    query("""
+                            DELETE FROM TREATED_DATA
+                            WHERE tdAirplane = ?
+                            AND tdTime BETWEEN ? AND ?;
+                        """, (airplane_name, landing_time - DELAY_BETWEEN_LANDINGS * 60 *60,
+                              landing_time + DELAY_BETWEEN_LANDINGS * 60 *60))
+                for landing in new_landing.values():
+                    landing = landing[0]
+                    query(insert_treated, (landing[1], landing[2], landing[3], landing[4], landing[6]))
 
     conn.close()
 
@@ -690,5 +680,6 @@ while True:
     print_c("Sending data to the AVDB API...")
     # os.system(f"python3 {SEND_LANDING_PROGRAM}")
 
+    print_query_summary(FILENAME)
     print_c("end of the routine")
     time.sleep(CYCLE_TIME)
\ No newline at end of file
@@ -0,0 +1,248 @@
+"""
+This program exports the landings of TREATED_DATA and of its archives
+(see retention.py) to a CSV or a newline-delimited JSON file, optionally
+compressed with gzip:
+python3 export_landings.py <output> [--format csv|ndjson] [--gzip]
+                           [--since <time>] [--until <time>] [--airport <airport>] [--no-archives]
+(<output> is - for the standard output, and then the messages are on
+the standard error; the times are unix timestamps or dates, YYYY-MM-DD
+in UTC, and until is excluded)
+The rows are read by batches of EXPORT_BATCH_SIZE, each one beginning
+after the last row of the previous one, and written at once, so the
+memory doesn't depend on the number of landings. The landings of
+TREATED_DATA are read by time (with the indexes by time, and by airport
+and time), in one snapshot of the database, then the archives of the
+months in the time range, in the order they were archived. A landing
+that is archived during the export can be written twice, but is never
+missed.
+"""
+
+import argparse
+import csv
+import glob
+import gzip
+import io
+import json
+import os
+import sys
+from calendar import timegm
+from datetime import datetime
+from functions import *
+from schema import LANDING_DATABASE, LANDING_MIGRATIONS, migrate
+from retention import ARCHIVE_SCHEMA, archive_path, load_policies
+from query_service import LANDING_COLUMNS
+
+FILENAME = os.path.basename(__file__)
+# number of rows read at once
+EXPORT_BATCH_SIZE = 5000
+# no landing is after that
+MAX_TIME = 2 ** 62
+
+print_c = lambda text : print_context(FILENAME, text)
+
+
+class ExportError(Exception):
+    """
+A batch of rows couldn't be read
+    """
+
+
+def parse_time(value: str) -> int:
+    """
+Returns the unix timestamp of a time of the command (a unix timestamp,
+or a date YYYY-MM-DD in UTC)
+    """
+    if value.isdigit():
+        return int(value)
+    try:
+        return timegm(datetime.strptime(value, "%Y-%m-%d").timetuple())
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value} isn't a unix timestamp or a date YYYY-MM-DD")
+
+
+def stream_rows(conn: sqlite3.Connection, table: str, keys: list, condition: str, parameters: tuple,
+                batch_size: int=EXPORT_BATCH_SIZE):
+    """
+Yields the landings of a table (the columns of LANDING_COLUMNS), by
+batches sorted by keys: a batch begins after the last row of the
+previous one, so each batch only reads its rows in the index of the keys
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the landing database
+table : str
+    Table of the landings (of the database, or of an attached archive)
+keys : list
+    Columns that sort the rows, and identify a row
+condition : str
+    Condition of the landings to export
+parameters : tuple
+    Parameters of the condition
+batch_size : int, optional
+    Number of rows read at once
+
+Yields
+------
+tuple
+    The columns of a landing
+    """
+    after = None
+    while True:
+        keyset = f"AND ({', '.join(keys)}) > ({', '.join('?' * len(keys))})" if after is not None else ""
+        rows = execute(conn, FILENAME, f"""
+                SELECT {", ".join(keys)}, {", ".join(LANDING_COLUMNS)}
+                FROM {table}
+                WHERE {condition}
+                {keyset}
+                ORDER BY {", ".join(keys)}
+                LIMIT ?;
+            """, (*parameters, *(after or ()), batch_size))
+        if rows is False:
+            raise ExportError(f"the landings of {table} couldn't be read")
+        rows = rows.fetchall()
+
+        for row in rows:
+            yield row[len(keys):]
+        if len(rows) < batch_size:
+            return
+        after = rows[-1][:len(keys)]
+
+
+def landing_condition(since: int, until: int, airport: str) -> tuple:
+    """
+Returns the condition of the landings to export, and its parameters
+    """
+    condition = "tdTime >= ? AND tdTime < ?"
+    parameters = (since, until)
+    if airport is not None:
+        condition += " AND tdAirport = ?"
+        parameters += (airport,)
+    return (condition, parameters)
+
+
+def archive_months(archive_dir: str, since: int, until: int) -> list:
+    """
+Returns the paths of the archives of the landing database, of the months
+that are in the time range (in the order of the months)
+    """
+    paths = []
+    for path in sorted(glob.glob(archive_path(archive_dir, LANDING_DATABASE, "*"))):
+        month = os.path.splitext(os.path.basename(path))[0].rsplit("_", 1)[-1]
+        try:
+            month_begin = datetime.strptime(month, "%Y-%m")
+        except ValueError:
+            continue
+        month_end = month_begin.replace(year=month_begin.year + month_begin.month // 12,
+                                        month=month_begin.month % 12 + 1)
+        if timegm(month_end.timetuple()) > since and timegm(month_begin.timetuple()) < until:
+            paths.append(path)
+    return paths
+
+
+def export_landings(conn: sqlite3.Connection, writer, since: int, until: int, airport: str,
+                    archive_dir: str) -> int:
+    """
+Writes the landings of TREATED_DATA, then the ones of the archives (if
+archive_dir isn't None), with writer(row)
+
+Returns
+-------
+int
+    Number of landings written
+    """
+    condition, parameters = landing_condition(since, until, airport)
+    row_c = 0
+    # in a transaction, an error of a batch rolls it back and skips the
+    # rest of the block (see transaction), so the export is only complete
+    # if the end of the block is reached
+    is_read = False
+    with transaction(conn, FILENAME, immediate=False):
+        for row in stream_rows(conn, "\"TREATED_DATA\"", ["tdTime", "tdId"], condition, parameters):
+            writer(row)
+            row_c += 1
+        is_read = True
+    if not is_read:
+        raise ExportError("the landings of TREATED_DATA couldn't be read")
+    if archive_dir is None:
+        return row_c
+
+    for path in archive_months(archive_dir, since, until):
+        # an archive can only be attached outside of a transaction
+        if execute(conn, FILENAME, f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA};", (path,)) is False:
+            raise ExportError(f"the archive {path} couldn't be read")
+        try:
+            archive_columns = execute(conn, FILENAME, f"PRAGMA {ARCHIVE_SCHEMA}.table_info(\"TREATED_DATA\");")
+            if archive_columns is False:
+                raise ExportError(f"the archive {path} couldn't be read")
+            if len(archive_columns.fetchall()) > 0:
+                is_read = False
+                with transaction(conn, FILENAME, immediate=False):
+                    # the archives don't have the indexes of the database,
+                    # their rows are read in the order of their rowid
+                    for row in stream_rows(conn, f"{ARCHIVE_SCHEMA}.\"TREATED_DATA\"", ["rowid"], condition, parameters):
+                        writer(row)
+                        row_c += 1
+                    is_read = True
+                if not is_read:
+                    raise ExportError(f"the landings of the archive {path} couldn't be read")
+        finally:
+            execute(conn, FILENAME, f"DETACH DATABASE {ARCHIVE_SCHEMA};")
+
+    return row_c
+
+
+def open_output(output: str, is_gzip: bool):
+    """
+Opens the output of the export (a text file)
+    """
+    if output == "-":
+        if is_gzip:
+            return io.TextIOWrapper(gzip.GzipFile(fileobj=sys.__stdout__.buffer, mode="wb"), newline="")
+        return io.TextIOWrapper(sys.__stdout__.buffer, newline="")
+    if is_gzip:
+        return gzip.open(output, "wt", newline="")
+    return open(output, "w", newline="")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the landings of TREATED_DATA and of its archives")
+    parser.add_argument("output", help="file of the export (- for the standard output)")
+    parser.add_argument("--format", choices=("csv", "ndjson"), default="csv")
+    parser.add_argument("--gzip", action="store_true", help="compresses the export with gzip")
+    parser.add_argument("--since", type=parse_time, default=0, help="unix timestamp or date YYYY-MM-DD")
+    parser.add_argument("--until", type=parse_time, default=MAX_TIME, help="unix timestamp or date YYYY-MM-DD")
+    parser.add_argument("--airport")
+    parser.add_argument("--no-archives", action="store_true", help="only exports TREATED_DATA")
+    arguments = parser.parse_args()
+
+    if arguments.output == "-":
+        # the messages are printed on the standard error, not in the
+        # export
+        sys.stdout = sys.stderr
+
+    conn = create_connection(LANDING_DATABASE)
+    migrate(conn, FILENAME, LANDING_MIGRATIONS)
+    # the archives are only made for SQLite
+    archive_dir = None if arguments.no_archives or STORAGE.name != "sqlite" else load_policies()["archive_path"]
+    names = list(LANDING_COLUMNS.values())
+
+    with open_output(arguments.output, arguments.gzip) as output:
+        if arguments.format == "csv":
+            csv_writer = csv.writer(output)
+            csv_writer.writerow(names)
+            writer = csv_writer.writerow
+        else:
+            writer = lambda row : output.write(json.dumps(dict(zip(names, row))) + "\n")
+
+        print_c("begin of the export")
+        try:
+            row_c = export_landings(conn, writer, arguments.since, arguments.until, arguments.airport, archive_dir)
+            print_c(f"{row_c} landings exported to {arguments.output}")
+        except ExportError as e:
+            print_context(FILENAME, f"Error: '{e}', the export is incomplete", True)
+            exit(1)
+        finally:
+            conn.close()
+
+    print_query_summary(FILENAME)
@@ -4,12 +4,44 @@ Here you can find functions that are used in many other program
 
 import sqlite3
 import time
-from sqlite3 import Error
+import json
+import re
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import islice
 from datetime import datetime
+from storage import STORAGE, ERRORS as Error
+from spatial import haversine, bounding_box
+
+# number of airplanes written at once by upsert_airplanes
+UPSERT_BATCH_SIZE = 500
+# an airplane is only rewritten by upsert_airplanes if one of its values
+# changed more than that since it was written, so the noise of the ADS-B
+# signal isn't considered as a change: {<column>: <smallest change>}
+CHANGE_TOLERANCES = {"apLatitude": 0.0001, "apLongitude": 0.0001, "apAltitude": 1,
+                     "apVelocity": 0.1, "apHeading": 1, "apIcao": 1}
+# an unchanged airplane is written again after that time (in seconds),
+# so its last contact is never too old, it has to be smaller than the
+# DELAY_INVISIBLE of check_airplanes.py
+HEARTBEAT_TIME = 120
+# a query (or a wait for the write lock) longer than that is printed 
+# (in seconds)
+SLOW_QUERY_TIME = 0.5
+# number of queries in the summary of a cycle (the longest ones)
+QUERY_SUMMARY_SIZE = 5
+# (file, fingerprint) -> [number of calls, total time, maximum time,
+# rows] of the queries since the last summary
+QUERY_STATS = {}
+QUERY_STATS_LOCK = threading.Lock()
+
 
 def create_connection(path: str, check_same_thread :bool=True) -> sqlite3.Connection: #|None
     """
-Establish the connection with the database
+Establish the connection with the database, with the storage of the
+STORAGE_FILE (see storage.py): a SQLite file in WAL mode, that waits at
+most BUSY_TIMEOUT seconds if the database is locked, or a connection of
+the pool of a PostgreSQL database
 
 Parameters
 ----------
@@ -26,12 +58,141 @@ sqlite3.Connection or None
     """
     connection = None
     try:
-        connection = sqlite3.connect(path, check_same_thread=check_same_thread)
+        connection = STORAGE.connect(path, check_same_thread)
     except Error as e:
         print(f"The error '{e}' occurred")
 
     return connection
 
+@lru_cache(maxsize=1024)
+def statement_fingerprint(query_: str) -> str:
+    """
+Returns the query without its values (strings and numbers are replaced
+by ?, and the lists of values by (?)), on one line, so the same query
+with other values has the same fingerprint
+
+Parameters
+----------
+query_ : str
+    Query to the database
+
+Returns
+-------
+str
+    Fingerprint of the query
+    """
+    fingerprint = re.sub(r"'(?:[^']|'')*'", "?", query_)
+    fingerprint = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])", "?", fingerprint)
+    fingerprint = re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", fingerprint)
+
+    return " ".join(fingerprint.split())
+
+
+def record_statement(file: str, query_: str, elapsed: float, row_c: int) -> None:
+    """
+Adds a query to the QUERY_STATS of the file, and prints it if it took 
+more than SLOW_QUERY_TIME seconds
+
+Parameters
+----------
+file : str
+    File which made the query
+query_ : str
+    Query to the database
+elapsed : float
+    Time of the query (in seconds)
+row_c : int
+    Number of rows changed by the query (0 for a SELECT)
+    """
+    fingerprint = statement_fingerprint(query_)
+    with QUERY_STATS_LOCK:
+        stats = QUERY_STATS.setdefault((file, fingerprint), [0, 0, 0, 0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        stats[3] += row_c
+
+    if elapsed > SLOW_QUERY_TIME:
+        print_context(file, f"slow query ({elapsed:.3f} seconds, {row_c} rows): {fingerprint}")
+
+
+def timed_statement(file: str, query_: str, method, parameters):
+    """
+Makes a query with a method of the connection (execute or executemany)
+and records its time (see record_statement). An error is raised
+    """
+    begin_time = time.perf_counter()
+    cursor = method(query_, parameters)
+    record_statement(file, query_, time.perf_counter() - begin_time, max(cursor.rowcount, 0))
+
+    return cursor
+
+
+def timed_commit(connection: sqlite3.Connection, file: str) -> None:
+    """
+Commits the transaction of the connection, and records the time of the
+commit (with the COMMIT fingerprint)
+    """
+    begin_time = time.perf_counter()
+    connection.commit()
+    record_statement(file, "COMMIT", time.perf_counter() - begin_time, 0)
+
+
+def query_summary(file: str) -> list:
+    """
+Returns the statistics of the queries of a file since the last summary,
+and resets them
+
+Parameters
+----------
+file : str
+    File which made the queries
+
+Returns
+-------
+list
+    Fingerprint, number of calls, total time, maximum time and rows of
+each query, the longest (in total) first
+    """
+    with QUERY_STATS_LOCK:
+        summary = [(fingerprint, *QUERY_STATS.pop((file, fingerprint)))
+                    for stats_file, fingerprint in list(QUERY_STATS) if stats_file == file]
+
+    return sorted(summary, key=lambda item: item[2], reverse=True)
+
+
+def print_query_summary(file: str) -> list:
+    """
+Prints the summary of the queries of a cycle: the total time of the 
+queries, of the commits and of the wait for the lock, and the 
+QUERY_SUMMARY_SIZE longest queries
+
+Parameters
+----------
+file : str
+    File which made the queries
+
+Returns
+-------
+list
+    The whole summary (see query_summary)
+    """
+    summary = query_summary(file)
+    times = {"COMMIT": 0, "BEGIN IMMEDIATE": 0}
+    for fingerprint, _, total_time, _, _ in summary:
+        if fingerprint in times:
+            times[fingerprint] = total_time
+    query_time = sum(item[2] for item in summary if item[0] not in times)
+
+    print_context(file, f"queries: {sum(item[1] for item in summary if item[0] not in times)} in {query_time:.3f} "
+                        f"seconds, commit: {times['COMMIT']:.3f} seconds, lock wait: {times['BEGIN IMMEDIATE']:.3f} seconds")
+    for fingerprint, call_c, total_time, max_time, row_c in [item for item in summary if item[0] not in times][:QUERY_SUMMARY_SIZE]:
+        print_context(file, f"    {total_time:.3f} seconds ({call_c} calls, max {max_time:.3f} seconds, "
+                            f"{row_c} rows): {fingerprint[:120]}")
+
+    return summary
+
+
 def query_to_bdd(connection: sqlite3.Connection, file: str, query_: str) -> sqlite3.Cursor: #|None
     """
 Makes a query to a database
@@ -50,18 +211,151 @@ Returns
 sqlite3.Cursor or None
     Response (if any) from the database of the query
     """    
-    cursor = connection.cursor()
+    return execute(connection, file, query_)
+
+
+def execute(connection: sqlite3.Connection, file: str, query_: str, parameters=()) -> sqlite3.Cursor: #|False
+    """
+Makes a parameterized query to a database. The values are bound to the
+placeholders (?) of the query, so the query is the same for all values,
+and is prepared only once (it is kept in the statement cache of the 
+connection). The query is committed at once, except in a transaction
+(see transaction)
+
+Parameters
+----------
+connection : sqlite3.Connection
+    Connection to the database on wich the query has to be made
+file : str
+    File which makes the query
+query_ : str
+    Query to be done on the database, with a placeholder for each value
+parameters : tuple or dict, optional
+    Values of the placeholders
+
+Returns
+-------
+sqlite3.Cursor or False
+    Response (if any) from the database of the query, or False if there
+was an error (in a transaction, the error is raised, so the whole 
+transaction is rolled back)
+    """
+    in_transaction = connection.in_transaction
     try:
-        cursor.execute(query_)
-        connection.commit()
+        cursor = timed_statement(file, query_, connection.execute, parameters)
+        if not in_transaction:
+            timed_commit(connection, file)
         return cursor
-    # except sqlite3.OperationalError:
-    #     print_context(file, "Error: the database is locked", True)
-    #     return "locked"
     except Error as e:
+        if in_transaction:
+            raise
+        # the query was the only one of its transaction
+        if connection.in_transaction:
+            connection.rollback()
         print_context(file, f"Error: '{e}'", True)
         return False
 
+
+def executemany(connection: sqlite3.Connection, file: str, query_: str, parameters_list) -> sqlite3.Cursor: #|False
+    """
+Makes a parameterized query to a database for each values of a list,
+with the query prepared only once (see execute)
+
+Parameters
+----------
+connection : sqlite3.Connection
+    Connection to the database on wich the query has to be made
+file : str
+    File which makes the query
+query_ : str
+    Query to be done on the database, with a placeholder for each value
+parameters_list : iterable
+    Values of the placeholders, for each query
+
+Returns
+-------
+sqlite3.Cursor or False
+    Cursor of the queries, or False if there was an error (in a 
+transaction, the error is raised)
+    """
+    in_transaction = connection.in_transaction
+    try:
+        cursor = timed_statement(file, query_, connection.executemany, parameters_list)
+        if not in_transaction:
+            timed_commit(connection, file)
+        return cursor
+    except Error as e:
+        if in_transaction:
+            raise
+        # the query was the only one of its transaction
+        if connection.in_transaction:
+            connection.rollback()
+        print_context(file, f"Error: '{e}'", True)
+        return False
+
+
+def begin_immediate(connection: sqlite3.Connection, file: str) -> None:
+    """
+Begins a transaction that locks the database for writing at once, and
+records the time waited for the lock (with the BEGIN IMMEDIATE 
+fingerprint, see record_statement)
+
+Parameters
+----------
+connection : sqlite3.Connection
+    Connection to the database
+file : str
+    File which makes the transaction
+    """
+    begin_time = time.perf_counter()
+    connection.execute("BEGIN IMMEDIATE;")
+    record_statement(file, "BEGIN IMMEDIATE", time.perf_counter() - begin_time, 0)
+
+
+@contextmanager
+def transaction(connection: sqlite3.Connection, file: str, immediate: bool=True):
+    """
+Groups all queries made in its block in one transaction, so they are
+committed at once (only one write on the disk). If a query fails, the
+whole transaction is rolled back, the error is printed, and the rest of
+the block is skipped. In a transaction, the block is only a part of it
+
+Parameters
+----------
+connection : sqlite3.Connection
+    Connection to the database
+file : str
+    File which makes the queries
+immediate : bool, optional
+    If true (by default), the database is locked for writing at the 
+beginning of the transaction (see begin_immediate), instead of at the 
+first write. In WAL mode, a transaction that has read the database can
+fail at once when it begins to write, if another one wrote since then
+
+Yields
+------
+sqlite3.Connection
+    The connection
+    """
+    if connection.in_transaction:
+        yield connection
+        return
+
+    if immediate:
+        begin_immediate(connection, file)
+    else:
+        connection.execute("BEGIN;")
+    try:
+        yield connection
+    except Error as e:
+        connection.rollback()
+        print_context(file, f"Error: '{e}'", True)
+        return
+    except BaseException:
+        connection.rollback()
+        raise
+    timed_commit(connection, file)
+
 class bcolors:
     """
 Class with the color used for the terminal output
@@ -74,6 +368,7 @@ Class with the color used for the terminal output
     get_ppr = "\033[1;95m"                      # purple
     get_aftn_by_id = "\033[1;93m"               # yellow
     get_airport_by_zone = "\033[1;36m"          # cyan
+    ingestion_daemon = "\033[1;34m"             # dark blue
     error = "\u001b[31m"                        # red
     default = "\033[1;37m"
 
@@ -114,33 +409,239 @@ None
     print(f"{output_time} | {output_file} {message}")
 
 
-def wait_unlock_db(query, DATABASE_PATH: str, FILENAME: str, SOURCE: str="") -> None:
+def add_column(connection: sqlite3.Connection, file: str, table: str, column: str, definition: str) -> None:
+    """
+Adds a column to a table, if the table was created before this column
+existed
+
+Parameters
+----------
+connection : sqlite3.Connection
+    Connection to the database
+file : str
+    File which makes the query
+table : str
+    Name of the table
+column : str
+    Name of the column
+definition : str
+    Type (and constraints) of the column
+    """
+    # PostgreSQL writes the names in lower case
+    columns = [item.lower() for item in STORAGE.table_columns(connection, table)]
+    if column.lower() not in columns:
+        execute(connection, file, f"ALTER TABLE \"{table}\" ADD COLUMN \"{column}\" {definition};")
+
+
+def nearby_evidences(connection: sqlite3.Connection, file: str, latitude: float, longitude: float, time_: int,
+                     distance: float, minutes: float, airport: str=None) -> list:
+    """
+Returns the evidences of UNTREATED_DATA at less than distance km and
+minutes minutes of a position, with one query: the R*Tree of the
+evidences (see schema.py) finds the ones in the box around the position,
+and the SQL function haversine keeps the ones in the circle
+
+Parameters
+----------
+connection : sqlite3.Connection
+    Connection to the database
+file : str
+    File which makes the query
+latitude : float
+    Latitude of the position
+longitude : float
+    Longitude of the position
+time_ : int
+    Time of the position (unix timestamp)
+distance : float
+    Maximum distance (in km)
+minutes : float
+    Maximum time between the evidences and the position (in minutes)
+airport : str, optional
+    Only the evidences of this airport
+
+Returns
+-------
+list
+    The rows of the evidences
     """
-Will stop the program, if the database is locked
+    if latitude is None or longitude is None:
+        return []
+
+    min_latitude, max_latitude, min_longitude, max_longitude = bounding_box(latitude, longitude, distance)
+    min_time, max_time = time_ - minutes * 60, time_ + minutes * 60
+    airport_condition = "" if airport is None else "AND udAirport = ?"
+    airport_parameters = () if airport is None else (airport,)
+
+    if STORAGE.name != "sqlite":
+        # without R*Tree, the box is compared to the columns, and the
+        # circle is computed here
+        rows = execute(connection, file, f"""
+                SELECT * FROM "UNTREATED_DATA"
+                WHERE udLatitude BETWEEN ? AND ?
+                AND udLongitude BETWEEN ? AND ?
+                AND udTime BETWEEN ? AND ?
+                {airport_condition};
+            """, (min_latitude, max_latitude, min_longitude, max_longitude, min_time, max_time, *airport_parameters))
+        return [row for row in (rows.fetchall() if rows else [])
+                if haversine(latitude, longitude, row[7], row[8]) <= distance]
+
+    rows = execute(connection, file, f"""
+            SELECT "UNTREATED_DATA".* FROM "UNTREATED_DATA_POSITION"
+            JOIN "UNTREATED_DATA" ON udId = id
+            WHERE maxLatitude >= ? AND minLatitude <= ?
+            AND maxLongitude >= ? AND minLongitude <= ?
+            AND maxTime >= ? AND minTime <= ?
+            AND udTime BETWEEN ? AND ?
+            AND haversine(?, ?, udLatitude, udLongitude) <= ?
+            {airport_condition};
+        """, (min_latitude, max_latitude, min_longitude, max_longitude, min_time, max_time, min_time, max_time,
+              latitude, longitude, distance, *airport_parameters))
+    return rows.fetchall() if rows else []
+
+
+def read_auth_api(auth_file: str, source: str) -> tuple:
+    """
+Reads the user and the key of a source from the auth file of the 
+get_airplane programs
 
 Parameters
 ----------
-query : function
-    The function to make querie on a database
-DATABASE_PATH : str
-    The path/name of the database
-FILENAME : str
-    The file that execute this function
-SOURCE : str
-    For the "get_aiplane" programms, the name of the source
-    """
-    db_status = query(f"""
-                    INSERT INTO "AIRPLANE" 
-                    VALUES ("{FILENAME}_", "", "", "", "", "", "", "", "", "{SOURCE}");
-                """)
-
-    query(f"DELETE FROM \"AIRPLANE\" WHERE apRegis = \"{FILENAME}_\" AND apSource = \"{SOURCE}\";")
-    while db_status == "locked":
-        print_context(FILENAME, f"waiting for the {DATABASE_PATH} database to be unlocked")
-        
-        time.sleep(5)
-        db_status = query(f"""
-                            INSERT INTO "AIRPLANE" 
-                            VALUES ("{FILENAME}_", "", "", "", "", "", "", "", "", "{SOURCE}");
-                        """)
-        query(f"DELETE FROM \"AIRPLANE\" WHERE apRegis = \"{FILENAME}_\" AND apSource = \"{SOURCE}\";")
\ No newline at end of file
+auth_file : str
+    Path to the auth file (see README.md for its format)
+source : str
+    Name of the source (api)
+
+Returns
+-------
+tuple
+    The user and the key of the source
+    """
+    with open(auth_file) as file:
+        content = json.loads(file.read())[source]
+
+    return (content["user"], content["key"])
+
+
+def upsert_airplanes(connection: sqlite3.Connection, file: str, source: str, airplane_data, 
+                     history=None) -> tuple:
+    """
+Writes a whole snapshot of airplanes from one source in the AIRPLANE 
+table, in a single transaction. The airplanes of the snapshot are 
+inserted or updated with one prepared statement, by batches of 
+UPSERT_BATCH_SIZE, and the airplanes of this source that aren't in the
+snapshot anymore are registered as invisible with one set-based update.
+An airplane whose ICAO address is already known by another source takes
+the registration of this source, so the same airplane has the same 
+registration in all sources.
+An airplane that didn't change since it was written (see 
+CHANGE_TOLERANCES) isn't written again, except its last contact every
+HEARTBEAT_TIME seconds
+
+Parameters
+----------
+connection : sqlite3.Connection
+    Connection to the database with the AIRPLANE table
+file : str
+    File which makes the query
+source : str
+    Name of the source (api) of the snapshot
+airplane_data : dict or iterable
+    Position of all airplanes (see normalizer.py), with they're 
+callsign as key, or an iterable (a generator for instance) of Position
+history : HistoryStore, optional
+    Position history of the airplanes, where every fix of the snapshot
+is added (see position_history.py)
+
+Returns
+-------
+tuple
+    Number of new airplanes, updated airplanes, new invisible airplanes
+and skipped (unchanged) airplanes
+    """
+    if isinstance(airplane_data, dict):
+        airplane_data = airplane_data.values()
+    airplane_data = iter(airplane_data)
+    count_query = "SELECT count(apRegis) FROM \"AIRPLANE\" WHERE apSource = ?;"
+    # the queries are timed (see record_statement)
+    query = lambda query_, parameters=() : timed_statement(file, query_, connection.execute, parameters)
+    query_many = lambda query_, parameters_list : timed_statement(file, query_, connection.executemany, parameters_list)
+    # the row of an airplane is only updated if it was invisible, if one
+    # of its values changed, or for the heartbeat of its last contact
+    changed = "\n".join(f"OR abs(excluded.{column} - \"AIRPLANE\".{column}) >= {tolerance} "
+                        f"OR (excluded.{column} IS NULL) != (\"AIRPLANE\".{column} IS NULL)"
+                        for column, tolerance in CHANGE_TOLERANCES.items())
+    airplane_c, written_c = 0, 0
+    now = int(time.time())
+
+    try:
+        begin_immediate(connection, file)
+        with connection:
+            airplane_before = query(count_query, (source,)).fetchone()[0]
+
+            # the airplanes seen in this snapshot are kept in a temporary
+            # table, so all the others can be registered as invisible at
+            # once
+            query("CREATE TEMP TABLE IF NOT EXISTS \"SEEN_AIRPLANE\" (\"apRegis\" TEXT PRIMARY KEY);")
+            query("DELETE FROM temp.\"SEEN_AIRPLANE\";")
+
+            regis_by_icao = dict(query("""
+                    SELECT apIcao, apRegis
+                    FROM "AIRPLANE"
+                    WHERE apIcao >= 0
+                    AND apSource != ?;
+                """, (source,)).fetchall())
+
+            while True:
+                airplanes = list(islice(airplane_data, UPSERT_BATCH_SIZE))
+                if len(airplanes) == 0:
+                    break
+                airplanes = [airplane._replace(regis=regis_by_icao[airplane.icao])
+                                if airplane.icao in regis_by_icao else airplane
+                             for airplane in airplanes]
+                airplane_c += len(airplanes)
+                if history is not None:
+                    for airplane in airplanes:
+                        history.add(airplane)
+                query_many("INSERT OR IGNORE INTO temp.\"SEEN_AIRPLANE\" VALUES (?);",
+                           ((airplane.regis,) for airplane in airplanes))
+
+                # if the airplane is in the list, it is reachable by ADS-B,
+                # so it isn't invisible anymore
+                # (the Position of an airplane has the same order as the 
+                # columns)
+                written_c += query_many(f"""
+                        INSERT INTO "AIRPLANE"
+                        (apRegis, apLatitude, apLongitude, apAltitude, apTime,
+                        apVelocity, apHeading, apIcao, apInvisible, apInvisibleTime, apSource)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 0, 0, ?)
+                        ON CONFLICT(apRegis, apSource) DO UPDATE SET
+                        apLatitude = excluded.apLatitude,
+                        apLongitude = excluded.apLongitude,
+                        apAltitude = excluded.apAltitude,
+                        apTime = excluded.apTime,
+                        apVelocity = excluded.apVelocity,
+                        apHeading = excluded.apHeading,
+                        apIcao = excluded.apIcao,
+                        apInvisible = 0,
+                        apInvisibleTime = 0
+                        WHERE "AIRPLANE".apInvisible = 1
+                        OR excluded.apTime - "AIRPLANE".apTime >= {HEARTBEAT_TIME}
+                        {changed};
+                    """, [airplane + (source,) for airplane in airplanes]).rowcount
+
+            new_airplane_c = query(count_query, (source,)).fetchone()[0] - airplane_before
+
+            invisible_airplane_c = query("""
+                    UPDATE "AIRPLANE"
+                    SET apInvisible = 1,
+                    apInvisibleTime = ?
+                    WHERE apSource = ?
+                    AND apInvisible = 0
+                    AND apRegis NOT IN (SELECT apRegis FROM temp."SEEN_AIRPLANE");
+                """, (now, source)).rowcount
+    except (*Error, ValueError) as e:
+        print_context(file, f"Error: '{e}'", True)
+        return (0, 0, 0, 0)
+
+    return (new_airplane_c, written_c - new_airplane_c, invisible_airplane_c, airplane_c - written_c)
@@ -7,10 +7,16 @@ airplane" in the database.
 """
 
 import json
+import math
 import time
 import os
 import requests
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from functions import *
+from schema import AIRPLANE_MIGRATIONS, migrate
+from position_history import HistoryStore
+from operations_area import load_areas, load_altitude_ceiling, search_box, compile_area_filter
+from normalizer import UNITS as UNIT_COEFS, compile_normalizer, normalize_batch
 
 # forces this program to be in the UTC timezone
 os.environ["TZ"] = "UTC"
@@ -23,215 +29,213 @@ SOURCE = "FlightAware"
 AUTH_FILE = "auth_api.json"
 FILENAME = os.path.basename(__file__)
 #CYCLE_TIME = 30
+API_URL = "https://aeroapi.flightaware.com/aeroapi"
+SEARCH_PATH = "/flights/search/positions"
+# the search is split in latitude bands (of the search box), that are 
+# requested concurrently
+LATITUDE_BANDS = 4
+MAX_CONCURRENT_REQUESTS = 4
+# number of pages returned by the API for one request
+MAX_PAGES_PER_REQUEST = 1
+# maximum number of pages, and maximum time (in seconds), for one cycle
+PAGE_BUDGET = 40
+TIME_BUDGET = 25
+# the airplanes of the last WINDOW_TIME seconds are returned, but only 
+# the positions newer than the last ingested one (minus OVERLAP_TIME 
+# seconds, for the positions that are reported late) are requested
+WINDOW_TIME = 3600
+OVERLAP_TIME = 120
+
+# fields of an airplane in the API response, and their units
+FIELDS = {"regis": "fa_flight_id", "latitude": "latitude", "longitude": "longitude",
+          "heading": "heading", "altitude": "altitude", "velocity": "groundspeed",
+          "time": "timestamp"}
+UNITS = {"altitude": "hft", "velocity": "kt", "time": "iso8601"}
 
 print_c = lambda text : print_context(FILENAME, text)
 
-def to_dict_by_callsign(airplane_list: list, callsign: str, 
-                        latitude: int, longitude: int, 
-                        heading: int, geo_altitude: int,
-                        velocity: int, airplane_time: int, 
-                        ) -> dict:
+AREAS = load_areas()
+# the search is limited to the operations areas (the whole world if 
+# there isn't any), and to the altitude ceiling, so the API doesn't 
+# return the airplanes that can't land in them
+SEARCH_BOX = search_box(AREAS) or (-90, -180, 90, 180)
+ALTITUDE_CEILING = load_altitude_ceiling()
+
+# the fa_flight_id is formated as <ident>-<timestamp>-...
+normalize = compile_normalizer(FIELDS, UNITS, lambda regis: regis.split("-")[0],
+                               compile_area_filter(AREAS))
+
+
+def build_queries(min_clock: int) -> list:
     """
-Returns a formated dictionary of airplanes, with they're callsign as key
+Builds the search queries of the positions newer than min_clock, in
+the SEARCH_BOX (one query by latitude band) and below the 
+ALTITUDE_CEILING
 
 Parameters
 ----------
-airplane_list : list
-    List of all airplanes
-callsign : str or int
-    Key or index to the callsign value
-latitude : str or int
-    Key or index to the latitude value
-longitude : str or int
-    Key or index to the longitude value
-heading : str or int
-    Key or index to the heading/direction value
-geo_altitude : str or int
-    Key or index to the altitude value
-velocity : str or int
-    Key or index to the velocity/speed value
-airplane_time : str or int
-    Key or index to the time value of the last contact
+min_clock : int
+    Time of the oldest position (unix timestamp)
 
 Returns
 -------
-dict
-    Formated list of all airplane, with they're callsign as key
+list
+    The queries, one by latitude band
     """
-    new_dict = {}
-    for i in airplane_list:
-
-
-        # in this part, we are going to see if all the data is available
-        latitude_value = i[latitude] if not isinstance(i[latitude], str) else eval(i[latitude])
-        longitude_value = i[longitude] if not isinstance(i[longitude], str) else eval(i[longitude])
-        if isinstance(latitude_value, type(None)) or \
-                isinstance(longitude_value, type(None)):
-            continue
-
-        heading_value = i[heading] if not isinstance(i[heading], str) else eval(i[heading])
-        if isinstance(heading_value, type(None)) :
-            continue
-
-        geo_altitude_value = i[geo_altitude] if not isinstance(i[geo_altitude], str) else eval(i[geo_altitude])
-        if isinstance(geo_altitude_value, type(None)):
-            continue
-        geo_altitude_value *= 0.3048    # to convert from feet to meters
-        geo_altitude_value *= 100       # from hundreds of meter to meter
-
-        velocity_value = i[velocity] if not isinstance(i[velocity], str) else eval(i[velocity])
-        if isinstance(velocity_value, type(None)):
-            continue
-        velocity_value *= 0.5144        # to convert from knots to meter per seconds
-
-
-        # time is the only data that we can put by ourselves
-        airplane_time_value = i[airplane_time]
-        if isinstance(airplane_time_value, type(None)):
-            airplane_time_value = int(time.time())
-        else:
-            airplane_time_value = datetime.strptime(airplane_time_value, "%Y-%m-%dT%H:%M:%SZ")
-            airplane_time_value = time.mktime(airplane_time_value.timetuple())
-
-        i[callsign] = i[callsign].split("-")[0]
-        if isinstance(i[callsign], type(None)):
-            continue
-
-        i[callsign] = i[callsign].replace("-", "")
-        new_dict[i[callsign].strip()] = {"latitude": latitude_value, 
-                                            "longitude": longitude_value,
-                                            "heading": heading_value, 
-                                            "altitude": geo_altitude_value, 
-                                            "velocity": velocity_value, 
-                                            "time": airplane_time_value}
-
-    return new_dict
-
-def initialize_database(conn: sqlite3.Connection) -> None:
+    min_lat, min_lon, max_lat, max_lon = SEARCH_BOX
+    clauses = f"{{> clock {min_clock}}}"
+    if ALTITUDE_CEILING is not None:
+        # the altitude of the API is in hundreds of feet
+        clauses += f" {{< alt {math.ceil(ALTITUDE_CEILING / UNIT_COEFS[UNITS['altitude']])}}}"
+    if min_lon > -180 or max_lon < 180:
+        clauses += f" {{range lon {min_lon:.4f} {max_lon:.4f}}}"
+
+    band_size = (max_lat - min_lat) / LATITUDE_BANDS
+    return [f"{clauses} {{range lat {min_lat + band * band_size:.4f} {min_lat + (band + 1) * band_size:.4f}}}"
+            for band in range(LATITUDE_BANDS)]
+
+
+def fetch_airplanes(session: requests.Session, user: str, api_key: str, timeout: float=None, state: dict=None) -> dict: #|None
     """
-Creates the table AIRPLANE, if it doesn't exist
+Requests the positions of the last hour to the FlightAware API (see
+build_queries).
+The positions of the last hour are kept in the state, so only the 
+positions after the newest ingested one (the watermark, minus 
+OVERLAP_TIME) are requested, and merged with the known ones. Without 
+state (first call), the whole hour is requested.
+The search is split in LATITUDE_BANDS, whose pages are requested 
+concurrently (at most MAX_CONCURRENT_REQUESTS at a time), each band 
+following the cursor of its next page. The pages are merged as they 
+arrive, until all pages are received or the PAGE_BUDGET or TIME_BUDGET
+of the cycle is exceeded
+
+Parameters
+----------
+session : requests.Session
+    Session used to make the requests, so the connections can be kept 
+alive between two calls
+user : str
+    Name of the header with the API key
+api_key : str
+    Key of the API
+timeout : float, optional
+    Maximum time (in seconds) to wait for each response
+state : dict, optional
+    State of the source, kept between two calls. The bytes transferred
+and the latency of the requests of this call are written in it, with
+the watermark and the known positions
+
+Returns
+-------
+dict or None
+    Position of all airplanes (see normalizer.py), with they're callsign 
+as key, or None if a request failed
     """
-    table_exists = query("SELECT count(name) FROM sqlite_master WHERE type = 'table' AND name = 'AIRPLANE';").fetchall()
-    if table_exists[0][0] == 0:
-        # we have the basic parameters of a airplane (registration 
-        # name, coordinate, altitude, speed and heading) qnd three more
-        # aspects : when it was last seen, if it is invisible, and since
-        # when it's invisible
-        query("""
-                CREATE TABLE "AIRPLANE" ( 
-                    "apRegis" TEXT NOT NULL, 
-                    "apLatitude" REAL, 
-                    "apLongitude" REAL, 
-                    "apAltitude" REAL, 
-                    "apTime" INTEGER,
-                    "apVelocity" REAL,
-                    "apHeading" REAL,
-                    "apInvisible" INTEGER,
-                    "apInvisibleTime" INTEGER,
-                    "apSource" TEXT,
-                    CONSTRAINT unique_direction UNIQUE (apRegis, apSource),
-                    PRIMARY KEY ("apRegis", "apSource") );
-            """)
-
-with open(AUTH_FILE) as file:
-    content = json.loads(file.read())[SOURCE]
-    user = content["user"]
-    api_key = content["key"]
-
-conn = create_connection(DATABASE_PATH)
-query = lambda query_ : query_to_bdd(conn, FILENAME, query_)
-initialize_database(conn)
-conn.close()
-
-print_c("begin of the routine")
-
-headers = {
-    'Accept': 'application/json; charset=UTF-8',
-    user: api_key,
-}
-
-params = {
-    'query': f"{{> clock {int(time.time()) - 3600}}}",
-    'unique_flights': True,
-    'max_pages': 1
-}
-
-response = requests.get('https://aeroapi.flightaware.com/aeroapi/flights/search/positions', params=params, headers=headers)
-
-if response.status_code != 200:
-    print_c(f"ERROR: there was a problem during the request (statuscode: {response.status_code})")
-    print_c("anormal end of the routine")
-    exit()
-
-content = json.loads(response.text)
-
-# create a dict from the api data, indexed by they're licence number 
-airplane_data = to_dict_by_callsign(content["positions"], "fa_flight_id", "latitude", "longitude", "heading", "altitude", "groundspeed", "timestamp")
-
-# creates the database if it doesn't exist
-conn = create_connection(DATABASE_PATH)
-query = lambda text: query_to_bdd(conn, FILENAME, text)
-
-initialize_database(conn)
-
-new_airplane_c, updated_airplane_c, invisible_airplane_c = 0, 0, 0
-for airplane_name in airplane_data.keys():
-
-    wait_unlock_db(query, DATABASE_PATH, FILENAME, SOURCE)
-
-    unique_airplane = query(f"SELECT * FROM \"AIRPLANE\" WHERE apRegis = '{airplane_name}' AND apSource = '{SOURCE}';")
-    unique_airplane = True if len(unique_airplane.fetchall()) == 0 else False
-    tmp_airplane = airplane_data[airplane_name]
-
-    # if the airplane isn't in the database, we add it
-    if unique_airplane:
-        query(f"""
-                INSERT INTO "AIRPLANE" VALUES
-                ('{airplane_name}', '{tmp_airplane["latitude"]}', 
-                '{tmp_airplane["longitude"]}', '{tmp_airplane["altitude"]}', 
-                '{int(tmp_airplane["time"])}', '{tmp_airplane["velocity"]}',
-                '{tmp_airplane["heading"]}', '0', '0', '{SOURCE}');    
-            """)
-        new_airplane_c += 1
-    else:
-        # if it does exists, we update it 
-        # here we can see can we put apInvisible and apInivisibleTime 
-        # to 0, because if the airplane wasn't on radar for a small
-        # time, it will be registered as disappeared, but if it is 
-        # in the list, it is reachable by ADS-B, so it isn't
-        # invisible
-        query(f"""
-                        UPDATE "AIRPLANE"
-                        SET apLatitude = '{tmp_airplane["latitude"]}',
-                        apLongitude = '{tmp_airplane["longitude"]}',
-                        apAltitude = '{tmp_airplane["altitude"]}',
-                        apTime = '{tmp_airplane["time"]}',
-                        apHeading = '{tmp_airplane["heading"]}',
-                        apVelocity = '{tmp_airplane["velocity"]}',
-                        apInvisible = '0',
-                        apInvisibleTime = '0'
-                        WHERE apRegis = '{airplane_name}'
-                        AND apSource = '{SOURCE}';
-                    """)
-        updated_airplane_c += 1
-
-# if the airplane isn't to be seen by the ADS-B system,
-# it will be registered as invisible
-airplanes = query("SELECT apRegis, apSource FROM \"AIRPLANE\" WHERE apInvisible = '0';")
-for airplane in airplanes:
-    if airplane[1] == SOURCE: 
-        airplane_name = airplane[0]
-        if airplane_name not in airplane_data.keys():
-            query(f"""
-                            UPDATE "AIRPLANE"
-                            SET apInvisible = '1',
-                            apInvisibleTime = '{int(time.time())}'
-                            WHERE apRegis = '{airplane_name}'
-                            AND apSource = '{SOURCE}';
-                        """)
-            invisible_airplane_c += 1
-conn.close()
-
-print_c(f"new airplanes: {new_airplane_c}, updated airplanes: {updated_airplane_c}, new invisible airplanes: {invisible_airplane_c}")
-print_c("end of the routine")
-# it will pause 30 seconds, so we won't have any problem with the APIs
+    headers = {
+        'Accept': 'application/json; charset=UTF-8',
+        user: api_key,
+    }
+
+    if state is None:
+        state = {}
+    state["bytes"], state["latency"] = 0, 0
+    known_airplanes = state.setdefault("airplanes", {})
+    watermark = state.get("watermark")
+
+    now = int(time.time())
+    min_clock = now - WINDOW_TIME
+    if watermark is not None:
+        min_clock = max(min_clock, watermark - OVERLAP_TIME)
+    all_params = [{
+        'query': query,
+        'unique_flights': True,
+        'max_pages': MAX_PAGES_PER_REQUEST
+    } for query in build_queries(min_clock)]
+
+    end_time = time.monotonic() + TIME_BUDGET
+    airplane_data = {}
+    page_c = 0
+    # False if pages were skipped, so the watermark isn't moved
+    is_complete = True
+
+    executor = ThreadPoolExecutor(MAX_CONCURRENT_REQUESTS)
+    try:
+        pending = {executor.submit(session.get, API_URL + SEARCH_PATH, params=params, headers=headers, timeout=timeout)
+                    for params in all_params}
+        while len(pending) > 0:
+            done, pending = wait(pending, max(0, end_time - time.monotonic()), FIRST_COMPLETED)
+            if len(done) == 0:
+                print_c(f"the time budget ({TIME_BUDGET} seconds) is exceeded, {len(pending)} pages are skipped")
+                is_complete = False
+                break
+
+            for future in done:
+                response = future.result()
+                state["bytes"] += response.raw.tell()
+                state["latency"] += response.elapsed.total_seconds()
+                if response.status_code != 200:
+                    print_c(f"ERROR: there was a problem during the request (statuscode: {response.status_code})")
+                    return None
+                content = json.loads(response.text)
+                page_c += 1
+
+                # the pages are merged as they arrive, with the newest 
+                # position if an airplane is in two pages
+                for airplane in normalize_batch(normalize, content["positions"]).values():
+                    if airplane.regis not in airplane_data or airplane_data[airplane.regis].time < airplane.time:
+                        airplane_data[airplane.regis] = airplane
+
+                next_page = (content.get("links") or {}).get("next")
+                if next_page is None:
+                    continue
+                if page_c + len(pending) >= PAGE_BUDGET:
+                    print_c(f"the page budget ({PAGE_BUDGET} pages) is exceeded, the next pages are skipped")
+                    is_complete = False
+                    continue
+                pending.add(executor.submit(session.get, API_URL + next_page, headers=headers, timeout=timeout))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # the positions of the overlap that were already ingested are skipped
+    new_position_c = 0
+    for airplane in airplane_data.values():
+        known_airplane = known_airplanes.get(airplane.regis)
+        if known_airplane is None or known_airplane.time < airplane.time:
+            known_airplanes[airplane.regis] = airplane
+            new_position_c += 1
+    for regis in [regis for regis, airplane in known_airplanes.items() if airplane.time < now - WINDOW_TIME]:
+        del known_airplanes[regis]
+
+    if is_complete and len(airplane_data) > 0:
+        state["watermark"] = max(watermark or 0, max(airplane.time for airplane in airplane_data.values()))
+    print_c(f"{new_position_c} new positions since {time.strftime('%H:%M:%S', time.gmtime(min_clock))}")
+
+    return dict(known_airplanes)
+
+
+if __name__ == "__main__":
+    user, api_key = read_auth_api(AUTH_FILE, SOURCE)
+
+    print_c("begin of the routine")
+
+    airplane_data = fetch_airplanes(requests.Session(), user, api_key)
+    if airplane_data is None:
+        print_c("anormal end of the routine")
+        exit()
+
+    # creates the database if it doesn't exist, or upgrades it
+    conn = create_connection(DATABASE_PATH)
+    migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+
+    # all airplanes are written in one transaction, and the airplanes that 
+    # aren't to be seen by the ADS-B system anymore are registered as 
+    # invisible
+    history = HistoryStore.load()
+    new_airplane_c, updated_airplane_c, invisible_airplane_c, skipped_airplane_c = upsert_airplanes(conn, FILENAME, SOURCE, airplane_data, 
+                                                                                                     history=history)
+    history.save()
+    conn.close()
+
+    print_c(f"new airplanes: {new_airplane_c}, updated airplanes: {updated_airplane_c}, new invisible airplanes: {invisible_airplane_c}, unchanged airplanes: {skipped_airplane_c}")
+    print_query_summary(FILENAME)
+    print_c("end of the routine")
@@ -11,6 +11,10 @@ import time
 import os
 import requests
 from functions import *
+from schema import AIRPLANE_MIGRATIONS, migrate
+from position_history import HistoryStore
+from operations_area import load_areas, compile_area_filter
+from normalizer import compile_normalizer, normalize_batch, normalize_stream, iter_json_array
 
 # path to the database
 DATABASE_PATH = "airplane.db"
@@ -19,209 +23,192 @@ SOURCE = "JetVision"
 AUTH_FILE = "auth_api.json"
 FILENAME = os.path.basename(__file__)
 
+# fields of an airplane in the API response, and their units
+FIELDS = {"regis": "reg", "latitude": "lat", "longitude": "lon", "heading": "trk",
+          "altitude": "alt", "velocity": "spd", "time": "uti", "icao": "hex"}
+UNITS = {"altitude": "ft", "velocity": "kt", "time": "unix"}
+# size of the chunks read from the response, in streaming mode (in bytes)
+CHUNK_SIZE = 64 * 1024
+# maximum time to receive the whole response, when this program runs
+# alone (in seconds)
+TIMEOUT = 20
+
 print_c = lambda text : print_context(FILENAME, text)
 
+normalize = compile_normalizer(FIELDS, UNITS, area_filter=compile_area_filter(load_areas()))
 
 
-def to_dict_by_callsign(airplane_list: list, callsign: str, 
-                        latitude: int, longitude: int, 
-                        heading: int, geo_altitude: int,
-                        velocity: int, airplane_time: int, 
-                        ) -> dict:
+def remember_response(response: requests.Response, state: dict) -> None:
     """
-Returns a formated dictionary of airplanes, with they're callsign as key
+Keeps the validators (ETag and Last-Modified) of a response that was 
+entirely read, so the next request is only answered if the list 
+changed, and the number of bytes transferred
 
 Parameters
 ----------
-airplane_list : list
-    List of all airplanes
-callsign : str or int
-    Key or index to the callsign value
-latitude : str or int
-    Key or index to the latitude value
-longitude : str or int
-    Key or index to the longitude value
-heading : str or int
-    Key or index to the heading/direction value
-geo_altitude : str or int
-    Key or index to the altitude value
-velocity : str or int
-    Key or index to the velocity/speed value
-airplane_time : str or int
-    Key or index to the time value of the last contact
-
-Returns
--------
-dict
-    Formated list of all airplane, with they're callsign as key
+response : requests.Response
+    Response of the API
+state : dict
+    State of the source, kept between two calls
     """
-    new_dict = {}
-    for i in airplane_list:
-
+    state["bytes"] = response.raw.tell()
+    for header, key in (("ETag", "etag"), ("Last-Modified", "last_modified")):
+        if header in response.headers:
+            state[key] = response.headers[header]
+        else:
+            state.pop(key, None)
 
-        # in this part, we are going to see if all the data is available
-        latitude_value = i[latitude] if not isinstance(i[latitude], str) else eval(i[latitude])
-        longitude_value = i[longitude] if not isinstance(i[longitude], str) else eval(i[longitude])
-        if isinstance(latitude_value, type(None)) or \
-                isinstance(longitude_value, type(None)):
-            continue
 
-        heading_value = i[heading] if not isinstance(i[heading], str) else eval(i[heading])
-        if isinstance(heading_value, type(None)) :
-            continue
+def chunks_before(chunks, deadline: float):
+    """
+Yields the chunks of a response, and raises a Timeout if the response
+isn't entirely received at deadline (time.monotonic() time, None for no
+deadline): the timeout of the request is only the maximum time between
+two chunks
+    """
+    for chunk in chunks:
+        if deadline is not None and time.monotonic() > deadline:
+            raise requests.exceptions.Timeout("the aircraft list wasn't received before the deadline")
+        yield chunk
 
-        geo_altitude_value = i[geo_altitude] if not isinstance(i[geo_altitude], str) else eval(i[geo_altitude])
-        if isinstance(geo_altitude_value, type(None)):
-            continue
-        geo_altitude_value *= 0.3048    # to convert from feet to meters
 
-        velocity_value = i[velocity] if not isinstance(i[velocity], str) else eval(i[velocity])
-        if isinstance(velocity_value, type(None)):
-            continue
-        velocity_value *= 0.5144        # to convert from knots to meter per seconds
+def read_stream(response: requests.Response, state: dict, deadline: float) -> list:
+    """
+Reads the response by chunks, and parses the airplanes while they are
+received, so the raw response is never kept entirely in memory. The
+Position of all airplanes are kept until the whole response is received
 
+Parameters
+----------
+response : requests.Response
+    Response of the API, requested with stream=True
+state : dict
+    State of the source, kept between two calls
+deadline : float
+    Time (of time.monotonic()) when the whole response has to be
+received, or None
 
-        # time is the only data that we can put by ourselves
-        airplane_time_value = i[airplane_time]
-        if isinstance(airplane_time_value, type(None)):
-            airplane_time_value = int(time.time())
+Returns
+-------
+list
+    Position of each complete airplane (see normalizer.py)
+    """
+    response.encoding = response.encoding or "utf-8"
+    try:
+        chunks = chunks_before(response.iter_content(CHUNK_SIZE, decode_unicode=True), deadline)
+        airplanes = list(normalize_stream(normalize, iter_json_array(chunks)))
 
-        if isinstance(i[callsign], type(None)):
-            continue
+        # the end of the response is read, so the connection can be reused
+        for _ in chunks:
+            pass
+        remember_response(response, state)
+    finally:
+        response.close()
 
-        i[callsign] = i[callsign].replace("-", "")
-        new_dict[i[callsign].strip()] = {"latitude": latitude_value, 
-                                            "longitude": longitude_value,
-                                            "heading": heading_value, 
-                                            "altitude": geo_altitude_value, 
-                                            "velocity": velocity_value, 
-                                            "time": airplane_time_value}
+    return airplanes
 
-    return new_dict
 
-def initialize_database(conn: sqlite3.Connection) -> None:
+def fetch_airplanes(session: requests.Session, user: str, api_key: str, timeout: float=None, 
+                    stream: bool=False, state: dict=None): #dict|list|None
     """
-Creates the table AIRPLANE, if it doesn't exist
+Requests the airplanes detected by the JetVision API. The response is
+requested compressed, and if the previous response had validators, 
+the API only answers if the list changed since then
+
+Parameters
+----------
+session : requests.Session
+    Session used to make the request, so the connection can be kept 
+alive between two calls
+user : str
+    Username of the API
+api_key : str
+    Password of the API
+timeout : float, optional
+    Maximum time (in seconds) to wait for the response (in streaming
+mode, to receive the whole response)
+stream : bool, optional
+    If true, the response is read by chunks, and the airplanes are 
+parsed one at a time while they are received (only the raw response is
+bounded in memory, the Position of all airplanes are returned at once)
+state : dict, optional
+    State of the source, kept between two calls (the validators of the
+last response). The bytes transferred and the latency of the request 
+are written in it
+
+Returns
+-------
+dict, list or None
+    Position of all airplanes (see normalizer.py), with they're callsign 
+as key, or a list of Position in streaming mode, or None if the request
+failed or the list didn't change
     """
-    table_exists = query("SELECT count(name) FROM sqlite_master WHERE type = 'table' AND name = 'AIRPLANE';").fetchall()
-    if table_exists[0][0] == 0:
-        # we have the basic parameters of a airplane (registration 
-        # name, coordinate, altitude, speed and heading) qnd three more
-        # aspects : when it was last seen, if it is invisible, and since
-        # when it's invisible
-        query("""
-                CREATE TABLE "AIRPLANE" ( 
-                    "apRegis" TEXT NOT NULL, 
-                    "apLatitude" REAL, 
-                    "apLongitude" REAL, 
-                    "apAltitude" REAL, 
-                    "apTime" INTEGER,
-                    "apVelocity" REAL,
-                    "apHeading" REAL,
-                    "apInvisible" INTEGER,
-                    "apInvisibleTime" INTEGER,
-                    "apSource" TEXT,
-                    CONSTRAINT unique_direction UNIQUE (apRegis, apSource),
-                    PRIMARY KEY ("apRegis", "apSource") );
-            """)
-
-with open(AUTH_FILE) as file:
-    content = json.loads(file.read())[SOURCE]
-    user = content["user"]
-    api_key = content["key"]
-
-conn = create_connection(DATABASE_PATH)
-query = lambda query_ : query_to_bdd(conn, FILENAME, query_)
-initialize_database(conn)
-conn.close()
-
-
-print_c("begin of the routine")
-
-headers = {
-    'Accept': 'application/json; charset=UTF-8',
-}
-
-auth = (user, api_key)
-
-response = requests.get('https://mlat.jetvision.de/mlat/aircraftlist.json', headers=headers, auth=auth)
-
-if response.status_code != 200:
-    print_c("ERROR: there was a problem during the request (statuscode: {response.status_code})")
-    print_c("anormal end of the routine")
-    exit()
-
-content = json.loads(response.text)
-
-# create a dict from the api data, indexed by they're licence number 
-airplane_data = to_dict_by_callsign(content, "reg", "lat", "lon", "trk", "alt", "spd", "uti")
-
-# creates the database if it doesn't exist
-conn = create_connection(DATABASE_PATH)
-query = lambda query_ : query_to_bdd(conn, FILENAME, query_)
-
-initialize_database(conn)
-
-new_airplane_c, updated_airplane_c, invisible_airplane_c = 0, 0, 0
-for airplane_name in airplane_data.keys():
-
-    wait_unlock_db(query, DATABASE_PATH, FILENAME, SOURCE)
-
-    unique_airplane = query(f"SELECT * FROM \"AIRPLANE\" WHERE apRegis = '{airplane_name}' AND apSource = '{SOURCE}';")
-    unique_airplane = True if len(unique_airplane.fetchall()) == 0 else False
-    tmp_airplane = airplane_data[airplane_name]
-
-    # if the airplane isn't in the database, we add it
-    if unique_airplane:
-        query(f"""
-                INSERT INTO "AIRPLANE" VALUES
-                ('{airplane_name}', '{tmp_airplane["latitude"]}', 
-                '{tmp_airplane["longitude"]}', '{tmp_airplane["altitude"]}', 
-                '{int(tmp_airplane["time"])}', '{tmp_airplane["velocity"]}',
-                '{tmp_airplane["heading"]}', '0', '0', '{SOURCE}');
-            """)
-        new_airplane_c += 1
-    else:
-        # if it does exists, we update it 
-        # here we can see can we put apInvisible and apInivisibleTime 
-        # to 0, because if the airplane wasn't on radar for a small
-        # time, it will be registered as disappeared, but if it is 
-        # in the list, it is reachable by ADS-B, so it isn't
-        # invisible
-        query(f"""
-                UPDATE "AIRPLANE"
-                SET apLatitude = '{tmp_airplane["latitude"]}',
-                apLongitude = '{tmp_airplane["longitude"]}',
-                apAltitude = '{tmp_airplane["altitude"]}',
-                apTime = '{tmp_airplane["time"]}',
-                apHeading = '{tmp_airplane["heading"]}',
-                apVelocity = '{tmp_airplane["velocity"]}',
-                apInvisible = '0',
-                apInvisibleTime = '0'
-                WHERE apRegis = '{airplane_name}'
-                AND apSource = '{SOURCE}';
-            """)
-        updated_airplane_c += 1
-        
-
-# if the airplane isn't to be seen by the ADS-B system,
-# it will be registered as invisible
-airplanes = query("SELECT apRegis, apSource FROM \"AIRPLANE\" WHERE apInvisible = '0';")
-for airplane in airplanes:
-    if airplane[1] == SOURCE: 
-        airplane_name = airplane[0]
-        if airplane_name not in airplane_data.keys():
-            wait_unlock_db(query, DATABASE_PATH, FILENAME)
-            query(f"""
-                    UPDATE "AIRPLANE"
-                    SET apInvisible = '1',
-                    apInvisibleTime = '{int(time.time())}'
-                    WHERE apRegis = '{airplane_name}'
-                    AND apSource = '{SOURCE}';
-                """)
-            invisible_airplane_c += 1
-conn.close()
-
-print_c(f"new airplanes: {new_airplane_c}, updated airplanes: {updated_airplane_c}, new invisible airplanes: {invisible_airplane_c}")
-print_c("end of the routine")
-# it will pause 30 seconds, so we won't have any problem with the APIs
+    if state is None:
+        state = {}
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    headers = {
+        'Accept': 'application/json; charset=UTF-8',
+        'Accept-Encoding': 'gzip',
+    }
+    if "etag" in state:
+        headers["If-None-Match"] = state["etag"]
+    if "last_modified" in state:
+        headers["If-Modified-Since"] = state["last_modified"]
+
+    auth = (user, api_key)
+
+    response = session.get('https://mlat.jetvision.de/mlat/aircraftlist.json', headers=headers, 
+                            auth=auth, timeout=timeout, stream=stream)
+    state["latency"] = response.elapsed.total_seconds()
+    state["bytes"] = 0
+
+    if response.status_code == 304:
+        print_c("the aircraft list didn't change since the last request")
+        response.close()
+        return None
+
+    if response.status_code != 200:
+        print_c(f"ERROR: there was a problem during the request (statuscode: {response.status_code})")
+        response.close()
+        return None
+
+    if stream:
+        # the airplanes are parsed while the response is received, but
+        # only written once it is entirely received, so a slow response
+        # never keeps the database (or the live state) locked
+        return read_stream(response, state, deadline)
+
+    content = json.loads(response.text)
+    remember_response(response, state)
+
+    # create a dict from the api data, indexed by they're licence number 
+    return normalize_batch(normalize, content)
+
+
+if __name__ == "__main__":
+    user, api_key = read_auth_api(AUTH_FILE, SOURCE)
+
+    print_c("begin of the routine")
+
+    airplane_data = fetch_airplanes(requests.Session(), user, api_key, TIMEOUT, stream=True)
+    if airplane_data is None:
+        print_c("anormal end of the routine")
+        exit()
+
+    # creates the database if it doesn't exist, or upgrades it
+    conn = create_connection(DATABASE_PATH)
+    migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+
+    # all airplanes are written in one transaction, and the airplanes 
+    # that aren't to be seen by the ADS-B system anymore are registered
+    # as invisible
+    history = HistoryStore.load()
+    new_airplane_c, updated_airplane_c, invisible_airplane_c, skipped_airplane_c = upsert_airplanes(conn, FILENAME, SOURCE, airplane_data, 
+                                                                                                     history=history)
+    history.save()
+    conn.close()
+
+    print_c(f"new airplanes: {new_airplane_c}, updated airplanes: {updated_airplane_c}, new invisible airplanes: {invisible_airplane_c}, unchanged airplanes: {skipped_airplane_c}")
+    print_query_summary(FILENAME)
+    print_c("end of the routine")
@@ -0,0 +1,280 @@
+"""
+With this program, you can detect airplanes with a local ADS-B
+receiver, that sends the messages it decodes in the SBS-1 (BaseStation)
+format: lines of text on a TCP port (30003 for dump1090).
+The messages of an airplane are merged as they arrive, so each airplane
+always has its last known position, altitude, speed and heading, and
+is written with the name of the receiver as source.
+With ingestion_daemon.py, the receiver is read in the background, and
+its state is taken at each cycle (of a few seconds). Alone, this
+program listens to the receiver for LISTEN_TIME seconds, or replays a
+recorded stream with: python3 get_airplane_sbs.py <file>
+"""
+
+import os
+import socket
+import sys
+import threading
+import time
+import requests
+from calendar import timegm
+from datetime import datetime
+from functions import *
+from schema import AIRPLANE_MIGRATIONS, migrate
+from position_history import HistoryStore
+from operations_area import load_areas, compile_area_filter
+from normalizer import compile_normalizer, normalize_batch
+
+# path to the database
+DATABASE_PATH = "airplane.db"
+# name of the receiver, written as source of its airplanes
+SOURCE = "Receiver"
+# address of the SBS stream of the receiver
+HOST = "127.0.0.1"
+PORT = 30003
+FILENAME = os.path.basename(__file__)
+# time that this program listens to the receiver, when it runs alone
+# (in seconds)
+LISTEN_TIME = 30
+# an airplane without message since STALE_TIME seconds isn't detected
+# anymore by the receiver
+STALE_TIME = 30
+# time before reconnecting to the receiver (in seconds)
+RECONNECT_TIME = 10
+
+# index of the values in a MSG line
+HEX_IDENT = 4
+DATE_LOGGED, TIME_LOGGED = 8, 9
+SBS_FIELDS = {"callsign": 10, "altitude": 11, "velocity": 12, "heading": 13,
+              "latitude": 14, "longitude": 15}
+UNITS = {"altitude": "ft", "velocity": "kt", "time": "unix"}
+
+print_c = lambda text : print_context(FILENAME, text)
+
+normalize = compile_normalizer({key: key for key in (*SBS_FIELDS, "time", "icao")} | {"regis": "callsign"},
+                               UNITS, area_filter=compile_area_filter(load_areas()))
+
+
+def parse_message(line: str, airplanes: dict, now: float=None) -> bool:
+    """
+Merges a line of the SBS stream in the state of its airplane
+
+Parameters
+----------
+line : str
+    Line of the stream
+airplanes : dict
+    State of the airplanes, with they're ICAO address as key
+now : float, optional
+    Time of the reception of the line (unix timestamp). If None, the
+time logged in the line (in UTC) is used (for a replay)
+
+Returns
+-------
+bool
+    True if the line is a valid MSG line
+    """
+    fields = line.strip().split(",")
+    if len(fields) <= SBS_FIELDS["longitude"] or fields[0] != "MSG" or fields[HEX_IDENT] == "":
+        return False
+
+    if now is None:
+        # the receivers log the time in UTC
+        try:
+            now = timegm(datetime.strptime(f"{fields[DATE_LOGGED]} {fields[TIME_LOGGED]}",
+                                           "%Y/%m/%d %H:%M:%S.%f").timetuple())
+        except ValueError:
+            return False
+
+    airplane = airplanes.get(fields[HEX_IDENT])
+    if airplane is None:
+        airplane = airplanes[fields[HEX_IDENT]] = dict.fromkeys((*SBS_FIELDS, "time", "seen"))
+        airplane["icao"] = fields[HEX_IDENT]
+    # each type of message only has some of the values
+    for key, index in SBS_FIELDS.items():
+        if fields[index] != "":
+            airplane[key] = fields[index].strip()
+    if fields[SBS_FIELDS["latitude"]] != "":
+        airplane["time"] = int(now)
+    airplane["seen"] = now
+
+    return True
+
+
+def snapshot(airplanes: dict, now: float) -> dict:
+    """
+Forgets the airplanes that weren't seen since STALE_TIME seconds, and
+normalizes the others
+
+Parameters
+----------
+airplanes : dict
+    State of the airplanes, with they're ICAO address as key
+now : float
+    Time of the snapshot (unix timestamp)
+
+Returns
+-------
+dict
+    Position of all complete airplanes (see normalizer.py), with they're
+callsign as key
+    """
+    for hex_ident in [hex_ident for hex_ident, airplane in airplanes.items()
+                        if airplane["seen"] < now - STALE_TIME]:
+        del airplanes[hex_ident]
+
+    return normalize_batch(normalize, airplanes.values())
+
+
+class SbsReceiver:
+    """
+Reads the SBS stream of a receiver in a background thread, and
+reconnects to it if the connection is lost
+    """
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.airplanes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.connected = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port), RECONNECT_TIME) as sock:
+                    # a receiver always sends something, a silence means
+                    # that the connection is lost
+                    sock.settimeout(STALE_TIME)
+                    self.connected.set()
+                    print_c(f"connected to the receiver {self.host}:{self.port}")
+                    # the lines are parsed as soon as they are received
+                    for line in sock.makefile("r", encoding="ascii", errors="replace"):
+                        with self.lock:
+                            self.bytes += len(line)
+                            parse_message(line, self.airplanes, time.time())
+                print_context(FILENAME, f"Error: the receiver {self.host}:{self.port} closed the connection", True)
+            except OSError as e:
+                print_context(FILENAME, f"Error: '{e}' with the receiver {self.host}:{self.port}", True)
+            self.connected.clear()
+            time.sleep(RECONNECT_TIME)
+
+    def snapshot(self, state: dict) -> dict:
+        """
+Returns the airplanes detected by the receiver (see snapshot), and
+writes the bytes received since the last call in the state
+        """
+        now = time.time()
+        with self.lock:
+            airplane_data = snapshot(self.airplanes, now)
+            state["bytes"], self.bytes = self.bytes, 0
+            last_seen = max((airplane["seen"] for airplane in self.airplanes.values()), default=now)
+        # the latency is the age of the last message
+        state["latency"] = now - last_seen
+
+        return airplane_data
+
+
+def fetch_airplanes(session: requests.Session, user: str, api_key: str, timeout: float=None, state: dict=None,
+                    host: str=HOST, port: int=PORT) -> dict: #|None
+    """
+Returns the airplanes detected by the receiver. The first call starts
+to read the receiver in the background (the reader is kept in the
+state)
+
+Parameters
+----------
+session : requests.Session
+    Unused, the receiver isn't an HTTP API
+user : str
+    Unused, the receiver doesn't need an authentification
+api_key : str
+    Unused
+timeout : float, optional
+    Maximum time (in seconds) to wait for the connection to the receiver
+state : dict, optional
+    State of the source, kept between two calls. The bytes received and
+the age of the last message are written in it
+host : str, optional
+    Address of the receiver
+port : int, optional
+    Port of the SBS stream of the receiver
+
+Returns
+-------
+dict or None
+    Position of all airplanes (see normalizer.py), with they're callsign
+as key, or None if the receiver isn't connected
+    """
+    if state is None:
+        state = {}
+
+    receiver = state.get("receiver")
+    if receiver is None:
+        receiver = state["receiver"] = SbsReceiver(host, port)
+        receiver.start()
+
+    if not receiver.connected.wait(timeout or 0):
+        print_c(f"ERROR: the receiver {host}:{port} isn't connected")
+        return None
+
+    return receiver.snapshot(state)
+
+
+def replay(path: str) -> dict:
+    """
+Replays a recorded SBS stream, with the time logged in its lines
+
+Parameters
+----------
+path : str
+    Path to the recorded stream
+
+Returns
+-------
+dict
+    Position of the airplanes detected at the end of the stream (see
+normalizer.py), with they're callsign as key
+    """
+    airplanes = {}
+    with open(path, encoding="ascii", errors="replace") as file:
+        for line in file:
+            parse_message(line, airplanes)
+
+    return snapshot(airplanes, max((airplane["seen"] for airplane in airplanes.values()), default=0))
+
+
+if __name__ == "__main__":
+    print_c("begin of the routine")
+
+    if len(sys.argv) > 1:
+        airplane_data = replay(sys.argv[1])
+    else:
+        receiver = SbsReceiver(HOST, PORT)
+        receiver.start()
+        time.sleep(LISTEN_TIME)
+        airplane_data = receiver.snapshot({}) if receiver.connected.is_set() else None
+    if airplane_data is None:
+        print_c("anormal end of the routine")
+        exit()
+
+    # creates the database if it doesn't exist, or upgrades it
+    conn = create_connection(DATABASE_PATH)
+    migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+
+    # all airplanes are written in one transaction, and the airplanes
+    # that aren't to be seen by the receiver anymore are registered as
+    # invisible
+    history = HistoryStore.load()
+    new_airplane_c, updated_airplane_c, invisible_airplane_c, skipped_airplane_c = upsert_airplanes(conn, FILENAME, SOURCE, airplane_data,
+                                                                                                     history=history)
+    history.save()
+    conn.close()
+
+    print_c(f"new airplanes: {new_airplane_c}, updated airplanes: {updated_airplane_c}, new invisible airplanes: {invisible_airplane_c}, unchanged airplanes: {skipped_airplane_c}")
+    print_query_summary(FILENAME)
+    print_c("end of the routine")
@@ -11,9 +11,12 @@ import json
 import time
 import os
 from functions import *
+from db_writer import write
 from json import JSONDecodeError
 from airplane_zone import create_zone
 from in_polygon import is_inside_polygon
+from position_history import HistoryStore
+from spatial import AirportIndex
 
 MAXIMUM_ALTITUDE = 1000     # in meters
 # database, where the airplanes are registered
@@ -66,16 +69,19 @@ list
 """
     conn = create_connection(file, False)
     query = lambda query_ : query_to_bdd(conn, FILENAME, query_)
-    wait_unlock_db(query, file, FILENAME)
     
     airplanes = query("SELECT * FROM \"INVISIBLE_AIRPLANE\" WHERE 1;")
 
     airplanes = airplanes.fetchall() if not isinstance(airplanes, type(None)) and airplanes else []
 
-    query("DELETE FROM \"INVISIBLE_AIRPLANE\" WHERE 1;")
+    # only the airplanes that were read are deleted, so an airplane 
+    # registered in between isn't lost (and if they can't be deleted, 
+    # they will be read the next time)
+    is_deleted = write(file, conn, FILENAME, [("DELETE FROM \"INVISIBLE_AIRPLANE\" WHERE apRegis = ? AND apTime = ?;",
+                                                [(airplane[0], airplane[4]) for airplane in airplanes])])
     
     conn.close()
-    return airplanes
+    return airplanes if is_deleted else []
 
 
 def format_airplanes(airplane_list: list) -> list:
@@ -92,7 +98,7 @@ Returns
 list
     List of dictionnaries of airplanes
     """
-    keys = ("callname", "latitude", "longitude", "altitude", "last_contact", "velocity", "heading", "invisible", "invisible_time")
+    keys = ("callname", "latitude", "longitude", "altitude", "last_contact", "velocity", "heading", "invisible_time", "icao")
     new_list = []
     for airplane in airplane_list:
         tmp_airplane = {}
@@ -128,6 +134,8 @@ with open(AUTH_AVDB_FILE) as file:
 response = requests.get("https://avdb.aerops.com/public/airports", auth=(avdb_user, avdb_password))
 airports = json.loads(response.text)["data"]
 airports = filter_airports(airports)
+# only the airports in the box of a zone are tested with the zone
+airport_index = AirportIndex(airports)
 
 
 print_c("begin of the routine")
@@ -136,6 +144,9 @@ print_c("begin of the routine")
 airplanes = format_airplanes(get_airplanes(AIRPLANE_DATABASE))
 print_c(f"number of new invisible airplane: {len(airplanes)}")
 
+# the last fixes of the airplanes, written by the ingestion
+history = HistoryStore.load()
+
 airport_in_zone = {}
 for airplane in airplanes:
     # we verify that the data can be interpreted, if not, it will be skipped
@@ -149,13 +160,19 @@ for airplane in airplanes:
         continue
 
     if airplane["altitude"] < MAXIMUM_ALTITUDE:
+        airplane_history = history.get(airplane["callname"])
+        descent_rate = airplane_history.descent_rate() if airplane_history else None
+        speed_trend = airplane_history.speed_trend() if airplane_history else None
+
         # create the zone on which the airplane can land
         airplane_zone = create_zone((airplane["latitude"], 
                                     airplane["longitude"]),
                                     airplane["altitude"],
                                     airplane["velocity"],
-                                    airplane["heading"])
-        for airport in airports:
+                                    airplane["heading"],
+                                    descent_rate,
+                                    speed_trend)
+        for airport in airport_index.in_box(airplane_zone):
             airport_coords = (float(airport["latitude"]), float(airport["longitude"]))
             if is_inside_polygon(airplane_zone, airport_coords):
                 # add the airplane as key if it is not already
@@ -165,6 +182,7 @@ for airplane in airplanes:
                                                                 "longitude": airplane["longitude"]
                                                                 },
                                                             "last_contact": airplane["last_contact"],
+                                                            "icao": airplane.get("icao"),
                                                             "airport": []
                                                             }
                 # add the airport, if it is possible to the airplane to 
@@ -189,4 +207,5 @@ output_data = {
 with open(OUTPUT_FILE, "w+") as file:
     file.write(json.dumps(output_data, indent=2))
 
+print_query_summary(FILENAME)
 print_c("end of the routine")
@@ -0,0 +1,242 @@
+"""
+This program is a long-running ingestion service for the get_airplane
+programs.
+Instead of starting a new process for each call, it keeps one event
+loop, and for each source a session (so the HTTPS connection is kept
+alive) that is polled with its own cycle time and timeout. All sources
+are polled concurrently, so a slow source never delays the others.
+The airplanes are kept in memory (see live_state.py), where the checks
+of check_airplanes.py run every CHECK_TIME seconds, and the AIRPLANE 
+table is only a snapshot, written every SNAPSHOT_TIME seconds (with the
+position history), so the live path never waits for the database. An
+error of a source is printed, and the source is polled again at its
+next cycle, so it never stops the daemon.
+
+If you want to add a source, you have to write it in the CONFIG_PATH
+file, the module of the source needs a fetch_airplanes function (see
+get_airplane_jetvision.py), that accepts the state of the source. A
+local receiver (see get_airplane_sbs.py) is added in the same way, with
+a short cycle time, for instance:
+"Receiver": {"module": "get_airplane_sbs", "cycle_time": 5, "timeout": 5,
+             "auth": false, "options": {"host": "127.0.0.1", "port": 30003}}
+"""
+
+import asyncio
+import importlib
+import json
+import os
+import pickle
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from functions import *
+from schema import AIRPLANE_MIGRATIONS, migrate
+from position_history import HISTORY_FILE, HistoryStore
+from live_state import LiveState
+import check_airplanes
+
+# this file is where the sources that need to be polled are written
+# in this format:
+# {
+#   <source>: {
+#       "module": <module_name>,
+#       "cycle_time": <cycle_seconds>,
+#       "timeout": <timeout_seconds>,
+#       "stream": <true/false, optional>,
+#       "auth": <false if the source doesn't need the auth file, optional>,
+#       "options": <arguments of its fetch_airplanes, optional>
+#   },
+CONFIG_PATH = "ingestion.json"
+# path to the database
+DATABASE_PATH = "airplane.db"
+AUTH_FILE = "auth_api.json"
+FILENAME = os.path.basename(__file__)
+# time between two checks of the airplanes (see check_airplanes.py), and
+# between two snapshots of the live state in the database (in seconds)
+CHECK_TIME = 100
+SNAPSHOT_TIME = 60
+
+print_c = lambda text : print_context(FILENAME, text)
+
+
+async def poll_source(source: str, config: dict, live: LiveState, state_lock: asyncio.Lock, 
+                      history: HistoryStore) -> None:
+    """
+Polls a source forever, and writes each snapshot in the live state
+
+Parameters
+----------
+source : str
+    Name of the source (api), as written in the auth file
+config : dict
+    Configuration of the source (see CONFIG_PATH)
+live : LiveState
+    Live state of the airplanes, shared by all sources
+state_lock : asyncio.Lock
+    Lock so only one task uses the live state at a time
+history : HistoryStore
+    Position history of the airplanes, shared by all sources
+    """
+    module = importlib.import_module(config["module"])
+    user, api_key = None, None
+    if config.get("auth", True):
+        try:
+            user, api_key = read_auth_api(AUTH_FILE, source)
+        except (FileNotFoundError, KeyError):
+            print_context(FILENAME, f"Error: no auth for {source} in {AUTH_FILE}, it won't be polled", True)
+            return
+
+    # the session keeps the connection alive between two cycles
+    session = requests.Session()
+    # in streaming mode, the response is parsed while it is received (in
+    # the thread of the request, so within its timeout)
+    fetch_kwargs = dict(config.get("options", {}))
+    if config.get("stream", False):
+        fetch_kwargs["stream"] = True
+    # the state of the source is kept between two cycles (validators of
+    # the last response, ...), with the counters of the last cycle
+    state = {}
+    # the requests of the source run in its own thread, so a request that
+    # still hangs after its timeout never fills the default executor of
+    # the event loop
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=source)
+    fetch = None
+
+    while True:
+        begin_time = time.monotonic()
+        # the state of the source is used by the request, so no request
+        # begins before the last one ends
+        if fetch is not None and not fetch.done():
+            print_context(FILENAME, f"Error: the last request to {source} is still running, its cycle is skipped", True)
+            await asyncio.sleep(config["cycle_time"])
+            continue
+        state.pop("bytes", None)
+        fetch = executor.submit(module.fetch_airplanes, session, user, api_key, config["timeout"],
+                                state=state, **fetch_kwargs)
+        try:
+            airplane_data = await asyncio.wait_for(asyncio.wrap_future(fetch), config["timeout"])
+        except asyncio.TimeoutError:
+            print_context(FILENAME, f"Error: {source} didn't answer in {config['timeout']} seconds", True)
+            airplane_data = None
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print_context(FILENAME, f"Error: '{e}' during the request to {source}", True)
+            airplane_data = None
+        except Exception as e:
+            # an unexpected response (or error) of a source only skips its
+            # cycle
+            print_context(FILENAME, f"Error: {type(e).__name__} '{e}' during the request to {source}", True)
+            airplane_data = None
+
+        if airplane_data is not None:
+            try:
+                # the response is entirely received, so the live state is
+                # only locked for the update
+                async with state_lock:
+                    new_airplane_c, updated_airplane_c, invisible_airplane_c, skipped_airplane_c = await asyncio.to_thread(
+                        live.update, source, airplane_data, int(time.time()), history)
+                print_c(f"{source}: new airplanes: {new_airplane_c}, updated airplanes: {updated_airplane_c}, new invisible airplanes: {invisible_airplane_c}, unchanged airplanes: {skipped_airplane_c}")
+            except Exception as e:
+                print_context(FILENAME, f"Error: {type(e).__name__} '{e}' in the airplanes of {source}", True)
+        if "bytes" in state:
+            print_c(f"{source}: {state['bytes']} bytes transferred, request latency: {state['latency']:.2f} seconds")
+
+        # the cycle time is counted from the beginning of the request, so
+        # the time of the request doesn't shift the cycle
+        await asyncio.sleep(max(0, config["cycle_time"] - (time.monotonic() - begin_time)))
+
+
+async def check_live_state(conn: sqlite3.Connection, live: LiveState, state_lock: asyncio.Lock, 
+                           history: HistoryStore) -> None:
+    """
+Runs the checks of check_airplanes.py on the live state every 
+CHECK_TIME seconds, and registers the airplanes that could have landed
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the airplane database
+live : LiveState
+    Live state of the airplanes
+state_lock : asyncio.Lock
+    Lock so only one task uses the live state at a time
+history : HistoryStore
+    Position history of the airplanes
+    """
+    while True:
+        await asyncio.sleep(CHECK_TIME)
+        async with state_lock:
+            invisible_landings, slow_landings = live.resolve(int(time.time()), check_airplanes.DELAY_INVISIBLE,
+                                                             check_airplanes.DELAY_DELETE,
+                                                             check_airplanes.MIN_VELOCITY)
+            save_data_list = await asyncio.to_thread(check_airplanes.register_landings, conn, invisible_landings,
+                                                     False, history)
+            save_data_list += await asyncio.to_thread(check_airplanes.register_landings, conn, slow_landings,
+                                                      True, history)
+        await asyncio.to_thread(check_airplanes.save_landings, save_data_list)
+        print_c(f"new possible landings: {len(save_data_list)}")
+
+
+async def snapshot_live_state(conn: sqlite3.Connection, live: LiveState, state_lock: asyncio.Lock, 
+                              history: HistoryStore) -> None:
+    """
+Writes the live state in the AIRPLANE table, and the position history in
+its file, every SNAPSHOT_TIME seconds
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the airplane database
+live : LiveState
+    Live state of the airplanes
+state_lock : asyncio.Lock
+    Lock so only one task uses the live state at a time
+history : HistoryStore
+    Position history of the airplanes
+    """
+    while True:
+        await asyncio.sleep(SNAPSHOT_TIME)
+        async with state_lock:
+            written_c, deleted_c = await asyncio.to_thread(live.snapshot, conn, FILENAME, int(time.time()),
+                                                              DATABASE_PATH)
+            # the history is only serialized with the lock, the file is
+            # written without it
+            history_content = await asyncio.to_thread(pickle.dumps, history)
+        await asyncio.to_thread(history.save, HISTORY_FILE, history_content)
+        print_c(f"snapshot: written airplanes: {written_c}, deleted airplanes: {deleted_c}")
+        # the queries of the daemon since the last snapshot
+        print_query_summary(FILENAME)
+
+
+async def main() -> None:
+    """
+Initializes the database and the live state once, and polls all 
+sources concurrently
+    """
+    with open(CONFIG_PATH) as file:
+        sources = json.loads(file.read())
+
+    # the connection is used by the threads of the event loop, but only
+    # one at a time (see state_lock)
+    conn = create_connection(DATABASE_PATH, False)
+    migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+
+    # the live state restarts from the last snapshot
+    live = LiveState()
+    live.load(conn, FILENAME)
+    state_lock = asyncio.Lock()
+    history = HistoryStore.load()
+
+    print_c(f"polling {', '.join(sources.keys())}")
+    try:
+        await asyncio.gather(check_live_state(conn, live, state_lock, history),
+                             snapshot_live_state(conn, live, state_lock, history),
+                             *[poll_source(source, config, live, state_lock, history)
+                                for source, config in sources.items()])
+    finally:
+        live.snapshot(conn, FILENAME, int(time.time()), DATABASE_PATH)
+        history.save()
+        conn.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,325 @@
+"""
+This module keeps the live state of the airplanes (the content of the
+AIRPLANE table) in memory, for ingestion_daemon.py. The airplanes are
+keyed by registration and source, with an index of the visible and the
+invisible airplanes, and an index of the visible airplanes by the time
+they were last seen. An airplane whose ICAO address is already known
+takes the registration it has in the state, so the same airplane has
+the same registration in all sources.
+The ingestion and the checks of check_airplanes.py (invisibility and
+merge of the sources) run directly on it, and it is written from time
+to time in the AIRPLANE table (only the rows that changed), so it can
+be reloaded after a crash.
+"""
+
+import heapq
+from functions import *
+from db_writer import write
+from schema import AIRPLANE_DATABASE
+from normalizer import Position
+
+# index of the values of a row (the columns of the AIRPLANE table,
+# without the registration and the source)
+LATITUDE, LONGITUDE, ALTITUDE, TIME, VELOCITY, HEADING, INVISIBLE, INVISIBLE_TIME, ICAO = range(9)
+
+
+def fingerprint(airplane) -> int:
+    """
+Computes the fingerprint of the position and the kinematics of an
+airplane. The values are rounded, so the noise of the ADS-B signal
+isn't considered as a change
+
+Parameters
+----------
+airplane : Position
+    Position of the airplane (see normalizer.py)
+
+Returns
+-------
+int
+    Fingerprint of the airplane
+    """
+    return hash((round(airplane.latitude, 4), round(airplane.longitude, 4),
+                 round(airplane.altitude), round(airplane.velocity, 1),
+                 round(airplane.heading)))
+
+
+class LiveState:
+    """
+Live state of the airplanes, keyed by (registration, source)
+    """
+    def __init__(self):
+        # (regis, source) -> [latitude, longitude, altitude, time,
+        # velocity, heading, invisible, invisible_time, icao]
+        self.airplanes = {}
+        # regis -> set of sources, and source -> set of regis
+        self.by_regis = {}
+        self.by_source = {}
+        # icao -> regis of the airplane in the state
+        self.regis_by_icao = {}
+        self.visible = set()
+        self.invisible = set()
+        # heap of (time, key) of the visible airplanes, an entry is
+        # outdated if the airplane was seen again since then
+        self.last_seen = []
+        # (fingerprint, time) of each key when it was last written in the
+        # AIRPLANE table, and the keys to write or to delete
+        self.written = {}
+        self.dirty = set()
+        self.deleted = set()
+
+    def load(self, conn: sqlite3.Connection, file: str) -> None:
+        """
+Loads the state from the AIRPLANE table (after a restart)
+        """
+        rows = query_to_bdd(conn, file, """
+                                SELECT apRegis, apLatitude, apLongitude, apAltitude, apTime, apVelocity,
+                                apHeading, apInvisible, apInvisibleTime, apIcao, apSource
+                                FROM "AIRPLANE";
+                            """)
+        for row in (rows.fetchall() if rows else []):
+            key = (row[0], row[10])
+            self.set_row(key, list(row[1:10]))
+            if row[9] is not None:
+                self.regis_by_icao.setdefault(row[9], row[0])
+            self.written[key] = (self.row_fingerprint(key), row[4])
+        self.dirty.clear()
+
+    def row_fingerprint(self, key: tuple) -> int:
+        """
+Returns the fingerprint of the position, the kinematics and the
+visibility of an airplane (see fingerprint)
+        """
+        row = self.airplanes[key]
+        return hash((fingerprint(Position(key[0], row[LATITUDE], row[LONGITUDE], row[ALTITUDE],
+                                          row[TIME], row[VELOCITY], row[HEADING])),
+                     row[INVISIBLE], row[ICAO]))
+
+    def set_row(self, key: tuple, row: list) -> None:
+        """
+Adds or replaces the row of an airplane, and updates the indexes
+        """
+        regis, source = key
+        self.airplanes[key] = row
+        self.by_regis.setdefault(regis, set()).add(source)
+        self.by_source.setdefault(source, set()).add(regis)
+        self.deleted.discard(key)
+        self.dirty.add(key)
+        if row[INVISIBLE]:
+            self.visible.discard(key)
+            self.invisible.add(key)
+        else:
+            self.invisible.discard(key)
+            self.visible.add(key)
+            heapq.heappush(self.last_seen, (row[TIME], key))
+
+    def set_invisible(self, key: tuple, now: int) -> None:
+        """
+Registers an airplane as invisible
+        """
+        row = self.airplanes[key]
+        row[INVISIBLE], row[INVISIBLE_TIME] = 1, now
+        self.visible.discard(key)
+        self.invisible.add(key)
+        self.dirty.add(key)
+
+    def delete(self, regis: str, invisible_only: bool=False) -> None:
+        """
+Deletes the rows of an airplane (of all sources, or only the invisible
+ones)
+        """
+        icao_list = []
+        for source in list(self.by_regis.get(regis, ())):
+            key = (regis, source)
+            if invisible_only and key not in self.invisible:
+                continue
+            icao_list.append(self.airplanes.pop(key)[ICAO])
+            self.by_regis[regis].discard(source)
+            self.by_source[source].discard(regis)
+            self.visible.discard(key)
+            self.invisible.discard(key)
+            self.dirty.discard(key)
+            self.deleted.add(key)
+        if len(self.by_regis.get(regis, ())) == 0:
+            self.by_regis.pop(regis, None)
+            for icao in icao_list:
+                if self.regis_by_icao.get(icao) == regis:
+                    del self.regis_by_icao[icao]
+
+    def last_seen_row(self, regis: str) -> tuple:
+        """
+Returns the row of an airplane with the last contact, in the form of
+a row of the AIRPLANE table
+        """
+        source = max(self.by_regis[regis], key=lambda source: self.airplanes[(regis, source)][TIME])
+        row = self.airplanes[(regis, source)]
+        return (regis, *row[:ICAO], source, row[ICAO])
+
+    def update(self, source: str, airplane_data, now: int, history=None) -> tuple:
+        """
+Writes a snapshot of airplanes from one source, and registers as
+invisible the airplanes of this source that aren't in it anymore
+
+Parameters
+----------
+source : str
+    Name of the source (api) of the snapshot
+airplane_data : dict or iterable
+    Position of all airplanes (see normalizer.py), with they're
+callsign as key, or an iterable of Position
+now : int
+    Time of the cycle (unix timestamp)
+history : HistoryStore, optional
+    Position history of the airplanes (see position_history.py)
+
+Returns
+-------
+tuple
+    Number of new airplanes, updated airplanes, new invisible airplanes
+and unchanged airplanes
+        """
+        if isinstance(airplane_data, dict):
+            airplane_data = airplane_data.values()
+
+        seen = set()
+        new_airplane_c, updated_airplane_c, unchanged_airplane_c = 0, 0, 0
+        for airplane in airplane_data:
+            if airplane.icao is not None:
+                regis = self.regis_by_icao.setdefault(airplane.icao, airplane.regis)
+                if regis != airplane.regis:
+                    airplane = airplane._replace(regis=regis)
+            if history is not None:
+                history.add(airplane)
+            key = (airplane.regis, source)
+            seen.add(airplane.regis)
+
+            previous = self.airplanes.get(key)
+            row = [airplane.latitude, airplane.longitude, airplane.altitude, airplane.time,
+                   airplane.velocity, airplane.heading, 0, 0, airplane.icao]
+            if previous is None:
+                new_airplane_c += 1
+            elif previous == row:
+                unchanged_airplane_c += 1
+                continue
+            elif previous[:TIME] + previous[VELOCITY:] == row[:TIME] + row[VELOCITY:]:
+                unchanged_airplane_c += 1
+            else:
+                updated_airplane_c += 1
+            self.set_row(key, row)
+
+        invisible_airplane_c = 0
+        for regis in self.by_source.get(source, set()) - seen:
+            if (regis, source) in self.visible:
+                self.set_invisible((regis, source), now)
+                invisible_airplane_c += 1
+
+        return (new_airplane_c, updated_airplane_c, invisible_airplane_c, unchanged_airplane_c)
+
+    def resolve(self, now: int, delay_invisible: int, delay_delete: int, min_velocity: float) -> tuple:
+        """
+Runs the checks of check_airplanes.py on the state: the airplanes
+without signal since delay_invisible minutes are registered as
+invisible, the airplanes invisible for all sources, or too slow for all
+sources, could have landed and are removed, and the invisible
+airplanes older than delay_delete minutes are removed
+
+Parameters
+----------
+now : int
+    Time of the check (unix timestamp)
+delay_invisible : int
+    Delay (in minutes) without signal, before an airplane is invisible
+delay_delete : int
+    Delay (in minutes) before an invisible airplane is deleted
+min_velocity : float
+    Minimum speed that an airplane can have (in m/s)
+
+Returns
+-------
+tuple
+    The last seen rows of the airplanes that are really invisible, and
+of the airplanes that are too slow (= on the ground)
+        """
+        # only the outdated part of the index is read
+        while len(self.last_seen) > 0 and self.last_seen[0][0] < now - delay_invisible * 60:
+            airplane_time, key = heapq.heappop(self.last_seen)
+            if key in self.visible and self.airplanes[key][TIME] == airplane_time:
+                self.set_invisible(key, now)
+
+        invisible_landings = []
+        for regis in {key[0] for key in self.invisible}:
+            if any((regis, source) in self.visible for source in self.by_regis[regis]):
+                # there is at least one tracking service that still
+                # detects the airplane, so we keep only this one
+                self.delete(regis, invisible_only=True)
+            else:
+                # none of the tracking services can track this airplane,
+                # so it is really invisible
+                invisible_landings.append(self.last_seen_row(regis))
+                self.delete(regis)
+
+        slow_landings = []
+        for regis in list(self.by_regis):
+            if all(self.airplanes[(regis, source)][VELOCITY] < min_velocity for source in self.by_regis[regis]):
+                slow_landings.append(self.last_seen_row(regis))
+                self.delete(regis)
+
+        for key in list(self.invisible):
+            if key in self.airplanes and now > self.airplanes[key][INVISIBLE_TIME] + delay_delete * 60:
+                self.delete(key[0])
+
+        return (invisible_landings, slow_landings)
+
+    def snapshot(self, conn: sqlite3.Connection, file: str, now: int, database: str=AIRPLANE_DATABASE) -> tuple:
+        """
+Writes the state in the AIRPLANE table, in one transaction. Only the
+rows that changed since they were last written, or that weren't written
+since HEARTBEAT_TIME seconds, are written
+
+Returns
+-------
+tuple
+    Number of written rows and of deleted rows
+        """
+        rows = []
+        for key in self.dirty:
+            row_fingerprint = self.row_fingerprint(key)
+            written = self.written.get(key)
+            if written is None or written[0] != row_fingerprint or now - written[1] >= HEARTBEAT_TIME:
+                row = self.airplanes[key]
+                rows.append((key[0], *row[:ICAO], key[1], row[ICAO]))
+                self.written[key] = (row_fingerprint, now)
+
+        upsert_query = """
+                INSERT INTO "AIRPLANE"
+                (apRegis, apLatitude, apLongitude, apAltitude, apTime, apVelocity,
+                apHeading, apInvisible, apInvisibleTime, apSource, apIcao)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(apRegis, apSource) DO UPDATE SET
+                apLatitude = excluded.apLatitude,
+                apLongitude = excluded.apLongitude,
+                apAltitude = excluded.apAltitude,
+                apTime = excluded.apTime,
+                apVelocity = excluded.apVelocity,
+                apHeading = excluded.apHeading,
+                apInvisible = excluded.apInvisible,
+                apInvisibleTime = excluded.apInvisibleTime,
+                apIcao = excluded.apIcao;
+            """
+        delete_query = "DELETE FROM \"AIRPLANE\" WHERE apRegis = ? AND apSource = ?;"
+        # the rows are written by the writer of the database, if it runs
+        # (see db_writer.py)
+        is_written = write(database, conn, file, [(upsert_query, rows), (delete_query, self.deleted)])
+
+        if not is_written:
+            # the rows will be written with the next snapshot
+            self.written.clear()
+            return (0, 0)
+
+        deleted_c = len(self.deleted)
+        for key in self.deleted:
+            self.written.pop(key, None)
+        self.dirty.clear()
+        self.deleted.clear()
+
+        return (len(rows), deleted_c)
@@ -0,0 +1,226 @@
+"""
+This module normalizes the airplanes returned by the get_airplane
+sources. Each source declares which of its fields holds which value,
+and in which unit, and the normalizer is built once from it. The
+values are parsed as numbers (never evaluated), converted in meters,
+meters per seconds and unix timestamps, and the incomplete airplanes
+and the airplanes outside of our operations area (see
+operations_area.py) are dropped in the same pass.
+"""
+
+import json
+import time
+from calendar import timegm
+from collections import namedtuple
+from datetime import datetime
+
+# compact record of an airplane, with the same order as the columns of
+# the AIRPLANE table (see upsert_airplanes in functions.py). The ICAO 
+# 24-bit address is None if the source doesn't give it
+Position = namedtuple("Position", ("regis", "latitude", "longitude", "altitude",
+                                    "time", "velocity", "heading", "icao"), defaults=(None,))
+
+# coefficient to convert a value in meters (distance) or meters per
+# seconds (speed)
+UNITS = {
+    "m": 1,
+    "ft": 0.3048,
+    "hft": 30.48,       # hundreds of feet
+    "m/s": 1,
+    "kt": 0.5144,
+    "deg": 1,
+}
+# characters that can be between two items of a JSON array
+JSON_SEPARATORS = " \t\r\n,"
+# format of the time, if it isn't an unix timestamp
+TIME_FORMATS = {
+    "iso8601": "%Y-%m-%dT%H:%M:%SZ",
+}
+
+
+def compile_normalizer(fields: dict, units: dict, regis_format=None, area_filter=None):
+    """
+Builds the function that normalizes one airplane of a source
+
+Parameters
+----------
+fields : dict
+    Key or index of each value in an airplane of the source, with as
+keys : regis, latitude, longitude, altitude, velocity, heading, time and
+icao (optional, the ICAO address in hexadecimal)
+units : dict
+    Unit of the altitude, the velocity and the heading (see UNITS), and
+format of the time ("unix" or a key of TIME_FORMATS). A missing unit is
+considered as already converted
+regis_format : function, optional
+    Function applied to the registration, before the "-" are removed
+area_filter : function, optional
+    Function that tells if a Position is kept (see operations_area.py)
+
+Returns
+-------
+function
+    Function that takes an airplane of the source, and returns its
+Position, or None if the airplane is incomplete (or filtered out)
+    """
+    regis_key, latitude_key, longitude_key = fields["regis"], fields["latitude"], fields["longitude"]
+    altitude_key, velocity_key = fields["altitude"], fields["velocity"]
+    heading_key, time_key = fields["heading"], fields["time"]
+    icao_key = fields.get("icao")
+
+    altitude_coef = UNITS[units.get("altitude", "m")]
+    velocity_coef = UNITS[units.get("velocity", "m/s")]
+    heading_coef = UNITS[units.get("heading", "deg")]
+    time_format = TIME_FORMATS.get(units.get("time", "unix"))
+
+    def normalize(airplane) -> Position: #|None
+        try:
+            regis = airplane[regis_key]
+            latitude = airplane[latitude_key]
+            longitude = airplane[longitude_key]
+            heading = airplane[heading_key]
+            altitude = airplane[altitude_key]
+            velocity = airplane[velocity_key]
+            airplane_time = airplane[time_key]
+        except (KeyError, IndexError):
+            return None
+
+        if regis is None or latitude is None or longitude is None \
+                or heading is None or altitude is None or velocity is None:
+            return None
+
+        try:
+            latitude = float(latitude)
+            longitude = float(longitude)
+            heading = float(heading) * heading_coef
+            altitude = float(altitude) * altitude_coef
+            velocity = float(velocity) * velocity_coef
+
+            # time is the only data that we can put by ourselves
+            if airplane_time is None:
+                airplane_time = int(time.time())
+            elif time_format is None:
+                airplane_time = int(float(airplane_time))
+            else:
+                airplane_time = timegm(datetime.strptime(airplane_time, time_format).timetuple())
+        except (TypeError, ValueError):
+            return None
+
+        if regis_format is not None:
+            regis = regis_format(regis)
+        regis = regis.replace("-", "").strip()
+        if regis == "":
+            return None
+
+        # the ICAO address is optional, an invalid one (a MLAT track for
+        # instance) is ignored
+        icao = None
+        if icao_key is not None:
+            try:
+                icao = int(airplane[icao_key], 16)
+            except (KeyError, IndexError, TypeError, ValueError):
+                icao = None
+
+        airplane = Position(regis, latitude, longitude, altitude, airplane_time, velocity, heading, icao)
+        if area_filter is not None and not area_filter(airplane):
+            return None
+
+        return airplane
+
+    return normalize
+
+
+def normalize_batch(normalize, airplane_list: list) -> dict:
+    """
+Normalizes all airplanes of a response
+
+Parameters
+----------
+normalize : function
+    Normalizer of the source (see compile_normalizer)
+airplane_list : list
+    List of all airplanes, as returned by the source
+
+Returns
+-------
+dict
+    Position of all complete airplanes, with they're callsign as key
+    """
+    return {airplane.regis: airplane
+            for airplane in map(normalize, airplane_list)
+            if airplane is not None}
+
+
+def normalize_stream(normalize, airplane_iter):
+    """
+Normalizes the airplanes of a response one at a time, so the response
+never has to be kept entirely in memory
+
+Parameters
+----------
+normalize : function
+    Normalizer of the source (see compile_normalizer)
+airplane_iter : iterable
+    Airplanes, as returned by the source (see iter_json_array)
+
+Yields
+------
+Position
+    Position of each complete airplane
+    """
+    for airplane in airplane_iter:
+        airplane = normalize(airplane)
+        if airplane is not None:
+            yield airplane
+
+
+def iter_json_array(chunks):
+    """
+Parses incrementally a JSON array of objects, received in chunks (for
+example with requests.Response.iter_content), and yields its items as
+soon as they are complete. Only the item being received is kept in 
+memory
+
+Parameters
+----------
+chunks : iterable
+    Chunks of text of the JSON array
+
+Yields
+------
+dict or list
+    Each item of the array
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    array_begun = False
+
+    for chunk in chunks:
+        buffer = buffer[position:] + chunk
+        position = 0
+
+        while True:
+            while position < len(buffer) and buffer[position] in JSON_SEPARATORS:
+                position += 1
+            if position == len(buffer):
+                break
+
+            if not array_begun:
+                if buffer[position] != "[":
+                    raise ValueError(f"the response isn't a JSON array (begins with '{buffer[position]}')")
+                array_begun = True
+                position += 1
+                continue
+
+            if buffer[position] == "]":
+                return
+
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # the item isn't complete yet, we wait for the next chunk
+                break
+            yield item
+
+    raise ValueError("the JSON array of the response is incomplete")
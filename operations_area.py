@@ -0,0 +1,218 @@
+"""
+This module filters the airplanes by our operations area: an airplane
+is kept only if it is in one of the areas, or if it can reach one of
+them within the radius of its landing zone (see airplane_zone.py).
+The areas are written in the AREA_FILE, as bounding boxes or polygons,
+in this format:
+{
+    "areas": [
+        {"name": <name>, "bbox": [<min_lat>, <min_lon>, <max_lat>, <max_lon>]},
+        {"name": <name>, "polygon": [[<lat>, <lon>], ...]},
+        ...
+    ],
+    "altitude_ceiling": <altitude>
+}
+If there isn't any area, the airplanes aren't filtered.
+The altitude ceiling (in meters, optional) is used by the sources that
+can filter the airplanes on their side (see get_airplane_flightaware.py).
+It has to be higher than the MAXIMUM_ALTITUDE of get_airport_by_zone.py,
+with a margin for the climb of an airplane during one cycle, else an
+airplane that climbs above it would seem to land.
+"""
+
+import json
+import math
+from airplane_zone import br
+from in_polygon import is_inside_polygon
+
+AREA_FILE = "operations_area.json"
+# length of one degree of latitude, and of longitude at the equator (in km)
+KM_BY_LATITUDE = 110.574
+KM_BY_LONGITUDE = 111.32
+
+
+def load_areas(path: str=AREA_FILE) -> list:
+    """
+Reads the operations areas
+
+Parameters
+----------
+path : str
+    Path to the file of the areas
+
+Returns
+-------
+list
+    List of areas, each one as a polygon (tuple of (latitude,
+longitude)). The list is empty if the file doesn't exist
+    """
+    try:
+        with open(path) as file:
+            content = json.loads(file.read())
+    except FileNotFoundError:
+        return []
+
+    areas = []
+    for area in content["areas"]:
+        if "bbox" in area:
+            min_lat, min_lon, max_lat, max_lon = area["bbox"]
+            areas.append(((min_lat, min_lon), (min_lat, max_lon),
+                          (max_lat, max_lon), (max_lat, min_lon)))
+        else:
+            areas.append(tuple(tuple(point) for point in area["polygon"]))
+
+    return areas
+
+
+def load_altitude_ceiling(path: str=AREA_FILE) -> float: #|None
+    """
+Reads the altitude ceiling of the operations areas
+
+Parameters
+----------
+path : str
+    Path to the file of the areas
+
+Returns
+-------
+float or None
+    The altitude ceiling (in meters), or None if there isn't any
+    """
+    try:
+        with open(path) as file:
+            content = json.loads(file.read())
+    except FileNotFoundError:
+        return None
+
+    return content.get("altitude_ceiling")
+
+
+def bounding_box(area: tuple) -> tuple:
+    """
+Returns the bounding box of an area
+
+Parameters
+----------
+area : tuple
+    Polygon of the area (tuple of (latitude, longitude))
+
+Returns
+-------
+tuple
+    The bounding box, in the form (min_lat, min_lon, max_lat, max_lon)
+    """
+    latitudes = [point[0] for point in area]
+    longitudes = [point[1] for point in area]
+
+    return (min(latitudes), min(longitudes), max(latitudes), max(longitudes))
+
+
+def distance_to_area(coords: tuple, area: tuple) -> float:
+    """
+Computes the distance between a point and the edges of an area. The
+distance is approximated on a plane tangent to the point, which is
+precise enough for the radius of a landing zone
+
+Parameters
+----------
+coords : tuple
+    Coordinates of the point, in the form (latitude, longitude)
+area : tuple
+    Polygon of the area (tuple of (latitude, longitude))
+
+Returns
+-------
+float
+    Distance from the point to the nearest edge of the area (in km)
+    """
+    km_by_longitude = KM_BY_LONGITUDE * math.cos(math.radians(coords[0]))
+    points = [((lon - coords[1]) * km_by_longitude, (lat - coords[0]) * KM_BY_LATITUDE)
+              for lat, lon in area]
+
+    min_distance = math.inf
+    for index, (x1, y1) in enumerate(points):
+        x2, y2 = points[(index + 1) % len(points)]
+        dx, dy = x2 - x1, y2 - y1
+        # projection of the point (the origin) on the edge
+        length = dx * dx + dy * dy
+        t = 0 if length == 0 else max(0, min(1, -(x1 * dx + y1 * dy) / length))
+        min_distance = min(min_distance, math.hypot(x1 + t * dx, y1 + t * dy))
+
+    return min_distance
+
+
+def search_box(areas: list) -> tuple: #|None
+    """
+Returns the bounding box of all areas, extended by the biggest radius
+of a landing zone, so it contains every airplane that the area filter
+keeps (see compile_area_filter)
+
+Parameters
+----------
+areas : list
+    List of areas (see load_areas)
+
+Returns
+-------
+tuple or None
+    The bounding box, in the form (min_lat, min_lon, max_lat, max_lon),
+or None if there isn't any area
+    """
+    if len(areas) == 0:
+        return None
+
+    boxes = [bounding_box(area) for area in areas]
+    min_lat = min(box[0] for box in boxes)
+    min_lon = min(box[1] for box in boxes)
+    max_lat = max(box[2] for box in boxes)
+    max_lon = max(box[3] for box in boxes)
+
+    margin = br(math.inf, math.inf)
+    margin_lat = margin / KM_BY_LATITUDE
+    # the degrees of longitude are the shortest at the latitude the
+    # farthest from the equator
+    max_abs_lat = min(90, max(abs(min_lat), abs(max_lat)) + margin_lat)
+    margin_lon = margin / (KM_BY_LONGITUDE * max(0.01, math.cos(math.radians(max_abs_lat))))
+
+    return (max(-90, min_lat - margin_lat), max(-180, min_lon - margin_lon),
+            min(90, max_lat + margin_lat), min(180, max_lon + margin_lon))
+
+
+def compile_area_filter(areas: list):
+    """
+Builds the function that tells if an airplane can land in the
+operations areas
+
+Parameters
+----------
+areas : list
+    List of areas (see load_areas)
+
+Returns
+-------
+function or None
+    Function that takes the Position of an airplane (see normalizer.py)
+and returns True if it has to be kept, or None if there isn't any area
+    """
+    if len(areas) == 0:
+        return None
+
+    areas = [(area, bounding_box(area)) for area in areas]
+
+    def in_area(airplane) -> bool:
+        # the airplane can land anywhere in the big circle of its zone
+        margin = br(airplane.altitude + 1, airplane.velocity + 1)
+        margin_lat = margin / KM_BY_LATITUDE
+        margin_lon = margin / (KM_BY_LONGITUDE * max(0.01, math.cos(math.radians(airplane.latitude))))
+        coords = (airplane.latitude, airplane.longitude)
+
+        for area, (min_lat, min_lon, max_lat, max_lon) in areas:
+            if airplane.latitude < min_lat - margin_lat or airplane.latitude > max_lat + margin_lat \
+                    or airplane.longitude < min_lon - margin_lon or airplane.longitude > max_lon + margin_lon:
+                continue
+            if is_inside_polygon(area, coords) or distance_to_area(coords, area) <= margin:
+                return True
+
+        return False
+
+    return in_area
@@ -0,0 +1,162 @@
+"""
+This module keeps the last fixes of each airplane in a ring buffer, so
+the descent rate and the ground speed trend of an airplane can be known
+without any query to the database.
+Each airplane has a fixed size buffer (HISTORY_SIZE fixes, in an array
+of doubles), and at most MAX_AIRPLANES airplanes are kept (the ones
+that weren't updated for the longest time are forgotten first), so the
+memory used is bounded.
+The ingestion writes the history in the HISTORY_FILE after each cycle
+(the daemon after each snapshot), so check_airplanes.py and
+get_airport_by_zone.py can read it.
+"""
+
+import os
+import pickle
+from array import array
+from collections import OrderedDict
+
+HISTORY_FILE = "position_history.bin"
+# number of fixes kept by airplane
+HISTORY_SIZE = 8
+# maximum number of airplanes kept
+MAX_AIRPLANES = 20000
+# values of a fix: time, latitude, longitude, altitude and velocity
+FIX_SIZE = 5
+
+
+def slope(points: list) -> float: #|None
+    """
+Computes the slope of the linear regression of points
+
+Parameters
+----------
+points : list
+    List of (x, y)
+
+Returns
+-------
+float or None
+    The slope, or None if there isn't at least two different x
+    """
+    if len(points) < 2:
+        return None
+    mean_x = sum(point[0] for point in points) / len(points)
+    mean_y = sum(point[1] for point in points) / len(points)
+    variance = sum((point[0] - mean_x) ** 2 for point in points)
+    if variance == 0:
+        return None
+
+    return sum((point[0] - mean_x) * (point[1] - mean_y) for point in points) / variance
+
+
+class PositionHistory:
+    """
+Ring buffer of the last fixes of one airplane
+    """
+    __slots__ = ("fixes", "head", "count")
+
+    def __init__(self, size: int=HISTORY_SIZE):
+        self.fixes = array("d", bytes(8 * FIX_SIZE * size))
+        self.head = 0
+        self.count = 0
+
+    def append(self, airplane) -> None:
+        """
+Adds the fix of a Position (see normalizer.py), if it is newer than
+the last one
+        """
+        size = len(self.fixes) // FIX_SIZE
+        if self.count > 0 and airplane.time <= self.fixes[((self.head - 1) % size) * FIX_SIZE]:
+            return
+
+        index = self.head * FIX_SIZE
+        self.fixes[index:index + FIX_SIZE] = array("d", (airplane.time, airplane.latitude, airplane.longitude,
+                                                         airplane.altitude, airplane.velocity))
+        self.head = (self.head + 1) % size
+        self.count = min(size, self.count + 1)
+
+    def last(self) -> list:
+        """
+Returns the fixes, from the oldest to the newest, as tuples of (time,
+latitude, longitude, altitude, velocity)
+        """
+        size = len(self.fixes) // FIX_SIZE
+        first = (self.head - self.count) % size
+        fixes = []
+        for i in range(self.count):
+            index = ((first + i) % size) * FIX_SIZE
+            fixes.append(tuple(self.fixes[index:index + FIX_SIZE]))
+
+        return fixes
+
+    def descent_rate(self) -> float: #|None
+        """
+Returns the descent rate (in m/s, positive when the airplane goes
+down), or None if there aren't enough fixes
+        """
+        rate = slope([(fix[0], fix[3]) for fix in self.last()])
+        return None if rate is None else -rate
+
+    def speed_trend(self) -> float: #|None
+        """
+Returns the ground speed trend (in m/s², negative when the airplane
+slows down), or None if there aren't enough fixes
+        """
+        return slope([(fix[0], fix[4]) for fix in self.last()])
+
+
+class HistoryStore:
+    """
+Position history of all airplanes, with they're callsign as key
+    """
+    def __init__(self, size: int=HISTORY_SIZE, max_airplanes: int=MAX_AIRPLANES):
+        self.size = size
+        self.max_airplanes = max_airplanes
+        self.airplanes = OrderedDict()
+
+    def add(self, airplane) -> None:
+        """
+Adds the fix of a Position (see normalizer.py) to the history of its
+airplane
+        """
+        history = self.airplanes.get(airplane.regis)
+        if history is None:
+            history = self.airplanes[airplane.regis] = PositionHistory(self.size)
+            if len(self.airplanes) > self.max_airplanes:
+                self.airplanes.popitem(last=False)
+        else:
+            self.airplanes.move_to_end(airplane.regis)
+        history.append(airplane)
+
+    def get(self, regis: str) -> PositionHistory: #|None
+        """
+Returns the history of an airplane, or None if it isn't known
+        """
+        return self.airplanes.get(regis)
+
+    def save(self, path: str=HISTORY_FILE, content: bytes=None) -> None:
+        """
+Writes the history in a file, or content (the history already
+serialized with pickle.dumps, so it can be written while the history
+changes). The file is replaced at once, so a reader never reads a
+partial history
+        """
+        with open(path + ".tmp", "wb") as file:
+            if content is None:
+                pickle.dump(self, file)
+            else:
+                file.write(content)
+        os.replace(path + ".tmp", path)
+
+    @staticmethod
+    def load(path: str=HISTORY_FILE):
+        """
+Reads the history from a file, or returns an empty history if the file
+doesn't exist or can't be read
+        """
+        try:
+            with open(path, "rb") as file:
+                return pickle.load(file)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return HistoryStore()
@@ -0,0 +1,267 @@
+"""
+This program is a local HTTP service, that serves the landings, the
+evidences that aren't treated yet, and the summary of an airport, in
+JSON, so the dashboards don't have to open database.db:
+GET /landings?airport=<airport>&since=<time>&until=<time>&limit=<n>&cursor=<cursor>
+GET /evidences?airport=<airport>&since=<time>&until=<time>&limit=<n>&cursor=<cursor>
+GET /summary?airport=<airport>&period=<hour|day>&days=<n>
+(all parameters are optional, except the airport of the summary; the
+times are unix timestamps)
+The landings and the evidences are sorted by time, by pages of at most
+MAX_PAGE_SIZE rows: a page has the cursor of the next one, which begins
+after its last row (without offset, so reading a page doesn't depend on
+the number of pages before it, and a client can poll the new rows with
+the cursor of its last page). All the queries of a request are made in
+one read transaction (a snapshot of the database, in WAL mode), with a
+read-only connection of the pool of the service.
+With: python3 query_service.py [<port>], the service listens on
+HOST:<port> (PORT by default).
+"""
+
+import base64
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from functions import *
+from schema import LANDING_DATABASE, LANDING_MIGRATIONS, migrate
+from aggregates import PERIOD_AGGREGATES, REPORT_DAYS, confirmation_rates, landings_by_period
+
+FILENAME = os.path.basename(__file__)
+# only the programs of this computer can read it
+HOST = "127.0.0.1"
+PORT = 8600
+# number of connections to the database (and of requests read at the
+# same time)
+POOL_SIZE = 4
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# maximum number of days of a summary
+MAX_SUMMARY_DAYS = 366
+# time between two prints of the statistics of the service (in seconds)
+STATS_TIME = 60
+# the columns of the rows of each page, with their name in the JSON
+LANDING_COLUMNS = {"tdId": "id", "tdAirport": "airport", "tdAirplane": "airplane", "tdTime": "time",
+                   "tdProb": "probability", "tdSent": "sent", "tdSource": "source"}
+EVIDENCE_COLUMNS = {"udId": "id", "udAirport": "airport", "udRegis": "registration", "udProbability": "probability",
+                    "udSource": "source", "udSource2": "source2", "udTime": "time", "udLatitude": "latitude",
+                    "udLongitude": "longitude", "udIcao": "icao"}
+
+print_c = lambda text : print_context(FILENAME, text)
+
+
+class QueryError(Exception):
+    """
+Error of a request, with its HTTP status
+    """
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class ReadPool:
+    """
+Read-only connections to a database, each one used by one request at a
+time
+    """
+    def __init__(self, database: str, size: int):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            conn = create_connection(database, False)
+            STORAGE.set_read_only(conn)
+            self.connections.put(conn)
+
+    def read(self, reader):
+        """
+Returns the result of reader(connection), called in a read transaction
+        """
+        conn = self.connections.get()
+        result = None
+        try:
+            with transaction(conn, FILENAME, immediate=False):
+                result = reader(conn)
+        finally:
+            self.connections.put(conn)
+
+        if result is None:
+            raise QueryError(503, "the database couldn't be read")
+        return result
+
+
+def fetch(conn: sqlite3.Connection, query_: str, parameters) -> list:
+    """
+Returns the rows of a query, or raises a QueryError if it fails
+    """
+    rows = execute(conn, FILENAME, query_, parameters)
+    if rows is False:
+        raise QueryError(503, "the database couldn't be read")
+    return rows.fetchall()
+
+
+def integer_parameter(parameters: dict, name: str, default: int, minimum: int, maximum: int) -> int:
+    """
+Returns an integer parameter of a request, between minimum and maximum
+    """
+    try:
+        value = int(parameters.get(name, default))
+    except ValueError:
+        raise QueryError(400, f"{name} must be an integer")
+    if not minimum <= value <= maximum:
+        raise QueryError(400, f"{name} must be between {minimum} and {maximum}")
+    return value
+
+
+def encode_cursor(row_time: int, row_id: int) -> str:
+    """
+Returns the cursor of the page that begins after a row
+    """
+    return base64.urlsafe_b64encode(f"{row_time}:{row_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """
+Returns the time and the id of the last row of the previous page
+    """
+    try:
+        row_time, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(":")
+        return (int(row_time), int(row_id))
+    except ValueError:
+        raise QueryError(400, "invalid cursor")
+
+
+def read_page(pool: ReadPool, table: str, columns: dict, parameters: dict) -> dict:
+    """
+Returns a page of the rows of a table (see the parameters above),
+sorted by time and id
+
+Parameters
+----------
+pool : ReadPool
+    Connections to the database
+table : str
+    TREATED_DATA or UNTREATED_DATA
+columns : dict
+    Columns of the rows, with their name in the JSON (the first one is
+the id, and the time is the one named "time")
+parameters : dict
+    Parameters of the request
+
+Returns
+-------
+dict
+    The rows of the page, and the cursor of the next page (None if it is
+the last one)
+    """
+    id_column = list(columns)[0]
+    time_column = [column for column, name in columns.items() if name == "time"][0]
+    since = integer_parameter(parameters, "since", 0, 0, 2 ** 62)
+    until = integer_parameter(parameters, "until", 2 ** 62, 0, 2 ** 62)
+    limit = integer_parameter(parameters, "limit", DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+    after = decode_cursor(parameters["cursor"]) if "cursor" in parameters else (-1, -1)
+
+    airport_column = [column for column, name in columns.items() if name == "airport"][0]
+    airport_condition = f"AND {airport_column} = ?" if "airport" in parameters else ""
+    airport_parameters = (parameters["airport"],) if "airport" in parameters else ()
+
+    # one more row tells if there is a next page
+    rows = pool.read(lambda conn : fetch(conn, f"""
+                SELECT {", ".join(columns)} FROM "{table}"
+                WHERE {time_column} >= ? AND {time_column} < ?
+                AND ({time_column}, {id_column}) > (?, ?)
+                {airport_condition}
+                ORDER BY {time_column}, {id_column}
+                LIMIT ?;
+            """, (since, until, *after, *airport_parameters, limit + 1)))
+
+    page = [dict(zip(columns.values(), row)) for row in rows[:limit]]
+    cursor = encode_cursor(page[-1]["time"], page[-1]["id"]) if len(rows) > limit else None
+    return {"data": page, "cursor": cursor}
+
+
+def read_summary(pool: ReadPool, parameters: dict) -> dict:
+    """
+Returns the landings of an airport by period, for the last days, and
+the confirmation rate of each source (see aggregates.py)
+    """
+    if "airport" not in parameters:
+        raise QueryError(400, "airport is missing")
+    period = parameters.get("period", "day")
+    if period not in PERIOD_AGGREGATES:
+        raise QueryError(400, f"period must be one of {', '.join(PERIOD_AGGREGATES)}")
+    days = integer_parameter(parameters, "days", REPORT_DAYS, 1, MAX_SUMMARY_DAYS)
+
+    today = int(time.time()) // 86400 * 86400
+    airport = parameters["airport"]
+    # the two queries read the same snapshot
+    periods, sources = pool.read(lambda conn : (
+        landings_by_period(conn, FILENAME, airport, period, today - (days - 1) * 86400, today + 86400),
+        confirmation_rates(conn, FILENAME, airport)))
+
+    return {
+        "airport": airport,
+        "periods": [{"time": row[0], "landings": row[1], "confirmed": row[2], "sent": row[3],
+                     "mean_probability": row[4]} for row in periods],
+        "sources": [{"source": row[0], "landings": row[1], "confirmed": row[2], "confirmation_rate": row[3]}
+                    for row in sources],
+    }
+
+
+ROUTES = {
+    "/landings": lambda pool, parameters : read_page(pool, "TREATED_DATA", LANDING_COLUMNS, parameters),
+    "/evidences": lambda pool, parameters : read_page(pool, "UNTREATED_DATA", EVIDENCE_COLUMNS, parameters),
+    "/summary": read_summary,
+}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+Answers the GET requests of the ROUTES
+    """
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            if url.path not in ROUTES:
+                raise QueryError(404, f"unknown path {url.path}")
+            self.send_json(200, ROUTES[url.path](self.server.pool, parameters))
+        except QueryError as e:
+            self.send_json(e.status, {"error": str(e)})
+        except (*Error, Exception) as e:
+            # an unexpected error of a request is logged, and the client
+            # gets a JSON answer like for the other errors
+            print_context(FILENAME, f"Error: '{e}' with the request {self.path}", True)
+            self.send_json(500, {"error": "internal error"})
+
+    def send_json(self, status: int, content: dict) -> None:
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args) -> None:
+        # the requests are counted in the statistics of the queries
+        pass
+
+
+if __name__ == "__main__":
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+
+    conn = create_connection(LANDING_DATABASE)
+    migrate(conn, FILENAME, LANDING_MIGRATIONS)
+    conn.close()
+
+    server = ThreadingHTTPServer((HOST, port), QueryHandler)
+    server.daemon_threads = True
+    server.pool = ReadPool(LANDING_DATABASE, POOL_SIZE)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print_c(f"query service listening on http://{HOST}:{port}")
+
+    while True:
+        time.sleep(STATS_TIME)
+        print_query_summary(FILENAME)
@@ -0,0 +1,293 @@
+"""
+This program moves the rows that expired from the tables of the
+databases to archive databases, so the tables that are read at each
+cycle keep the same size, however long the programs run.
+The policies of the tables are written in the RETENTION_FILE, in this
+format (the ages are in hours):
+{
+    "cycle_time": <time between two runs, in seconds>,
+    "archive_path": <directory of the archive databases>,
+    "batch_size": <rows moved in one transaction>,
+    "vacuum_pages": <pages freed at most by run and database>,
+    "tables": {
+        <table>: {
+            "database": <path to the database>,
+            "key": [<columns that identify a row>],
+            "time": <column of the time of a row (unix timestamp)>,
+            "max_age": <age of the expired rows>,
+            "source": <column of the source>,                   (optional)
+            "max_age_by_source": {<source>: <age>, ...},        (optional)
+            "sent": <column of the sent status>,                (optional)
+            "max_age_sent": <age of the expired sent rows>      (optional)
+        },
+        ...
+    }
+}
+The rows are archived in one database by month (of their time), and by
+database: <archive_path>/<database>_<YYYY-MM>.db, in a table with the
+same name and columns. The rows are moved by batches of batch_size rows,
+so the tables are never locked for long, and the free pages are then
+given back to the file system (incremental vacuum).
+The archives are only made for the SQLite storage (see storage.py).
+"""
+
+import json
+import os
+import time
+from functions import *
+from schema import MIGRATIONS, migrate
+
+RETENTION_FILE = "retention.json"
+FILENAME = os.path.basename(__file__)
+# name of the archive database, when it is attached
+ARCHIVE_SCHEMA = "archive"
+
+print_c = lambda text : print_context(FILENAME, text)
+
+
+def load_policies(path: str=RETENTION_FILE) -> dict:
+    """
+Reads the retention policies (see the format above)
+    """
+    with open(path) as file:
+        return json.loads(file.read())
+
+
+def expired_condition(policy: dict, now: int) -> tuple:
+    """
+Returns the condition of the expired rows of a table
+
+Parameters
+----------
+policy : dict
+    Policy of the table
+now : int
+    Time of the run (unix timestamp)
+
+Returns
+-------
+tuple
+    The condition (SQL) and its parameters
+    """
+    time_column = policy["time"]
+    limit = lambda max_age : now - max_age * 60 * 60
+
+    max_age_by_source = policy.get("max_age_by_source", {})
+    if "source" in policy and len(max_age_by_source) > 0:
+        # the rows of some sources are kept longer (or shorter)
+        cases = " ".join("WHEN ? THEN ?" for _ in max_age_by_source)
+        condition = f"{time_column} < CASE {policy['source']} {cases} ELSE ? END"
+        parameters = [value for source, max_age in max_age_by_source.items() for value in (source, limit(max_age))]
+        parameters.append(limit(policy["max_age"]))
+    else:
+        condition = f"{time_column} < ?"
+        parameters = [limit(policy["max_age"])]
+
+    if "sent" in policy:
+        # the rows that were sent are kept for less time than the others
+        condition = f"(({policy['sent']} = 1 AND {time_column} < ?) OR {condition})"
+        parameters.insert(0, limit(policy["max_age_sent"]))
+
+    return (condition, parameters)
+
+
+def archive_path(archive_dir: str, database: str, month: str) -> str:
+    """
+Returns the path of the archive of a database for a month (YYYY-MM)
+    """
+    return os.path.join(archive_dir, f"{os.path.splitext(os.path.basename(database))[0]}_{month}.db")
+
+
+def create_archive_table(conn: sqlite3.Connection, table: str, key: list) -> list:
+    """
+Creates the table in the attached archive, with the columns of the
+table of the database (without its constraints), and a unique key so a
+row is never archived twice. The columns added to the table since the
+archive was created are added to it
+
+Returns
+-------
+list
+    The columns of the table
+    """
+    columns = execute(conn, FILENAME, f"PRAGMA main.table_info(\"{table}\");").fetchall()
+    definitions = ", ".join(f"\"{column[1]}\" {column[2]}" for column in columns)
+    execute(conn, FILENAME, f"""
+            CREATE TABLE IF NOT EXISTS {ARCHIVE_SCHEMA}."{table}" (
+                {definitions},
+                UNIQUE ({", ".join(key)})
+            );
+        """)
+
+    archive_columns = [column[1] for column in
+                        execute(conn, FILENAME, f"PRAGMA {ARCHIVE_SCHEMA}.table_info(\"{table}\");").fetchall()]
+    for column in columns:
+        if column[1] not in archive_columns:
+            execute(conn, FILENAME, f"ALTER TABLE {ARCHIVE_SCHEMA}.\"{table}\" ADD COLUMN \"{column[1]}\" {column[2]};")
+
+    return [column[1] for column in columns]
+
+
+def archive_batch(conn: sqlite3.Connection, table: str, policy: dict, now: int, archive_dir: str,
+                  batch_size: int) -> int:
+    """
+Moves a batch of expired rows of a table to the archives
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the database of the table
+table : str
+    Name of the table
+policy : dict
+    Policy of the table
+now : int
+    Time of the run (unix timestamp)
+archive_dir : str
+    Directory of the archive databases
+batch_size : int
+    Maximum number of rows in the batch
+
+Returns
+-------
+int
+    Number of rows moved (0 if there isn't any expired row anymore, or
+if the batch couldn't be moved)
+    """
+    condition, parameters = expired_condition(policy, now)
+    rows = execute(conn, FILENAME, f"""
+                    SELECT rowid, strftime('%Y-%m', {policy['time']}, 'unixepoch')
+                    FROM "{table}"
+                    WHERE {condition}
+                    LIMIT ?;
+                """, (*parameters, batch_size))
+    rows = rows.fetchall() if rows else []
+
+    rowids_by_month = {}
+    for rowid, month in rows:
+        rowids_by_month.setdefault(month, []).append(rowid)
+
+    # the rows are first copied in the archive of their month (a row
+    # that is already there is ignored), and only the copied rows are
+    # deleted, so a row is never lost
+    archived = []
+    for month, rowids in rowids_by_month.items():
+        path = archive_path(archive_dir, policy["database"], month)
+        if execute(conn, FILENAME, f"ATTACH DATABASE ? AS {ARCHIVE_SCHEMA};", (path,)) is False:
+            continue
+        is_copied = False
+        with transaction(conn, FILENAME):
+            columns = ", ".join(f"\"{column}\"" for column in create_archive_table(conn, table, policy["key"]))
+            execute(conn, FILENAME, f"""
+                    INSERT OR IGNORE INTO {ARCHIVE_SCHEMA}."{table}" ({columns})
+                    SELECT {columns} FROM main."{table}"
+                    WHERE rowid IN ({", ".join("?" * len(rowids))});
+                """, rowids)
+            is_copied = True
+        execute(conn, FILENAME, f"DETACH DATABASE {ARCHIVE_SCHEMA};")
+        if is_copied:
+            archived += rowids
+
+    if len(archived) == 0:
+        return 0
+
+    # a rowid can be given again to a new row, which isn't expired. The
+    # archived rows stay in the aggregates of the database (see
+    # LANDING_AGGREGATES of schema.py)
+    has_aggregates = len(STORAGE.table_columns(conn, "AGGREGATE_STATE")) > 0
+    is_deleted = False
+    with transaction(conn, FILENAME):
+        if has_aggregates:
+            execute(conn, FILENAME, "UPDATE \"AGGREGATE_STATE\" SET asArchiving = 1;")
+        execute(conn, FILENAME, f"""
+                DELETE FROM "{table}"
+                WHERE rowid IN ({", ".join("?" * len(archived))})
+                AND {condition};
+            """, (*archived, *parameters))
+        if has_aggregates:
+            execute(conn, FILENAME, "UPDATE \"AGGREGATE_STATE\" SET asArchiving = 0;")
+        is_deleted = True
+
+    return len(archived) if is_deleted else 0
+
+
+def apply_policy(conn: sqlite3.Connection, table: str, policy: dict, now: int, archive_dir: str,
+                 batch_size: int) -> int:
+    """
+Moves all expired rows of a table to the archives, batch by batch (see
+archive_batch)
+
+Returns
+-------
+int
+    Number of rows moved
+    """
+    moved_c = 0
+    while True:
+        batch_c = archive_batch(conn, table, policy, now, archive_dir, batch_size)
+        moved_c += batch_c
+        if batch_c < batch_size:
+            return moved_c
+
+
+def incremental_vacuum(conn: sqlite3.Connection, pages: int) -> int:
+    """
+Gives at most pages free pages of the database back to the file
+system. A database created before the incremental vacuum is converted
+once (with a whole VACUUM)
+
+Returns
+-------
+int
+    Number of pages freed
+    """
+    # 2 = INCREMENTAL
+    if execute(conn, FILENAME, "PRAGMA auto_vacuum;").fetchone()[0] != 2:
+        print_c("converting the database to the incremental vacuum (whole VACUUM)")
+        execute(conn, FILENAME, "PRAGMA auto_vacuum = INCREMENTAL;")
+        execute(conn, FILENAME, "VACUUM;")
+
+    free_pages = execute(conn, FILENAME, "PRAGMA freelist_count;").fetchone()[0]
+    # the pragma frees the pages while its rows are read
+    execute(conn, FILENAME, f"PRAGMA incremental_vacuum({int(pages)});").fetchall()
+
+    return free_pages - execute(conn, FILENAME, "PRAGMA freelist_count;").fetchone()[0]
+
+
+def apply_retention(policies: dict, now: int) -> None:
+    """
+Applies the policies of all tables, then frees the pages of each
+database
+    """
+    os.makedirs(policies["archive_path"], exist_ok=True)
+
+    tables_by_database = {}
+    for table, policy in policies["tables"].items():
+        tables_by_database.setdefault(policy["database"], []).append(table)
+
+    for database, tables in tables_by_database.items():
+        conn = create_connection(database)
+        migrate(conn, FILENAME, MIGRATIONS.get(database, []))
+        for table in tables:
+            moved_c = apply_policy(conn, table, policies["tables"][table], now, policies["archive_path"],
+                                   policies["batch_size"])
+            print_c(f"{table}: {moved_c} expired rows archived")
+        freed_c = incremental_vacuum(conn, policies["vacuum_pages"])
+        print_c(f"{database}: {freed_c} pages freed")
+        conn.close()
+
+
+if __name__ == "__main__":
+    if STORAGE.name != "sqlite":
+        print_c(f"ERROR: the archives are only made for SQLite, not for {STORAGE.name}")
+        exit()
+
+    while True:
+        print_c("begin of the routine")
+
+        policies = load_policies()
+        apply_retention(policies, int(time.time()))
+
+        print_query_summary(FILENAME)
+        print_c("end of the routine")
+        time.sleep(policies["cycle_time"])
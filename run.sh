@@ -1,6 +1,13 @@
 #!/bin/bash
 
+# the writers of the databases are started first
+exec python3 -u db_writer.py airplane.db &
+exec python3 -u db_writer.py database.db &
+sleep 2
+exec python3 -u ingestion_daemon.py &
 exec python3 -u call_fly_tracker.py &
+exec python3 -u retention.py &
+exec python3 -u query_service.py &
 sleep 15
 exec python3 -u get_ppr.py &
 exec python3 -u get_aftn_by_id.py &
@@ -0,0 +1,562 @@
+"""
+This module has the schema of the two databases: airplane.db (the
+airplanes detected by the get_airplane programs) and database.db (the
+landings of etdex_ponderation.py). Each schema is a list of migrations,
+and the number of migrations applied to a database is kept in its
+user_version (see storage.py), so an existing database is upgraded in
+place, with only the migrations it doesn't have yet (each one in its
+own transaction).
+The indexes follow the queries that are made at each cycle (see
+HOT_QUERIES), and the positions of the evidences are in an R*Tree
+index (see POSITION_INDEXES), kept up to date by triggers, like the
+aggregates of the landings (see LANDING_AGGREGATES). With: python3
+schema.py, both databases are upgraded, and the query plans of these
+queries are checked, so a query that still reads a whole table is
+printed.
+"""
+
+import os
+import re
+from functions import *
+
+FILENAME = os.path.basename(__file__)
+AIRPLANE_DATABASE = "airplane.db"
+LANDING_DATABASE = "database.db"
+
+# R*Tree of the positions of the rows of a table, by database: the id
+# of a position is the primary key of its row (an alias of the rowid, so
+# a VACUUM doesn't change it)
+POSITION_INDEXES = {
+    LANDING_DATABASE: {
+        "UNTREATED_DATA_POSITION": {"table": "UNTREATED_DATA", "id": "udId",
+                                    "latitude": "udLatitude", "longitude": "udLongitude", "time": "udTime"},
+    },
+}
+
+# tables of the landings of TREATED_DATA, by airport and hour, day or
+# source (the one that decided the landing), kept up to date by triggers
+# in the transaction that writes TREATED_DATA: <table>: {<column of the
+# key>: (<type>, <value of a landing>)}
+LANDING_AGGREGATES = {
+    "LANDING_BY_HOUR": {"lhAirport": ("TEXT", "tdAirport"),
+                        "lhHour": ("INTEGER", "ifnull(tdTime, 0) / 3600 * 3600")},
+    "LANDING_BY_DAY": {"ldAirport": ("TEXT", "tdAirport"),
+                       "ldDay": ("INTEGER", "ifnull(tdTime, 0) / 86400 * 86400")},
+    "LANDING_BY_SOURCE": {"lsAirport": ("TEXT", "tdAirport"),
+                          "lsSource": ("TEXT", "ifnull(tdSource, '')")},
+}
+# counters of each aggregate (after the prefix of its key): <column>: 
+# (<type>, <value of a landing>). The landings with a probability of 1
+# were confirmed (by a PPR or an AFTN message)
+LANDING_COUNTERS = {
+    "Landings": ("INTEGER", "1"),
+    "Confirmed": ("INTEGER", "ifnull(tdProb >= 1, 0)"),
+    "Sent": ("INTEGER", "ifnull(tdSent = 1, 0)"),
+    "Probability": ("REAL", "ifnull(tdProb, 0)"),
+}
+
+print_c = lambda text : print_context(FILENAME, text)
+
+
+def create_airplane_tables(conn: sqlite3.Connection, file: str) -> None:
+    """
+Creates the tables AIRPLANE and INVISIBLE_AIRPLANE (version 1)
+    """
+    # we have the basic parameters of a airplane (registration name,
+    # coordinate, altitude, speed and heading) qnd three more aspects :
+    # when it was last seen, if it is invisible, and since when it's
+    # invisible
+    execute(conn, file, """
+            CREATE TABLE IF NOT EXISTS "AIRPLANE" (
+                "apRegis" TEXT NOT NULL,
+                "apLatitude" REAL,
+                "apLongitude" REAL,
+                "apAltitude" REAL,
+                "apTime" INTEGER,
+                "apVelocity" REAL,
+                "apHeading" REAL,
+                "apInvisible" INTEGER,
+                "apInvisibleTime" INTEGER,
+                "apSource" TEXT,
+                CONSTRAINT unique_direction UNIQUE (apRegis, apSource),
+                PRIMARY KEY ("apRegis", "apSource") );
+        """)
+    execute(conn, file, """
+            CREATE TABLE IF NOT EXISTS "INVISIBLE_AIRPLANE" (
+                "apRegis" TEXT NOT NULL,
+                "apLatitude" REAL,
+                "apLongitude" REAL,
+                "apAltitude" REAL,
+                "apTime" INTEGER,
+                "apVelocity" REAL,
+                "apHeading" REAL,
+                "apInvisibleTime" INTEGER,
+                CONSTRAINT unique_direction UNIQUE (apRegis),
+                PRIMARY KEY ("apRegis") );
+        """)
+
+
+def add_airplane_icao(conn: sqlite3.Connection, file: str) -> None:
+    """
+Adds the ICAO address of the airplanes, the key to find the same
+airplane in all sources (version 2)
+    """
+    # the databases created before the versions already have it
+    add_column(conn, file, "AIRPLANE", "apIcao", "INTEGER")
+    add_column(conn, file, "INVISIBLE_AIRPLANE", "apIcao", "INTEGER")
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"airplane_icao\" ON \"AIRPLANE\" (apIcao);")
+
+
+def add_airplane_indexes(conn: sqlite3.Connection, file: str) -> None:
+    """
+Adds the indexes of the checks of check_airplanes.py and of
+upsert_airplanes (version 3)
+    """
+    # the airplanes without signal since some time, and the invisible
+    # airplanes that are too old
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"airplane_visibility\" ON \"AIRPLANE\" (apInvisible, apTime);")
+    execute(conn, file, """
+            CREATE INDEX IF NOT EXISTS "airplane_invisible_time"
+            ON "AIRPLANE" (apInvisible, apInvisibleTime);
+        """)
+    # the airplanes of a source (the primary key begins with apRegis)
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"airplane_source\" ON \"AIRPLANE\" (apSource, apInvisible);")
+    # the airplanes that are too slow (= on the ground)
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"airplane_velocity\" ON \"AIRPLANE\" (apVelocity, apRegis);")
+
+
+def create_landing_tables(conn: sqlite3.Connection, file: str) -> None:
+    """
+Creates the tables UNTREATED_DATA and TREATED_DATA (version 1)
+    """
+    execute(conn, file, """
+            CREATE TABLE IF NOT EXISTS "UNTREATED_DATA" (
+                "udId" INTEGER NOT NULL,
+                "udAirport" TEXT NOT NULL,
+                "udRegis" TEXT,
+                "udProbability" REAL,
+                "udSource" TEXT,
+                "udSource2" TEXT,
+                "udTime" INTEGER,
+                "udLatitude" REAL,
+                "udLongitude" REAL,
+                PRIMARY KEY("udId" AUTOINCREMENT)
+            );
+        """)
+    execute(conn, file, """
+            CREATE TABLE IF NOT EXISTS "TREATED_DATA" (
+                "tdId" INTEGER NOT NULL,
+                "tdAirport" TEXT NOT NULL,
+                "tdAirplane" TEXT,
+                "tdTime" INTEGER,
+                "tdProb" REAL,
+                "tdSent" INTEGER,
+                CONSTRAINT unique_combinaison UNIQUE (tdAirport, tdAirplane),
+                PRIMARY KEY("tdId" AUTOINCREMENT)
+            );
+        """)
+
+
+def add_landing_icao(conn: sqlite3.Connection, file: str) -> None:
+    """
+Adds the ICAO address of the airplane, if the source gives it (version
+2)
+    """
+    add_column(conn, file, "UNTREATED_DATA", "udIcao", "INTEGER")
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"untreated_data_icao\" ON \"UNTREATED_DATA\" (udIcao);")
+
+
+def add_landing_indexes(conn: sqlite3.Connection, file: str) -> None:
+    """
+Adds the indexes of the treatment of etdex_ponderation.py and of
+send_db.py (version 3)
+    """
+    # the evidences of an airport, of an airplane at an airport, and of
+    # an airplane at an airport in a time range
+    execute(conn, file, """
+            CREATE INDEX IF NOT EXISTS "untreated_data_airport"
+            ON "UNTREATED_DATA" (udAirport, udRegis, udTime);
+        """)
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"untreated_data_source\" ON \"UNTREATED_DATA\" (udSource);")
+    # the landings of an airplane (the unique constraint begins with
+    # tdAirport), and the landings to send by airport
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"treated_data_airplane\" ON \"TREATED_DATA\" (tdAirplane, tdTime);")
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"treated_data_sent\" ON \"TREATED_DATA\" (tdSent, tdAirport);")
+
+
+def position_columns(index: dict, row: str="") -> str:
+    """
+Returns the values of the R*Tree of an index (see POSITION_INDEXES),
+from the columns of its table (with the prefix of a row of a trigger,
+like "NEW.")
+    """
+    columns = [index["id"], index["latitude"], index["latitude"], index["longitude"], index["longitude"]]
+    if "time" in index:
+        columns += [index["time"], index["time"]]
+    return ", ".join(f"{row}{column}" for column in columns)
+
+
+def create_position_index(conn: sqlite3.Connection, file: str, name: str, index: dict) -> None:
+    """
+Creates the R*Tree of the positions of a table, with the triggers that
+keep it up to date, and fills it with the rows of the table. The rows
+without position aren't in it
+    """
+    table = index["table"]
+    dimensions = "minLatitude, maxLatitude, minLongitude, maxLongitude"
+    if "time" in index:
+        # the R*Tree keeps 32 bits floats, rounded so the box of a row
+        # always has it, so a query has to compare the time of the rows
+        # again
+        dimensions += ", minTime, maxTime"
+    has_position = lambda row : f"{row}{index['latitude']} IS NOT NULL AND {row}{index['longitude']} IS NOT NULL"
+
+    execute(conn, file, f"CREATE VIRTUAL TABLE IF NOT EXISTS \"{name}\" USING rtree(id, {dimensions});")
+    execute(conn, file, f"""
+            CREATE TRIGGER IF NOT EXISTS "{name.lower()}_insert" AFTER INSERT ON "{table}"
+            WHEN {has_position("NEW.")}
+            BEGIN
+                INSERT INTO "{name}" VALUES ({position_columns(index, "NEW.")});
+            END;
+        """)
+    moved = ", ".join(column for column in (index["id"], index["latitude"], index["longitude"], index.get("time"))
+                      if column is not None)
+    execute(conn, file, f"""
+            CREATE TRIGGER IF NOT EXISTS "{name.lower()}_update" AFTER UPDATE OF {moved} ON "{table}"
+            BEGIN
+                DELETE FROM "{name}" WHERE id = OLD.{index["id"]};
+                INSERT INTO "{name}" SELECT {position_columns(index, "NEW.")} WHERE {has_position("NEW.")};
+            END;
+        """)
+    execute(conn, file, f"""
+            CREATE TRIGGER IF NOT EXISTS "{name.lower()}_delete" AFTER DELETE ON "{table}"
+            BEGIN
+                DELETE FROM "{name}" WHERE id = OLD.{index["id"]};
+            END;
+        """)
+    execute(conn, file, f"""
+            INSERT INTO "{name}"
+            SELECT {position_columns(index)} FROM "{index['table']}"
+            WHERE {index['latitude']} IS NOT NULL AND {index['longitude']} IS NOT NULL;
+        """)
+
+
+def add_evidence_positions(conn: sqlite3.Connection, file: str) -> None:
+    """
+Adds the R*Tree of the positions and times of the evidences, to find
+the evidences near a landing (see nearby_evidences of functions.py)
+(version 4)
+    """
+    # the R*Tree and the triggers only exist in SQLite
+    if STORAGE.name == "sqlite":
+        for name, index in POSITION_INDEXES[LANDING_DATABASE].items():
+            create_position_index(conn, file, name, index)
+
+
+def aggregate_columns(name: str) -> tuple:
+    """
+Returns the columns of the key and the columns of the counters of an
+aggregate (see LANDING_AGGREGATES)
+    """
+    keys = list(LANDING_AGGREGATES[name])
+    prefix = keys[0][:2]
+    return (keys, [prefix + counter for counter in LANDING_COUNTERS])
+
+
+def aggregate_values(name: str, row: str="") -> tuple:
+    """
+Returns the values of the key and of the counters of a landing in an
+aggregate (see landing_values)
+    """
+    return (landing_values([value for _, value in LANDING_AGGREGATES[name].values()], row),
+            landing_values([value for _, value in LANDING_COUNTERS.values()], row))
+
+
+def aggregate_conflict(name: str) -> str:
+    """
+Returns the ON CONFLICT clause that adds the counters of a row to the
+row of an aggregate with the same key
+    """
+    keys, counters = aggregate_columns(name)
+    return f"""
+            ON CONFLICT ({", ".join(keys)}) DO UPDATE SET
+            {", ".join(f"{counter} = {counter} + excluded.{counter}" for counter in counters)}
+        """
+
+
+def landing_sums(name: str, source: str) -> str:
+    """
+Returns the query of the rows of an aggregate, from the landings of a
+table like TREATED_DATA (of the database, or of an attached archive)
+    """
+    values, counter_values = aggregate_values(name)
+    # the WHERE is needed by SQLite before an ON CONFLICT of a SELECT
+    return f"""
+            SELECT {", ".join(values + [f"sum({value})" for value in counter_values])}
+            FROM {source}
+            WHERE 1
+            GROUP BY {", ".join(values)}
+        """
+
+
+def landing_values(expressions, row: str="") -> list:
+    """
+Returns the expressions of the values of a landing, with the prefix of
+a row of a trigger (like "NEW.") before the columns of TREATED_DATA
+    """
+    return [re.sub(r"\b(td\w+)", rf"{row}\1", expression) for expression in expressions]
+
+
+def create_landing_aggregate(conn: sqlite3.Connection, file: str, name: str) -> None:
+    """
+Creates an aggregate of TREATED_DATA (see LANDING_AGGREGATES), with
+the triggers that keep it up to date: a landing that is inserted is
+added to its row, a landing that is deleted is removed from it (except
+when it is archived, see AGGREGATE_STATE), and a landing that is
+updated is removed from its old row, then added to its new row
+    """
+    keys, counters = aggregate_columns(name)
+    definitions = [f"\"{key}\" {type_} NOT NULL" for key, (type_, _) in LANDING_AGGREGATES[name].items()]
+    definitions += [f"\"{counter}\" {type_} NOT NULL" for counter, (type_, _) in zip(counters, LANDING_COUNTERS.values())]
+    execute(conn, file, f"""
+            CREATE TABLE IF NOT EXISTS "{name}" (
+                {", ".join(definitions)},
+                PRIMARY KEY ({", ".join(keys)})
+            );
+        """)
+
+    key_condition = lambda row : " AND ".join(f"{key} = {value}" for key, value in
+                                              zip(keys, aggregate_values(name, row)[0]))
+    add = lambda row : f"""
+                INSERT INTO "{name}" ({", ".join(keys + counters)})
+                VALUES ({", ".join(sum(aggregate_values(name, row), []))})
+                {aggregate_conflict(name)};
+            """
+    remove = lambda row : f"""
+                UPDATE "{name}" SET
+                {", ".join(f"{counter} = {counter} - {value}" for counter, value in
+                           zip(counters, aggregate_values(name, row)[1]))}
+                WHERE {key_condition(row)};
+                DELETE FROM "{name}" WHERE {key_condition(row)} AND {counters[0]} <= 0;
+            """
+
+    execute(conn, file, f"""
+            CREATE TRIGGER IF NOT EXISTS "{name.lower()}_insert" AFTER INSERT ON "TREATED_DATA"
+            BEGIN
+                {add("NEW.")}
+            END;
+        """)
+    execute(conn, file, f"""
+            CREATE TRIGGER IF NOT EXISTS "{name.lower()}_delete" AFTER DELETE ON "TREATED_DATA"
+            WHEN (SELECT asArchiving FROM "AGGREGATE_STATE") = 0
+            BEGIN
+                {remove("OLD.")}
+            END;
+        """)
+    execute(conn, file, f"""
+            CREATE TRIGGER IF NOT EXISTS "{name.lower()}_update"
+            AFTER UPDATE OF tdAirport, tdTime, tdProb, tdSent, tdSource ON "TREATED_DATA"
+            BEGIN
+                {remove("OLD.")}
+                {add("NEW.")}
+            END;
+        """)
+
+
+def add_landings_to_aggregate(conn: sqlite3.Connection, file: str, name: str) -> None:
+    """
+Adds all the landings of TREATED_DATA to an aggregate
+    """
+    keys, counters = aggregate_columns(name)
+    execute(conn, file, f"""
+            INSERT INTO main."{name}" ({", ".join(keys + counters)})
+            {landing_sums(name, 'main."TREATED_DATA"')}
+            {aggregate_conflict(name)};
+        """)
+
+
+def add_landing_aggregates(conn: sqlite3.Connection, file: str) -> None:
+    """
+Adds the source of the landings, and the aggregates of the landings
+(see LANDING_AGGREGATES), filled with the landings of TREATED_DATA
+(version 5)
+    """
+    add_column(conn, file, "TREATED_DATA", "tdSource", "TEXT")
+    # the triggers only exist in SQLite
+    if STORAGE.name != "sqlite":
+        return
+
+    # asArchiving is 1 while retention.py moves landings to the archives
+    # (in its transaction), so they stay in the aggregates
+    execute(conn, file, "CREATE TABLE IF NOT EXISTS \"AGGREGATE_STATE\" (\"asArchiving\" INTEGER NOT NULL);")
+    execute(conn, file, "INSERT INTO \"AGGREGATE_STATE\" SELECT 0 WHERE NOT EXISTS (SELECT * FROM \"AGGREGATE_STATE\");")
+    for name in LANDING_AGGREGATES:
+        create_landing_aggregate(conn, file, name)
+        add_landings_to_aggregate(conn, file, name)
+
+
+def add_landing_time_indexes(conn: sqlite3.Connection, file: str) -> None:
+    """
+Adds the indexes of the pages of query_service.py, by time, and by
+airport and time (version 6)
+    """
+    # the rows of a page are sorted by time and id, the id (rowid) is the
+    # last column of each index
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"treated_data_time\" ON \"TREATED_DATA\" (tdTime);")
+    execute(conn, file, """
+            CREATE INDEX IF NOT EXISTS "treated_data_airport_time"
+            ON "TREATED_DATA" (tdAirport, tdTime);
+        """)
+    execute(conn, file, "CREATE INDEX IF NOT EXISTS \"untreated_data_time\" ON \"UNTREATED_DATA\" (udTime);")
+    execute(conn, file, """
+            CREATE INDEX IF NOT EXISTS "untreated_data_airport_time"
+            ON "UNTREATED_DATA" (udAirport, udTime);
+        """)
+
+
+# the migration n is applied to a database of version n-1, a migration
+# is never changed once released, a new one is added instead
+AIRPLANE_MIGRATIONS = [create_airplane_tables, add_airplane_icao, add_airplane_indexes]
+LANDING_MIGRATIONS = [create_landing_tables, add_landing_icao, add_landing_indexes, add_evidence_positions,
+                      add_landing_aggregates, add_landing_time_indexes]
+MIGRATIONS = {AIRPLANE_DATABASE: AIRPLANE_MIGRATIONS, LANDING_DATABASE: LANDING_MIGRATIONS}
+
+# queries made at each cycle, that shouldn't read a whole table
+HOT_QUERIES = {
+    AIRPLANE_DATABASE: [
+        "UPDATE \"AIRPLANE\" SET apInvisible = 1, apInvisibleTime = ? WHERE apInvisible = 0 AND apTime < ?;",
+        "SELECT DISTINCT apInvisible FROM \"AIRPLANE\" WHERE apRegis = ?;",
+        "SELECT * FROM \"AIRPLANE\" WHERE apRegis = ? ORDER BY apTime DESC LIMIT 1;",
+        "SELECT apRegis FROM \"AIRPLANE\" WHERE apVelocity < ?;",
+        """
+            DELETE FROM "AIRPLANE" WHERE apRegis IN (
+                SELECT apRegis FROM "AIRPLANE" WHERE apInvisible = 1 AND apInvisibleTime < ?
+            );
+        """,
+        "SELECT count(apRegis) FROM \"AIRPLANE\" WHERE apSource = ?;",
+        "SELECT apIcao, apRegis FROM \"AIRPLANE\" WHERE apIcao >= 0 AND apSource != ?;",
+        "SELECT count(apRegis) FROM \"INVISIBLE_AIRPLANE\" WHERE apRegis = ? AND apTime BETWEEN ? AND ?;",
+    ],
+    LANDING_DATABASE: [
+        "SELECT COUNT(udId) FROM \"UNTREATED_DATA\" WHERE udSource = ?;",
+        """
+            SELECT udId, udTime, udAirport, udSource FROM "UNTREATED_DATA"
+            WHERE (udAirport = ? OR udAirport = ?) AND udRegis = ? AND udSource != ?;
+        """,
+        "DELETE FROM \"UNTREATED_DATA\" WHERE udAirport = ? AND udRegis = ?;",
+        "SELECT * FROM \"UNTREATED_DATA\" WHERE udAirport = ?;",
+        "DELETE FROM \"UNTREATED_DATA\" WHERE udAirport = ? AND udRegis = ? AND udTime BETWEEN ? AND ?;",
+        "SELECT udId FROM \"UNTREATED_DATA\" WHERE udRegis = ? AND udAirport = ? AND udTime BETWEEN ? AND ?;",
+        """
+            SELECT count(tdId) FROM "TREATED_DATA"
+            WHERE tdAirport = ? AND tdAirplane = ? AND tdTime BETWEEN ? AND ?;
+        """,
+        "SELECT tdId FROM \"TREATED_DATA\" WHERE tdAirplane = ? AND tdAirport = ? AND tdTime BETWEEN ? AND ?;",
+        "SELECT * FROM \"TREATED_DATA\" WHERE tdAirplane = ?;",
+        "SELECT * FROM \"TREATED_DATA\" WHERE tdSent = 0 AND tdAirport = ?;",
+        # the pages of query_service.py
+        """
+            SELECT * FROM "TREATED_DATA"
+            WHERE tdTime >= ? AND tdTime < ? AND (tdTime, tdId) > (?, ?)
+            ORDER BY tdTime, tdId LIMIT ?;
+        """,
+        """
+            SELECT * FROM "TREATED_DATA"
+            WHERE tdTime >= ? AND tdTime < ? AND (tdTime, tdId) > (?, ?) AND tdAirport = ?
+            ORDER BY tdTime, tdId LIMIT ?;
+        """,
+        """
+            SELECT * FROM "UNTREATED_DATA"
+            WHERE udTime >= ? AND udTime < ? AND (udTime, udId) > (?, ?) AND udAirport = ?
+            ORDER BY udTime, udId LIMIT ?;
+        """,
+    ],
+}
+
+
+def migrate(conn: sqlite3.Connection, file: str, migrations: list) -> bool:
+    """
+Applies the migrations that the database doesn't have yet, each one in
+its own transaction with the new version (so a database is never
+between two versions)
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the database
+file : str
+    File which makes the queries
+migrations : list
+    Migrations of the database (AIRPLANE_MIGRATIONS or
+LANDING_MIGRATIONS)
+
+Returns
+-------
+bool
+    True if the database is at the last version
+    """
+    version = STORAGE.get_version(conn)
+    for new_version, migration in enumerate(migrations[version:], version + 1):
+        is_migrated = False
+        with transaction(conn, file):
+            # another program could have migrated it in the meantime
+            if STORAGE.get_version(conn) < new_version:
+                migration(conn, file)
+                STORAGE.set_version(conn, new_version)
+                print_context(file, f"database migrated to the version {new_version} ({migration.__name__})")
+            is_migrated = True
+        if not is_migrated:
+            return False
+
+    return True
+
+
+def check_query_plans(conn: sqlite3.Connection, file: str, queries: list) -> list:
+    """
+Returns the queries that read a whole table (without index), with the
+EXPLAIN QUERY PLAN of SQLite
+
+Parameters
+----------
+conn : sqlite3.Connection
+    Connection to the database
+file : str
+    File which makes the queries
+queries : list
+    Queries to check (their parameters are replaced by NULL)
+
+Returns
+-------
+list
+    The queries with a full scan, and the step of their plan that reads
+the table
+    """
+    full_scans = []
+    for query_ in queries:
+        plan = execute(conn, file, f"EXPLAIN QUERY PLAN {query_}", [None] * query_.count("?"))
+        for step in (plan.fetchall() if plan else []):
+            # a scan reads all the rows (of the table, or of an index),
+            # a search only reads the rows it needs
+            if step[3].startswith("SCAN"):
+                full_scans.append((" ".join(query_.split()), step[3]))
+
+    return full_scans
+
+
+if __name__ == "__main__":
+    print_c("begin of the routine")
+
+    for database, migrations in MIGRATIONS.items():
+        conn = create_connection(database)
+        if not migrate(conn, FILENAME, migrations):
+            print_c(f"ERROR: {database} couldn't be migrated")
+        elif STORAGE.name != "sqlite":
+            print_c(f"{database}: version {len(migrations)} (the query plans are only checked with SQLite)")
+        else:
+            full_scans = check_query_plans(conn, FILENAME, HOT_QUERIES[database])
+            for query_, step in full_scans:
+                print_c(f"full scan in {database}: {step} for: {query_}")
+            print_c(f"{database}: version {len(migrations)}, {len(full_scans)} full scans")
+        conn.close()
+
+    print_c("end of the routine")
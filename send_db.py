@@ -8,6 +8,8 @@ import os
 import json
 import requests
 from functions import *
+from schema import LANDING_MIGRATIONS, migrate
+from db_writer import write
 from datetime import datetime
 
 FILENAME = os.path.basename(__file__)
@@ -18,7 +20,8 @@ AIRPORT_SEND_FILE = "airport_to_send.json"
 print_c = lambda text : print_context(FILENAME, text)
 
 conn = create_connection(DATABASE_PATH)
-query = lambda x: query_to_bdd(conn, FILENAME, x)
+query = lambda query_, parameters=() : execute(conn, FILENAME, query_, parameters)
+migrate(conn, FILENAME, LANDING_MIGRATIONS)
 
 # we look up which for which airport we need to send the data
 with open(AIRPORT_SEND_FILE) as file:
@@ -28,9 +31,11 @@ with open(AIRPORT_SEND_FILE) as file:
 # next we parse every airport name, and see if there is data for that
 counter = 0
 for airport, password in airport_to_send.items():
-    new_movement = query(f"SELECT * FROM \"TREATED_DATA\" WHERE tdSent = '0' AND tdAirport = '{airport}';")
+    new_movement = query("SELECT * FROM \"TREATED_DATA\" WHERE tdSent = 0 AND tdAirport = ?;", (airport,))
 
     if new_movement:
+        new_movement = new_movement.fetchall()
+        sent_list = []
 
         first_movement = True
         for movement in new_movement:
@@ -115,17 +120,21 @@ for airport, password in airport_to_send.items():
 
             format_json = json.dumps(format_json)
 
-            response = requests.post(URL, data=format_json, auth=(airport, password))
+            try:
+                response = requests.post(URL, data=format_json, auth=(airport, password))
+            except Exception:
+                # the sent flags of the movements already posted are
+                # written before the error stops the program, so they are
+                # never sent again
+                write(DATABASE_PATH, conn, FILENAME, [("UPDATE \"TREATED_DATA\" SET tdSent = 1 WHERE tdId = ?;", sent_list)])
+                raise
 
             if response.status_code == 200:
                 # if the landing has been sent, we print it ...
                 print_c(f"Movement sent: {movement[2]} to {movement[1]} at {airplane_time}")
-                # ... update the movement to "sent" ...
-                query(f"""
-                        UPDATE "TREATED_DATA"
-                        SET tdSent = '1'
-                        WHERE tdId = '{movement[0]}';
-                    """)
+                # ... update the movement to "sent" (all the movements of
+                # the airport are updated at once) ...
+                sent_list.append((movement[0],))
                 # and add one to the counter
                 counter += 1
             else:
@@ -133,5 +142,7 @@ for airport, password in airport_to_send.items():
                 # with the database id of the movement
                 print_c(f"Error: {response} for {movement[0]}\n{response.text}")
 
+        write(DATABASE_PATH, conn, FILENAME, [("UPDATE \"TREATED_DATA\" SET tdSent = 1 WHERE tdId = ?;", sent_list)])
+
 print_c(f"Number of sent movements: {counter}")
 conn.close()
@@ -0,0 +1,112 @@
+"""
+This module has the spatial and fuzzy functions of the programs: the
+distance between two positions (haversine), and the similarity of two
+registrations. They are also SQL functions of the SQLite connections
+(see register_functions), so a query can filter its rows with them,
+after an R*Tree index (see schema.py) has found the rows in the
+bounding box of a position.
+"""
+
+import sqlite3
+from math import asin, cos, degrees, radians, sin, sqrt
+
+# mean radius of the Earth (in km)
+EARTH_RADIUS = 6371.0088
+
+
+def haversine(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float: #|None
+    """
+Returns the distance between two positions, on a sphere (in km), or
+None if a coordinate is missing
+    """
+    if None in (latitude1, longitude1, latitude2, longitude2):
+        return None
+
+    latitude1, longitude1, latitude2, longitude2 = map(radians, (latitude1, longitude1, latitude2, longitude2))
+    a = sin((latitude2 - latitude1) / 2) ** 2 \
+        + cos(latitude1) * cos(latitude2) * sin((longitude2 - longitude1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * asin(min(1, sqrt(a)))
+
+
+def regis_similarity(regis1: str, regis2: str) -> float: #|None
+    """
+Returns the similarity of two registrations: 1 if they are the same,
+and 1.5/len(regis1) less for each letter that differs (the Hamming
+distance, where the letters of the longest one that the other doesn't
+have also differ). It can be negative. None if a registration is
+missing
+    """
+    if regis1 is None or regis2 is None or len(regis1) == 0:
+        return None
+
+    diff_letter = sum(letter1 != letter2 for letter1, letter2 in zip(regis1, regis2)) \
+                  + abs(len(regis1) - len(regis2))
+
+    return 1 - (diff_letter / len(regis1)) * 1.5
+
+
+def bounding_box(latitude: float, longitude: float, distance: float) -> tuple:
+    """
+Returns the box (min latitude, max latitude, min longitude, max
+longitude) around a position, that has all the positions at less than
+distance km of it
+    """
+    delta_latitude = degrees(distance / EARTH_RADIUS)
+    min_latitude, max_latitude = latitude - delta_latitude, latitude + delta_latitude
+    if min_latitude <= -90 or max_latitude >= 90 or cos(radians(max(abs(min_latitude), abs(max_latitude)))) == 0:
+        # the box has a pole
+        return (max(-90, min_latitude), min(90, max_latitude), -180, 180)
+
+    delta_longitude = delta_latitude / cos(radians(max(abs(min_latitude), abs(max_latitude))))
+    if longitude - delta_longitude < -180 or longitude + delta_longitude > 180:
+        # the box crosses the antimeridian
+        return (min_latitude, max_latitude, -180, 180)
+
+    return (min_latitude, max_latitude, longitude - delta_longitude, longitude + delta_longitude)
+
+
+def register_functions(connection: sqlite3.Connection) -> None:
+    """
+Adds the SQL functions haversine(latitude1, longitude1, latitude2,
+longitude2) and regis_similarity(regis1, regis2) to a connection
+    """
+    connection.create_function("haversine", 4, haversine, deterministic=True)
+    connection.create_function("regis_similarity", 2, regis_similarity, deterministic=True)
+
+
+class AirportIndex:
+    """
+R*Tree of the positions of the airports (in memory), to find the
+airports of a zone without testing all of them
+    """
+    def __init__(self, airports: list):
+        # airports with their coordinates (see filter_airports of
+        # get_airport_by_zone.py)
+        self.airports = airports
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.execute("""
+                CREATE VIRTUAL TABLE "AIRPORT_POSITION"
+                USING rtree(id, minLatitude, maxLatitude, minLongitude, maxLongitude);
+            """)
+        self.connection.executemany("INSERT INTO \"AIRPORT_POSITION\" VALUES (?, ?, ?, ?, ?);",
+                                    ((index, float(airport["latitude"]), float(airport["latitude"]),
+                                      float(airport["longitude"]), float(airport["longitude"]))
+                                     for index, airport in enumerate(airports)))
+
+    def in_box(self, zone: tuple) -> list:
+        """
+Returns the airports in the bounding box of a zone (a list of (latitude,
+longitude)), in the order of the list of airports. They still have to
+be tested with the zone itself
+        """
+        latitudes = [point[0] for point in zone]
+        longitudes = [point[1] for point in zone]
+        rows = self.connection.execute("""
+                SELECT id FROM "AIRPORT_POSITION"
+                WHERE maxLatitude >= ? AND minLatitude <= ?
+                AND maxLongitude >= ? AND minLongitude <= ?
+                ORDER BY id;
+            """, (min(latitudes), max(latitudes), min(longitudes), max(longitudes))).fetchall()
+
+        return [self.airports[row[0]] for row in rows]
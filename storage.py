@@ -0,0 +1,317 @@
+"""
+This module is the storage under the functions of functions.py: the
+databases are SQLite files (by default) or PostgreSQL databases, as
+written in the STORAGE_FILE:
+{
+    "backend": "sqlite"
+}
+or:
+{
+    "backend": "postgresql",
+    "databases": {
+        "airplane.db": <dsn of the airplane database>,
+        "database.db": <dsn of the landing database>
+    },
+    "pool_size": <maximum number of connections by database>
+}
+The programs keep the same queries, written for SQLite. With PostgreSQL,
+the connections come from a pool (one by database), the queries are
+translated (see translate_query) and prepared on the server the first
+time they are made, and an insert of many rows is loaded with COPY (see
+PostgresConnection.copy_insert). PostgreSQL needs the modules psycopg
+and psycopg_pool.
+"""
+
+import json
+import re
+import sqlite3
+import threading
+from functools import lru_cache
+from spatial import register_functions
+
+try:
+    import psycopg
+    from psycopg.pq import TransactionStatus
+    from psycopg_pool import ConnectionPool
+except ImportError:
+    psycopg = None
+
+STORAGE_FILE = "storage.json"
+# maximum time to wait for a lock of the database (in seconds)
+BUSY_TIMEOUT = 30
+# pragmas of all connections: with the WAL journal, the readers never
+# block the writer (and the writer never blocks the readers), and a
+# commit doesn't have to wait that the disk is synchronized. The free
+# pages of a new database can be given back to the file system (see
+# retention.py)
+PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -20000,           # in KiB
+    "mmap_size": 256 * 1024 * 1024, # in bytes
+    "temp_store": "MEMORY",
+}
+# errors of the databases, of all storages
+ERRORS = (sqlite3.Error,) if psycopg is None else (sqlite3.Error, psycopg.Error)
+# an insert of at least that many rows is loaded with COPY (PostgreSQL)
+COPY_MIN_ROWS = 50
+
+# INSERT [OR IGNORE] INTO <table> (<columns>) VALUES (<values>) <rest>
+INSERT_VALUES = re.compile(r"\s*INSERT\s+(OR\s+IGNORE\s+)?INTO\s+\"?(\w+)\"?\s*\(([^)]*)\)\s*VALUES\s*\(([^)]*)\)(.*)$",
+                           re.IGNORECASE | re.DOTALL)
+
+
+class SqliteStorage:
+    """
+Databases in SQLite files
+    """
+    name = "sqlite"
+
+    def connect(self, path: str, check_same_thread: bool=True) -> sqlite3.Connection:
+        """
+Opens a database in WAL mode, that waits at most BUSY_TIMEOUT seconds
+if the database is locked (see PRAGMAS), with the SQL functions of
+spatial.py
+        """
+        connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=check_same_thread)
+        for pragma, value in PRAGMAS.items():
+            connection.execute(f"PRAGMA {pragma} = {value};")
+        register_functions(connection)
+
+        return connection
+
+    def table_columns(self, connection: sqlite3.Connection, table: str) -> list:
+        """
+Returns the names of the columns of a table
+        """
+        return [column[1] for column in connection.execute(f"PRAGMA table_info(\"{table}\");").fetchall()]
+
+    def get_version(self, connection: sqlite3.Connection) -> int:
+        """
+Returns the version of the schema of a database (see schema.py)
+        """
+        return connection.execute("PRAGMA user_version;").fetchone()[0]
+
+    def set_version(self, connection: sqlite3.Connection, version: int) -> None:
+        """
+Writes the version of the schema of a database, in its transaction
+        """
+        connection.execute(f"PRAGMA user_version = {int(version)};")
+
+    def set_durable(self, connection: sqlite3.Connection) -> None:
+        """
+Makes each commit wait until it is on the disk
+        """
+        connection.execute("PRAGMA synchronous = FULL;")
+
+    def set_read_only(self, connection: sqlite3.Connection) -> None:
+        """
+Makes a connection fail on the queries that write
+        """
+        connection.execute("PRAGMA query_only = ON;")
+
+
+@lru_cache(maxsize=1024)
+def translate_query(query_: str) -> str:
+    """
+Translates a query written for SQLite to PostgreSQL: the placeholders
+(? becomes %s), the identifiers (without quotes, so they are all in
+lower case), the REAL columns (8 bytes in SQLite, but 4 bytes in
+PostgreSQL, too few for a position), and the syntax that only SQLite has
+(INSERT OR IGNORE, BEGIN IMMEDIATE, AUTOINCREMENT, WHERE 1, the temp
+schema, the names of the constraints, that are unique by database in
+PostgreSQL). The queries don't have ? in their strings
+
+Parameters
+----------
+query_ : str
+    Query written for SQLite
+
+Returns
+-------
+str
+    The same query for PostgreSQL
+    """
+    query_ = query_.replace("%", "%%").replace("?", "%s").replace("\"", "")
+    query_ = re.sub(r"\bBEGIN\s+IMMEDIATE\b", "BEGIN", query_, flags=re.IGNORECASE)
+    query_ = re.sub(r"\btemp\.", "pg_temp.", query_)
+    query_ = re.sub(r"\bREAL\b", "DOUBLE PRECISION", query_)
+    query_ = re.sub(r"\bWHERE\s+1\b(?!\s*[=<>!])", "WHERE TRUE", query_, flags=re.IGNORECASE)
+    query_ = re.sub(r"\bCONSTRAINT\s+\w+\s+(?=UNIQUE\b)", "", query_, flags=re.IGNORECASE)
+
+    for column in re.findall(r"PRIMARY\s+KEY\s*\(\s*(\w+)\s+AUTOINCREMENT\s*\)", query_, flags=re.IGNORECASE):
+        query_ = re.sub(rf"\b{column}\s+INTEGER\s+NOT\s+NULL", f"{column} BIGINT GENERATED BY DEFAULT AS IDENTITY", query_)
+        query_ = re.sub(rf"PRIMARY\s+KEY\s*\(\s*{column}\s+AUTOINCREMENT\s*\)", f"PRIMARY KEY ({column})", query_)
+
+    if re.match(r"\s*INSERT\s+OR\s+IGNORE\b", query_, flags=re.IGNORECASE):
+        query_ = re.sub(r"INSERT\s+OR\s+IGNORE", "INSERT", query_, count=1, flags=re.IGNORECASE)
+        query_ = query_.rstrip().rstrip(";") + " ON CONFLICT DO NOTHING;"
+
+    return query_
+
+
+class PostgresConnection:
+    """
+Connection of a pool, with the methods of a sqlite3.Connection that
+the programs use. The connection is in autocommit, outside of the
+transactions that begin with a BEGIN (see functions.transaction)
+    """
+    def __init__(self, pool, connection):
+        self.pool = pool
+        self.connection = connection
+
+    @property
+    def in_transaction(self) -> bool:
+        return self.connection.info.transaction_status != TransactionStatus.IDLE
+
+    def execute(self, query_: str, parameters=()):
+        return self.connection.execute(translate_query(query_), tuple(parameters))
+
+    def executemany(self, query_: str, parameters_list):
+        parameters_list = list(parameters_list)
+        insert = INSERT_VALUES.match(query_)
+        if insert is not None and len(parameters_list) >= COPY_MIN_ROWS:
+            return self.copy_insert(insert, parameters_list)
+
+        cursor = self.connection.cursor()
+        cursor.executemany(translate_query(query_), parameters_list)
+        return cursor
+
+    def copy_insert(self, insert, parameters_list: list):
+        """
+Makes an insert of many rows with COPY: the rows are copied in a
+temporary table, then inserted in the table with one query (with the
+ON CONFLICT clause of the insert)
+        """
+        is_ignore, table, columns, values, rest = insert.groups()
+        columns = [column.strip().strip("\"") for column in columns.split(",")]
+        values = [value.strip() for value in values.split(",")]
+        copied = ", ".join(column for column, value in zip(columns, values) if value == "?")
+        # the values that aren't parameters are constants of the query
+        selected = ", ".join(column if value == "?" else value for column, value in zip(columns, values))
+        rest = rest.strip().rstrip(";")
+        if is_ignore:
+            rest += " ON CONFLICT DO NOTHING"
+
+        cursor = self.connection.cursor()
+        with self.connection.transaction():
+            cursor.execute(f"DROP TABLE IF EXISTS pg_temp.copy_{table};")
+            cursor.execute(f"CREATE TEMP TABLE copy_{table} AS SELECT {copied} FROM {table} WITH NO DATA;")
+            with cursor.copy(f"COPY copy_{table} ({copied}) FROM STDIN") as copy:
+                for parameters in parameters_list:
+                    copy.write_row(parameters)
+            cursor.execute(translate_query(f"INSERT INTO {table} ({', '.join(columns)}) "
+                                           f"SELECT {selected} FROM copy_{table} {rest};"))
+        return cursor
+
+    def commit(self) -> None:
+        if self.in_transaction:
+            self.connection.execute("COMMIT;")
+
+    def rollback(self) -> None:
+        if self.in_transaction:
+            self.connection.execute("ROLLBACK;")
+
+    def close(self) -> None:
+        """
+Gives the connection back to its pool
+        """
+        self.rollback()
+        self.pool.putconn(self.connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> bool:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.rollback()
+        return False
+
+
+class PostgresStorage:
+    """
+Databases in PostgreSQL, with a pool of connections by database
+    """
+    name = "postgresql"
+
+    def __init__(self, databases: dict, pool_size: int):
+        if psycopg is None:
+            raise ImportError("the PostgreSQL storage needs the modules psycopg and psycopg_pool")
+        # path of the database (in the programs) -> dsn
+        self.databases = databases
+        self.pool_size = pool_size
+        self.pools = {}
+        self.lock = threading.Lock()
+
+    def connect(self, path: str, check_same_thread: bool=True) -> PostgresConnection:
+        """
+Takes a connection from the pool of a database. The statements are
+prepared on the server the first time they are made
+        """
+        with self.lock:
+            pool = self.pools.get(path)
+            if pool is None:
+                pool = self.pools[path] = ConnectionPool(self.databases[path], min_size=1, max_size=self.pool_size,
+                                                         kwargs={"autocommit": True, "prepare_threshold": 0})
+
+        return PostgresConnection(pool, pool.getconn(timeout=BUSY_TIMEOUT))
+
+    def table_columns(self, connection: PostgresConnection, table: str) -> list:
+        """
+Returns the names of the columns of a table (in lower case)
+        """
+        return [column[0] for column in connection.execute("""
+                    SELECT column_name
+                    FROM information_schema.columns
+                    WHERE table_schema = current_schema()
+                    AND table_name = ?;
+                """, (table.lower(),)).fetchall()]
+
+    def get_version(self, connection: PostgresConnection) -> int:
+        """
+Returns the version of the schema of a database (see schema.py)
+        """
+        connection.execute("CREATE TABLE IF NOT EXISTS SCHEMA_VERSION (version INTEGER NOT NULL);")
+        row = connection.execute("SELECT max(version) FROM SCHEMA_VERSION;").fetchone()
+        return row[0] or 0
+
+    def set_version(self, connection: PostgresConnection, version: int) -> None:
+        """
+Writes the version of the schema of a database, in its transaction
+        """
+        connection.execute("DELETE FROM SCHEMA_VERSION;")
+        connection.execute("INSERT INTO SCHEMA_VERSION (version) VALUES (?);", (int(version),))
+
+    def set_durable(self, connection: PostgresConnection) -> None:
+        """
+Makes each commit wait until it is on the disk
+        """
+        connection.execute("SET synchronous_commit = on;")
+
+    def set_read_only(self, connection: PostgresConnection) -> None:
+        """
+Makes a connection fail on the queries that write
+        """
+        connection.execute("SET default_transaction_read_only = on;")
+
+
+def load_storage(path: str=STORAGE_FILE):
+    """
+Returns the storage of the STORAGE_FILE (SQLite if the file doesn't
+exist)
+    """
+    try:
+        with open(path) as file:
+            content = json.loads(file.read())
+    except FileNotFoundError:
+        return SqliteStorage()
+
+    if content["backend"] == PostgresStorage.name:
+        return PostgresStorage(content["databases"], content.get("pool_size", 4))
+    return SqliteStorage()
+
+
+STORAGE = load_storage()
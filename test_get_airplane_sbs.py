@@ -0,0 +1,54 @@
+"""
+Tests of the SBS receiver of get_airplane_sbs.py: a recorded stream is
+replayed, and the Positions must be the ones of the end of the stream,
+with the time logged in UTC whatever the timezone of the computer is
+"""
+
+import time
+import pytest
+from calendar import timegm
+from get_airplane_sbs import replay
+
+# recorded lines of a receiver: 4CA2D6 sends its callsign, position and
+# velocity, 3C6586 never sends its velocity, 40621D is stale at the end
+# of the stream, and the last line is corrupted
+RECORDED_STREAM = """\
+MSG,1,1,1,4CA2D6,1,2024/05/01,12:00:00.000,2024/05/01,12:00:00.000,EI-ABC  ,,,,,,,,,,,
+MSG,3,1,1,4CA2D6,1,2024/05/01,12:00:01.000,2024/05/01,12:00:01.000,,3000,,,53.42130,-6.27007,,,0,0,0,0
+MSG,4,1,1,4CA2D6,1,2024/05/01,12:00:02.000,2024/05/01,12:00:02.000,,,120,270,,,-640,,,,,0
+MSG,1,1,1,3C6586,1,2024/05/01,12:00:02.000,2024/05/01,12:00:02.000,DLH4AB  ,,,,,,,,,,,
+MSG,3,1,1,3C6586,1,2024/05/01,12:00:03.000,2024/05/01,12:00:03.000,,12000,,,53.50000,-6.10000,,,0,0,0,0
+MSG,1,1,1,40621D,1,2024/05/01,11:58:00.000,2024/05/01,11:58:00.000,GABCD   ,,,,,,,,,,,
+MSG,3,1,1,40621D,1,2024/05/01,11:58:00.000,2024/05/01,11:58:00.000,,2000,,,53.30000,-6.30000,,,0,0,0,0
+MSG,4,1,1,40621D,1,2024/05/01,11:58:00.000,2024/05/01,11:58:00.000,,,100,90,,,0,,,,,0
+MSG,3,1,1,4CA2D6,1,2024/05/01,12:00:04
+"""
+
+
+@pytest.fixture
+def timezone(monkeypatch):
+    """
+Runs the test in a timezone far from UTC
+    """
+    monkeypatch.setenv("TZ", "Asia/Tokyo")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_replay(tmp_path, timezone):
+    path = tmp_path / "stream.sbs"
+    path.write_text(RECORDED_STREAM, encoding="ascii")
+
+    airplane_data = replay(str(path))
+
+    assert list(airplane_data) == ["EIABC"]
+    position = airplane_data["EIABC"]
+    assert position.time == timegm((2024, 5, 1, 12, 0, 1, 0, 0, 0))
+    assert position.latitude == pytest.approx(53.4213)
+    assert position.longitude == pytest.approx(-6.27007)
+    assert position.altitude == pytest.approx(3000 * 0.3048)
+    assert position.velocity == pytest.approx(120 * 0.5144)
+    assert position.heading == 270
+    assert position.icao == 0x4CA2D6
@@ -0,0 +1,216 @@
+"""
+Tests of the storages of storage.py: the functions of functions.py and
+the migrations of schema.py are run on each storage, so both have the
+same behaviour. The PostgreSQL tests need the modules psycopg and
+psycopg_pool, and the dsn of an empty test database in the environment
+variable STORAGE_TEST_DSN (its tables are dropped after each test),
+otherwise they are skipped:
+STORAGE_TEST_DSN="postgresql://user@localhost/etdex_test" python3 -m pytest test_storage.py
+"""
+
+import os
+import pytest
+import functions
+import schema
+import storage
+from functions import HEARTBEAT_TIME, execute, executemany, transaction, upsert_airplanes
+from normalizer import Position
+from schema import AIRPLANE_DATABASE, AIRPLANE_MIGRATIONS, migrate
+from storage import COPY_MIN_ROWS, INSERT_VALUES, translate_query
+
+FILENAME = os.path.basename(__file__)
+# tables that the tests create
+TEST_TABLES = ["TEST_ROW", "AIRPLANE", "INVISIBLE_AIRPLANE", "SCHEMA_VERSION"]
+TEST_ROW_TABLE = """
+        CREATE TABLE IF NOT EXISTS "TEST_ROW" (
+            "trId" INTEGER NOT NULL,
+            "trName" TEXT,
+            "trFlag" INTEGER,
+            CONSTRAINT unique_name UNIQUE (trName),
+            PRIMARY KEY("trId" AUTOINCREMENT)
+        );
+    """
+
+
+def drop_test_tables(test_storage: storage.PostgresStorage, path: str) -> None:
+    """
+Drops the tables of the tests in a PostgreSQL database
+    """
+    conn = test_storage.connect(path)
+    for table in TEST_TABLES:
+        conn.execute(f"DROP TABLE IF EXISTS \"{table}\" CASCADE;")
+    conn.close()
+
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def database(request, tmp_path, monkeypatch) -> str:
+    """
+Returns the path of an empty database, with the storage of the test as
+the STORAGE of the programs
+    """
+    if request.param == "sqlite":
+        test_storage = storage.SqliteStorage()
+        path = str(tmp_path / AIRPLANE_DATABASE)
+    else:
+        dsn = os.environ.get("STORAGE_TEST_DSN")
+        if storage.psycopg is None or dsn is None:
+            pytest.skip("PostgreSQL needs psycopg, psycopg_pool and STORAGE_TEST_DSN")
+        path = AIRPLANE_DATABASE
+        test_storage = storage.PostgresStorage({path: dsn}, 2)
+        drop_test_tables(test_storage, path)
+
+    for module in (storage, functions, schema):
+        monkeypatch.setattr(module, "STORAGE", test_storage)
+    yield path
+
+    if request.param == "postgresql":
+        drop_test_tables(test_storage, path)
+        for pool in test_storage.pools.values():
+            pool.close()
+
+
+@pytest.fixture
+def conn(database: str):
+    """
+Returns a connection to the database, with the TEST_ROW table
+    """
+    connection = functions.create_connection(database)
+    assert execute(connection, FILENAME, TEST_ROW_TABLE) is not False
+    yield connection
+    connection.close()
+
+
+def names(connection) -> list:
+    return [row[0] for row in execute(connection, FILENAME, "SELECT trName FROM \"TEST_ROW\" ORDER BY trName;")]
+
+
+def test_translate_query():
+    assert translate_query("SELECT * FROM \"TEST_ROW\" WHERE trName LIKE 'a%' AND trId = ?;") \
+        == "SELECT * FROM TEST_ROW WHERE trName LIKE 'a%%' AND trId = %s;"
+    assert translate_query("BEGIN IMMEDIATE;") == "BEGIN;"
+    assert translate_query("DELETE FROM temp.\"SEEN_AIRPLANE\";") == "DELETE FROM pg_temp.SEEN_AIRPLANE;"
+    assert translate_query("SELECT 1 FROM \"TEST_ROW\" WHERE 1 GROUP BY trName;") \
+        == "SELECT 1 FROM TEST_ROW WHERE TRUE GROUP BY trName;"
+    assert translate_query("SELECT 1 FROM \"TEST_ROW\" WHERE 1 = trId;") == "SELECT 1 FROM TEST_ROW WHERE 1 = trId;"
+    assert translate_query("INSERT OR IGNORE INTO \"TEST_ROW\" (trName) VALUES (?);") \
+        == "INSERT INTO TEST_ROW (trName) VALUES (%s) ON CONFLICT DO NOTHING;"
+
+    table = " ".join(translate_query(TEST_ROW_TABLE).split())
+    assert "trId BIGINT GENERATED BY DEFAULT AS IDENTITY" in table
+    assert "PRIMARY KEY(trId)" in table or "PRIMARY KEY (trId)" in table
+    assert "AUTOINCREMENT" not in table
+    assert "CONSTRAINT" not in table and "UNIQUE (trName)" in table
+    assert translate_query("CREATE TABLE T (\"tLatitude\" REAL);") == "CREATE TABLE T (tLatitude DOUBLE PRECISION);"
+
+
+def test_insert_values():
+    # the insert of many rows that PostgreSQL loads with COPY
+    insert = INSERT_VALUES.match("""
+            INSERT OR IGNORE INTO "AIRPLANE"
+            (apRegis, apLatitude, apSource)
+            VALUES (?, ?, 'test')
+            ON CONFLICT(apRegis, apSource) DO UPDATE SET apLatitude = excluded.apLatitude;
+        """)
+    is_ignore, table, columns, values, rest = insert.groups()
+    assert is_ignore is not None and table == "AIRPLANE"
+    assert [column.strip() for column in columns.split(",")] == ["apRegis", "apLatitude", "apSource"]
+    assert [value.strip() for value in values.split(",")] == ["?", "?", "'test'"]
+    assert " ".join(rest.split()) == "ON CONFLICT(apRegis, apSource) DO UPDATE SET apLatitude = excluded.apLatitude;"
+    # an insert in another schema isn't loaded with COPY
+    assert INSERT_VALUES.match("INSERT OR IGNORE INTO temp.\"SEEN_AIRPLANE\" VALUES (?);") is None
+
+
+def test_execute(conn):
+    assert execute(conn, FILENAME, "INSERT INTO \"TEST_ROW\" (trName, trFlag) VALUES (?, ?);", ("a%b", 1)) is not False
+    assert execute(conn, FILENAME, "SELECT trName, trFlag FROM \"TEST_ROW\" WHERE trName LIKE 'a%';").fetchall() \
+        == [("a%b", 1)]
+
+    # an error is printed, and the query is rolled back
+    assert execute(conn, FILENAME, "INSERT INTO \"TEST_ROW\" (trName, trFlag) VALUES (?, ?);", ("a%b", 2)) is False
+    assert not conn.in_transaction
+    assert execute(conn, FILENAME, "SELECT count(*) FROM \"TEST_ROW\";").fetchone()[0] == 1
+
+
+@pytest.mark.parametrize("row_c", [3, COPY_MIN_ROWS * 2])
+def test_executemany(conn, row_c):
+    # the first rows are already there, and are ignored (with COPY for
+    # the biggest insert in PostgreSQL)
+    executemany(conn, FILENAME, "INSERT INTO \"TEST_ROW\" (trName, trFlag) VALUES (?, 0);", [("name000",), ("name001",)])
+    cursor = executemany(conn, FILENAME, "INSERT OR IGNORE INTO \"TEST_ROW\" (trName, trFlag) VALUES (?, 1);",
+                         [(f"name{index:03}",) for index in range(row_c)])
+
+    assert cursor is not False
+    assert names(conn) == [f"name{index:03}" for index in range(row_c)]
+    assert execute(conn, FILENAME, "SELECT count(DISTINCT trId), sum(trFlag) FROM \"TEST_ROW\";").fetchone() \
+        == (row_c, row_c - 2)
+
+
+def test_transaction(conn):
+    with transaction(conn, FILENAME):
+        execute(conn, FILENAME, "INSERT INTO \"TEST_ROW\" (trName) VALUES (?);", ("a",))
+        executemany(conn, FILENAME, "INSERT INTO \"TEST_ROW\" (trName) VALUES (?);", [("b",), ("c",)])
+        assert conn.in_transaction
+    assert not conn.in_transaction
+    assert names(conn) == ["a", "b", "c"]
+
+    # a query that fails rolls back the whole transaction, and the rest
+    # of the block is skipped
+    is_ended = False
+    with transaction(conn, FILENAME):
+        execute(conn, FILENAME, "INSERT INTO \"TEST_ROW\" (trName) VALUES (?);", ("d",))
+        execute(conn, FILENAME, "INSERT INTO \"TEST_ROW\" (trName) VALUES (?);", ("a",))
+        is_ended = True
+    assert not is_ended
+    assert not conn.in_transaction
+    assert names(conn) == ["a", "b", "c"]
+
+
+def test_migrate(database):
+    conn = functions.create_connection(database)
+    assert migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+    assert functions.STORAGE.get_version(conn) == len(AIRPLANE_MIGRATIONS)
+    # a database at the last version isn't changed
+    assert migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+    assert functions.STORAGE.get_version(conn) == len(AIRPLANE_MIGRATIONS)
+
+    columns = [column.lower() for column in functions.STORAGE.table_columns(conn, "AIRPLANE")]
+    assert "apicao" in columns and "apsource" in columns
+    conn.close()
+
+
+def test_upsert_airplanes(database):
+    conn = functions.create_connection(database)
+    migrate(conn, FILENAME, AIRPLANE_MIGRATIONS)
+    airplanes = [Position(f"F-T{index:03}", 45 + index / 100, 5.0, 1000.0, 1000 + index, 100.0, 90.0, index)
+                 for index in range(COPY_MIN_ROWS + 10)]
+
+    assert upsert_airplanes(conn, FILENAME, "test", iter(airplanes)) == (len(airplanes), 0, 0, 0)
+    # the airplanes that aren't in the next snapshot become invisible
+    moved = [airplane._replace(latitude=airplane.latitude + 1, time=airplane.time + 60) for airplane in airplanes[:30]]
+    assert upsert_airplanes(conn, FILENAME, "test", iter(moved)) == (0, 30, len(airplanes) - 30, 0)
+    assert not conn.in_transaction
+
+    rows = execute(conn, FILENAME, """
+            SELECT apRegis, apLatitude, apTime, apInvisible FROM "AIRPLANE"
+            WHERE apSource = ?
+            ORDER BY apRegis;
+        """, ("test",)).fetchall()
+    assert [row[0] for row in rows] == [airplane.regis for airplane in airplanes]
+    assert [(row[1], row[2]) for row in rows[:30]] == [(airplane.latitude, airplane.time) for airplane in moved]
+    assert [row[3] for row in rows] == [0] * 30 + [1] * (len(airplanes) - 30)
+
+    # the airplanes that didn't move are skipped, until their heartbeat
+    unchanged = [airplane._replace(time=airplane.time + 30) for airplane in moved]
+    assert upsert_airplanes(conn, FILENAME, "test", iter(unchanged)) == (0, 0, 0, 30)
+    unchanged = [airplane._replace(time=airplane.time + HEARTBEAT_TIME) for airplane in moved]
+    assert upsert_airplanes(conn, FILENAME, "test", iter(unchanged)) == (0, 30, 0, 0)
+
+    # a snapshot that can't be read is rolled back
+    def truncated():
+        yield moved[0]
+        raise ValueError("truncated snapshot")
+    assert upsert_airplanes(conn, FILENAME, "test", truncated()) == (0, 0, 0, 0)
+    assert not conn.in_transaction
+    assert execute(conn, FILENAME, "SELECT count(*) FROM \"AIRPLANE\" WHERE apInvisible = 1;").fetchone()[0] \
+        == len(airplanes) - 30
+    conn.close()